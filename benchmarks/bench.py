@@ -0,0 +1,270 @@
+"""
+Reproducible benchmarks of montage stages on synthetic inputs.
+
+Run from the repository root:
+    python -m benchmarks.bench run --output benchmarks/baseline.json
+    python -m benchmarks.bench run --output current.json --compare benchmarks/baseline.json
+    python -m benchmarks.bench compare --baseline benchmarks/baseline.json --current current.json
+"""
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+import typer
+
+from benchmarks.fixtures import tone_bursts, random_images, IMAGE_SIZES
+from src import subtitles_utils
+from src.ffmpeg_utils import detect_silence_in_samples, non_silent_intervals, cut_audio, encode_audio, \
+    StreamingSilenceCutter, default_silence_config
+from src import image_utils
+from src.montajer_utils import create_videos_with_image, RenderBackend, FONT_PATH
+from src.subtitles_utils import SubtitleEntry, SubtitlesConfig, generate_subtitles
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+app = typer.Typer()
+
+# results are matched by these fields when comparing two runs
+RESULT_KEY = ('name', 'duration', 'rate', 'channels', 'size', 'threads')
+
+
+class StubWhisperModel:
+    """
+    Stands in for faster_whisper.WhisperModel when weights are not available: returns a word every 0.4s
+    without running inference, so the rest of the subtitles path is still exercised.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def transcribe(self, audio, language=None, word_timestamps=True, clip_timestamps=None, **kwargs):
+        if clip_timestamps:
+            spans = list(zip(clip_timestamps[::2], clip_timestamps[1::2]))
+        elif isinstance(audio, np.ndarray):
+            # 16kHz samples, like faster-whisper accepts
+            spans = [(0.0, len(audio) / 16000)]
+        else:
+            from src.ffmpeg_utils import probe_audio
+            spans = [(0.0, probe_audio(audio).duration)]
+        segments = []
+        for start, end in spans:
+            words = [types.SimpleNamespace(start=t, end=min(end, t + 0.35), word=f' word{i}')
+                     for i, t in enumerate(np.arange(start, end, 0.4))]
+            segments.append(types.SimpleNamespace(words=words))
+        return iter(segments), None
+
+
+def _measure(fn, repeats: int) -> tuple[float, float]:
+    """
+    :return: best wall time of several runs and peak traced memory (MB) of one more run
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def _result(name: str, duration: float, rate, channels, wall_time: float, peak_memory_mb: float, **extra) -> dict:
+    return dict(name=name, duration=duration, rate=rate, channels=channels, wall_time=wall_time,
+                throughput=duration / wall_time if wall_time else None, peak_memory_mb=peak_memory_mb, **extra)
+
+
+def bench_audio_stages(duration: float, rate: int, channels: int, repeats: int) -> list[dict]:
+    fixture = tone_bursts(duration, rate, channels)
+    config = default_silence_config
+    expected = [gap for gap in fixture.silences if gap[1] - gap[0] >= config.min_duration]
+    results = []
+
+    detected = detect_silence_in_samples(fixture.samples, rate, config.threshold_db, config.min_duration)
+    wall, peak = _measure(lambda: detect_silence_in_samples(fixture.samples, rate, config.threshold_db,
+                                                            config.min_duration), repeats)
+    results.append(_result('detect_silence', duration, rate, channels, wall, peak,
+                           correct=len(detected) == len(expected)))
+
+    non_sil = non_silent_intervals(detected, config.keep_silence, duration)
+    wall, peak = _measure(lambda: cut_audio(fixture.samples, rate, non_sil), repeats)
+    results.append(_result('remove_silence', duration, rate, channels, wall, peak))
+
+    def stream():
+        samples = fixture.samples.reshape(len(fixture.samples), channels)
+        cutter = StreamingSilenceCutter(rate, channels, config)
+        block = 10 * rate
+        for i in range(0, len(samples), block):
+            cutter.feed(samples[i:i + block])
+        cutter.finish()
+
+    wall, peak = _measure(stream, repeats)
+    results.append(_result('streaming_cleanup', duration, rate, channels, wall, peak))
+    return results
+
+
+def bench_subtitles(duration: float, repeats: int) -> dict:
+    words = [SubtitleEntry(t, t + 0.35, f'word{i}') for i, t in enumerate(np.arange(0, duration, 0.4))]
+    wall, peak = _measure(lambda: generate_subtitles(words, 25, 2), repeats)
+    return _result('generate_subtitles', duration, None, None, wall, peak, words=len(words))
+
+
+def bench_frames(folder: str, repeats: int) -> list[dict]:
+    results = []
+    for image_path, size in zip(random_images(os.path.join(folder, 'images')), IMAGE_SIZES):
+        for video_type in ('plain', 'short'):
+            def render():
+                # measure rendering itself, not hits of the in-process layer caches
+                image_utils._render_background.cache_clear()
+                image_utils._render_caption.cache_clear()
+                image_utils.render_frame(video_type, image_path, 'Benchmark caption', FONT_PATH)
+
+            wall, peak = _measure(render, repeats)
+            # throughput of frames is in frames per second
+            results.append(_result(f'render_frame_{video_type}', 1, None, None, wall, peak,
+                                   size=f'{size[0]}x{size[1]}'))
+    return results
+
+
+def bench_end_to_end(folder: str, files: int, duration: float, threads: int, whisper: str,
+                     render_backend: RenderBackend) -> dict:
+    audio_folder = os.path.join(folder, 'audio')
+    output_folder = os.path.join(folder, 'out')
+    os.makedirs(audio_folder, exist_ok=True)
+    os.makedirs(output_folder, exist_ok=True)
+    for i in range(files):
+        fixture = tone_bursts(duration, 44100, 2, seed=i)
+        encode_audio(fixture.samples, fixture.rate, os.path.join(audio_folder, f'audio_{i}.mp3'))
+    images_folder = os.path.join(folder, 'images')
+    if not os.path.isdir(images_folder):
+        random_images(images_folder)
+
+    subtitles_config = None
+    if whisper != 'none':
+        if whisper == 'stub':
+            subtitles_utils.WhisperModel = StubWhisperModel
+        subtitles_config = SubtitlesConfig(25, 2, 'tiny' if whisper == 'stub' else whisper, 'en', 'cpu')
+
+    start = time.perf_counter()
+    failures = create_videos_with_image(audio_folder, images_folder, output_folder, 'Benchmark caption',
+                                        subtitles_config is not None, subtitles_config, threads,
+                                        render_backend=render_backend)
+    wall = time.perf_counter() - start
+
+    peak = None
+    if resource:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    return _result('end_to_end', duration * files, 44100, 2, wall, peak, threads=threads, files=files,
+                   whisper=whisper, render_backend=render_backend.value, failures=len(failures))
+
+
+def _parse_list(value: str, cast) -> list:
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def _key(result: dict) -> tuple:
+    return tuple(result.get(field) for field in RESULT_KEY)
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    """
+    :return: descriptions of results whose throughput dropped more than tolerance relative to baseline
+    """
+    baseline_results = {_key(result): result for result in baseline['results']}
+    regressions = []
+    print(f"{'benchmark':<40}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for result in current['results']:
+        old = baseline_results.get(_key(result))
+        if not old or not old.get('throughput') or not result.get('throughput'):
+            continue
+        ratio = result['throughput'] / old['throughput']
+        name = '/'.join(str(value) for value in _key(result) if value is not None)
+        print(f"{name:<40}{old['throughput']:>12.1f}{result['throughput']:>12.1f}{ratio:>8.2f}")
+        if ratio < 1 - tolerance:
+            regressions.append(f'{name}: {ratio:.2f}x of baseline throughput')
+    return regressions
+
+
+@app.command(name='run')
+def run(output: str = typer.Option('benchmarks/results.json'),
+        durations: str = typer.Option('1,10,60', help="Длительности аудио в минутах через запятую"),
+        rates: str = typer.Option('16000,44100,48000'),
+        channels: str = typer.Option('1,2'),
+        repeats: int = typer.Option(3),
+        end_to_end: bool = typer.Option(True),
+        e2e_files: int = typer.Option(4),
+        e2e_duration: float = typer.Option(1.0, help="Длительность каждого файла в минутах"),
+        threads: int = typer.Option(2),
+        whisper: str = typer.Option('stub', help="stub, none или размер модели (tiny)"),
+        render_backend: RenderBackend = typer.Option(RenderBackend.FFMPEG),
+        compare: str = typer.Option(None, help="Сравнить с сохраненным результатом"),
+        tolerance: float = typer.Option(0.2)):
+    """
+    Запускает бенчмарки и сохраняет результат в json.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='montajer-bench-') as folder:
+        for minutes in _parse_list(durations, float):
+            results.append(bench_subtitles(minutes * 60, repeats))
+            for rate in _parse_list(rates, int):
+                for channel_count in _parse_list(channels, int):
+                    results += bench_audio_stages(minutes * 60, rate, channel_count, repeats)
+                    print(f"{minutes} мин, {rate} Гц, {channel_count} кан.: готово")
+        results += bench_frames(folder, repeats)
+        if end_to_end:
+            if shutil.which('ffmpeg') and shutil.which('ffprobe'):
+                results.append(bench_end_to_end(folder, e2e_files, e2e_duration * 60, threads, whisper,
+                                                render_backend))
+            else:
+                print("ffmpeg не найден, end-to-end бенчмарк пропущен")
+
+    report = {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                 'numpy': np.__version__, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Результаты: {output}")
+
+    if compare:
+        _compare_files(compare, output, tolerance)
+
+
+def _compare_files(baseline_path: str, current_path: str, tolerance: float):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(current_path, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+    regressions = compare_results(baseline, current, tolerance)
+    if regressions:
+        print("Регрессии:")
+        for regression in regressions:
+            print(f"  {regression}")
+        raise typer.Exit(code=1)
+
+
+@app.command(name='compare')
+def compare_command(baseline: str = typer.Option(), current: str = typer.Option(), tolerance: float = typer.Option(0.2)):
+    """
+    Сравнивает пропускную способность (секунд аудио в секунду) двух запусков.
+    """
+    _compare_files(baseline, current, tolerance)
+
+
+if __name__ == '__main__':
+    app()
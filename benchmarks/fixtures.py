@@ -0,0 +1,75 @@
+"""
+Synthetic inputs for benchmarks: tone bursts separated by silence gaps of known length and random images.
+Everything is generated locally from a seed, so runs are reproducible and need no network.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+from scipy.io.wavfile import write
+
+# silence gaps cycled between bursts, some are shorter than the default min silence duration (0.5s)
+DEFAULT_GAPS = (0.2, 0.6, 1.0, 2.5)
+IMAGE_SIZES = ((1920, 1080), (1080, 1920), (800, 600), (3000, 1000))
+
+AudioFixture = namedtuple('AudioFixture', ['samples', 'rate', 'silences'])
+
+
+def tone_bursts(duration: float, rate: int = 44100, channels: int = 1, burst: float = 3.0,
+                gaps: tuple = DEFAULT_GAPS, seed: int = 0) -> AudioFixture:
+    """
+    Generates int16 audio of tone bursts with silence gaps between them.
+    :param duration: duration in seconds
+    :param rate: sample rate
+    :param channels: number of channels
+    :param burst: length of every tone burst in seconds
+    :param gaps: lengths of silence gaps in seconds, cycled
+    :param seed: seed of the noise added to the bursts
+    :return: samples with shape (n,) or (n, channels), sample rate and list of (start, end) of every gap
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * rate)
+    burst_size = int(burst * rate)
+    t = np.arange(burst_size) / rate
+    # a few precomputed bursts are reused, generating a tone per burst would dominate for long fixtures
+    tones = [(np.sin(2 * np.pi * frequency * t) * 8000 + rng.normal(0, 300, burst_size)).astype(np.int16)
+             for frequency in (220.0, 330.0, 440.0)]
+
+    samples = np.zeros((n, channels), dtype=np.int16)
+    silences = []
+    position = 0
+    i = 0
+    while position < n:
+        tone = tones[i % len(tones)]
+        end = min(n, position + burst_size)
+        samples[position:end] = tone[:end - position, np.newaxis]
+        gap = gaps[i % len(gaps)]
+        gap_end = min(n, end + int(gap * rate))
+        if gap_end > end:
+            silences.append((end / rate, gap_end / rate))
+        position = gap_end
+        i += 1
+    return AudioFixture(samples[:, 0] if channels == 1 else samples, rate, silences)
+
+
+def write_wav(path: str, fixture: AudioFixture) -> str:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    write(path, fixture.rate, fixture.samples)
+    return path
+
+
+def random_image(path: str, size: tuple[int, int], seed: int = 0) -> str:
+    """
+    Writes JPEG with smooth random gradient noise of the given size.
+    """
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(1, size[1] // 40), max(1, size[0] // 40), 3), dtype=np.uint8)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    Image.fromarray(small).resize(size, Image.BILINEAR).save(path, quality=90)
+    return path
+
+
+def random_images(folder: str, seed: int = 0) -> list[str]:
+    return [random_image(os.path.join(folder, f'image_{width}x{height}.jpg'), (width, height), seed + i)
+            for i, (width, height) in enumerate(IMAGE_SIZES)]
@@ -1,21 +1,47 @@
+import asyncio
+import glob
 import json
+import os
+import subprocess
+import sys
 import time
-from pathlib import Path
 
 import typer
 
-from src.montajer_utils import create_videos_with_image, clean_audiotrack
-from src.subtitles_utils import SubtitlesConfig
+from src.cache_utils import ArtifactCache, DEFAULT_CACHE_MAX_SIZE
+from src.file_utils import remove_partial_files
+from src.encoder_utils import EncoderProfileName, encoder_profile
+from src.ffmpeg_utils import SilenceConfig, default_silence_config
+from src.manifest_utils import DEFAULT_MAX_ATTEMPTS, ItemState
+from src.metrics_utils import MetricsConfig, summarize_metrics
+from src.image_utils import load_font, CAPTION_FONT_SIZE
+from src.montajer_utils import create_videos_with_image, clean_audiotrack, concat_videos, RenderBackend, FONT_PATH
+from src.scheduler_utils import ExecutorType, StageLimits, default_stage_limits, PipelineWorkers, \
+    default_pipeline_workers
+from src.planning_utils import plan_batch, print_plan
+from src.server_utils import RenderService, DEFAULT_MAX_QUEUED, DEFAULT_MAX_FINISHED
+from src.sharding_utils import default_shard_config, BATCH_CONFIG_NAME, prepare_sharded_batch, register_plan, \
+    batch_progress, format_progress
+from src.subtitles_utils import SubtitlesConfig, SubtitleFormat, write_subtitle_files, default_subtitle_config, \
+    load_whisper_model
 
 app = typer.Typer()
+cache_app = typer.Typer(help="Управление кэшем артефактов (очищенное аудио, субтитры, видео)")
+app.add_typer(cache_app, name='cache')
+
+GB = 1024 ** 3
 
 
 @app.command(name='cleanup-audio')
-def cleanup_audio(audio_path: str = typer.Option(), output_path: str = typer.Option(None)):
-    if output_path:
-        clean_audiotrack(audio_path, output_path)
-    else:
-        clean_audiotrack(audio_path)
+def cleanup_audio(audio_path: str = typer.Option(), output_path: str = typer.Option(None),
+                  silence_threshold_db: float = typer.Option(default_silence_config.threshold_db),
+                  min_silence_duration: float = typer.Option(default_silence_config.min_duration),
+                  keep_silence: float = typer.Option(default_silence_config.keep_silence),
+                  streaming: bool = typer.Option(False, help="Обрабатывать аудио блоками с постоянным "
+                                                             "потреблением памяти")):
+    clean_audiotrack(audio_path, output_path,
+                     SilenceConfig(silence_threshold_db, min_silence_duration, keep_silence),
+                     streaming)
 
 
 @app.command(name="create-videos")
@@ -28,9 +54,74 @@ def create_videos(source_audio_folder_path: str = typer.Option(),
                   subtitles_max_line_count: int = typer.Option(),
                   subtitles_model: str = typer.Option(),
                   subtitles_language: str = typer.Option(),
-                  threads: int = typer.Option(1)):
+                  subtitles_device: str = typer.Option('auto', help="auto, cuda или cpu"),
+                  subtitles_compute_type: str = typer.Option(None, help="По умолчанию float16 на cuda, int8 на cpu"),
+                  subtitles_cpu_threads: int = typer.Option(0),
+                  subtitles_num_workers: int = typer.Option(1),
+                  subtitles_max_cue_duration: float = typer.Option(default_subtitle_config.max_cue_duration,
+                                                                   help="Сколько секунд субтитр может быть на экране"),
+                  subtitles_split_pause: float = typer.Option(default_subtitle_config.split_pause,
+                                                              help="Пауза, после которой начинается новый субтитр"),
+                  subtitles_split_on_punctuation: bool = typer.Option(default_subtitle_config.split_on_punctuation,
+                                                                      help="Заканчивать субтитр в конце предложения"),
+                  threads: int = typer.Option(1),
+                  silence_threshold_db: float = typer.Option(default_silence_config.threshold_db),
+                  min_silence_duration: float = typer.Option(default_silence_config.min_duration),
+                  keep_silence: float = typer.Option(default_silence_config.keep_silence),
+                  render_backend: RenderBackend = typer.Option(RenderBackend.MOVIEPY,
+                                                               help="ffmpeg читает исходный файл и пишет только "
+                                                                    "итоговое видео, moviepy дополнительно пишет "
+                                                                    "звук во временный файл"),
+                  executor: ExecutorType = typer.Option(ExecutorType.THREAD),
+                  max_encoders: int = typer.Option(default_stage_limits.encoders,
+                                                   help="Сколько видео может кодироваться одновременно"),
+                  max_transcribers: int = typer.Option(default_stage_limits.transcribers,
+                                                       help="Сколько аудио может транскрибироваться одновременно"),
+                  cleanup_workers: int = typer.Option(default_pipeline_workers.cleanup,
+                                                      help="Число потоков очистки аудио (--executor pipeline)"),
+                  subtitles_workers: int = typer.Option(default_pipeline_workers.subtitles,
+                                                        help="Число потоков генерации субтитров (--executor pipeline)"),
+                  render_workers: int = typer.Option(default_pipeline_workers.render,
+                                                     help="Число потоков рендера (--executor pipeline)"),
+                  cache_dir: str = typer.Option(None, help="Папка кэша. Если задана, повторно обрабатываются "
+                                                           "только изменившиеся файлы"),
+                  cache_max_size_gb: float = typer.Option(DEFAULT_CACHE_MAX_SIZE / GB),
+                  metrics_report: str = typer.Option(None, help="JSON-lines файл с метриками каждого этапа "
+                                                                "для каждого файла"),
+                  profile: bool = typer.Option(False, help="Сохранять вывод cProfile для python-этапов"),
+                  resume: bool = typer.Option(False, help="Продолжить прерванный запуск: готовые видео пропускаются, "
+                                                          "упавшие повторяются"),
+                  max_attempts: int = typer.Option(DEFAULT_MAX_ATTEMPTS, help="Сколько раз повторять упавшее видео "
+                                                                              "при --resume"),
+                  encoder_profile_name: EncoderProfileName = typer.Option(EncoderProfileName.STILL, '--encoder-profile',
+                                                                          help="Набор настроек кодирования"),
+                  video_codec: str = typer.Option(None, help="Кодек видео, например libx264, h264_nvenc"),
+                  preset: str = typer.Option(None),
+                  crf: int = typer.Option(None),
+                  fps: int = typer.Option(None),
+                  gop_seconds: int = typer.Option(None, help="Расстояние между ключевыми кадрами в секундах"),
+                  encoder_threads: int = typer.Option(None, help="Потоков ffmpeg на одно видео, 0 - поделить ядра "
+                                                                 "между параллельными видео"),
+                  audio_bitrate: str = typer.Option(None),
+                  dry_run: bool = typer.Option(False, help="Только проверить входные файлы и показать план запуска"),
+                  plan_output: str = typer.Option(None, help="JSON-файл, в который сохраняется план запуска"),
+                  sharded: bool = typer.Option(False, help="Работать обработчиком общего пакета: видео берутся из "
+                                                           "манифеста, общего с обработчиками на других машинах"),
+                  worker_id: str = typer.Option(None, help="Имя обработчика в манифесте, по умолчанию имя машины "
+                                                           "и pid"),
+                  heartbeat_interval: float = typer.Option(default_shard_config.heartbeat_interval,
+                                                           help="Как часто обработчик подтверждает, что видео "
+                                                                "еще в работе, в секундах"),
+                  stale_after: float = typer.Option(default_shard_config.stale_after,
+                                                    help="Через сколько секунд без подтверждения видео забирает "
+                                                         "другой обработчик")):
+    if profile and not metrics_report:
+        metrics_report = os.path.join(output_video_folder_path, 'montajer-metrics.jsonl')
+    metrics_config = MetricsConfig(metrics_report,
+                                   os.path.splitext(metrics_report)[0] + '_profiles' if profile else None) \
+        if metrics_report else None
     start_time = time.time()
-    create_videos_with_image(source_audio_folder_path,
+    failures = create_videos_with_image(source_audio_folder_path,
                              source_images_folder_path,
                              output_video_folder_path,
                              video_caption_text,
@@ -39,32 +130,179 @@ def create_videos(source_audio_folder_path: str = typer.Option(),
                                  subtitles_max_line_width,
                                  subtitles_max_line_count,
                                  subtitles_model,
-                                 subtitles_language
+                                 subtitles_language,
+                                 subtitles_device,
+                                 subtitles_compute_type,
+                                 subtitles_cpu_threads,
+                                 subtitles_num_workers,
+                                 subtitles_max_cue_duration,
+                                 subtitles_split_pause,
+                                 subtitles_split_on_punctuation
                              ) if subtitles_enabled else None,
-                             threads)
+                             threads,
+                             SilenceConfig(silence_threshold_db, min_silence_duration, keep_silence),
+                             render_backend,
+                             executor,
+                             StageLimits(max_encoders, max_transcribers),
+                             PipelineWorkers(cleanup_workers, subtitles_workers, render_workers),
+                             ArtifactCache(cache_dir, int(cache_max_size_gb * GB)) if cache_dir else None,
+                             metrics_config,
+                             resume,
+                             max_attempts,
+                             encoder_profile(encoder_profile_name, codec=video_codec, preset=preset, crf=crf, fps=fps,
+                                             gop_seconds=gop_seconds, threads=encoder_threads,
+                                             audio_bitrate=audio_bitrate),
+                             dry_run,
+                             plan_output,
+                             default_shard_config._replace(worker_id=worker_id,
+                                                           heartbeat_interval=heartbeat_interval,
+                                                           stale_after=stale_after) if sharded else None)
+    if dry_run:
+        return
     print(f"Общее время монтажа: {time.time() - start_time:.2f}")
+    if metrics_config:
+        print(summarize_metrics(metrics_config.report_path))
+        print(f"Метрики: {metrics_config.report_path}")
+        if metrics_config.profile_dir:
+            print(f"Профили cProfile: {metrics_config.profile_dir}")
+    if failures:
+        print(f"Не удалось смонтировать {len(failures)} видео:")
+        for audio_path, error in failures.items():
+            print(f"  {audio_path}: {error!r}")
+        raise typer.Exit(code=1)
 
 
-def clean_subtitle_videos(folder_path):
+@app.command(name='create-subtitles')
+def create_subtitles(source_audio_folder_path: str = typer.Option(),
+                     output_folder_path: str = typer.Option(),
+                     subtitles_max_line_width: int = typer.Option(25),
+                     subtitles_max_line_count: int = typer.Option(2),
+                     subtitles_model: str = typer.Option('base'),
+                     subtitles_language: str = typer.Option(None),
+                     subtitles_device: str = typer.Option('auto', help="auto, cuda или cpu"),
+                     subtitles_compute_type: str = typer.Option(None),
+                     subtitles_cpu_threads: int = typer.Option(0),
+                     subtitles_num_workers: int = typer.Option(2, help="Сколько файлов распознается параллельно"),
+                     subtitles_max_cue_duration: float = typer.Option(default_subtitle_config.max_cue_duration),
+                     subtitles_split_pause: float = typer.Option(default_subtitle_config.split_pause),
+                     subtitles_split_on_punctuation: bool = typer.Option(default_subtitle_config.split_on_punctuation),
+                     subtitle_format: SubtitleFormat = typer.Option(SubtitleFormat.SRT)):
     """
-    Удаляет все mp4-файлы, не оканчивающиеся на '_subtitles.mp4',
-    и переименовывает файлы, заканчивающиеся на '_subtitles.mp4',
-    удаляя '_subtitles' из имени файла.
+    Создает субтитры (srt, vtt или ass) для всех аудиофайлов папки одной общей моделью.
     """
-    folder = Path(folder_path)
+    start_time = time.time()
+    audio_paths = glob.glob(os.path.join(source_audio_folder_path, '*.mp3')) + \
+                  glob.glob(os.path.join(source_audio_folder_path, '*.m4a'))
+    output_paths = [os.path.join(output_folder_path, f'{os.path.basename(audio_path)[:-4]}.{subtitle_format.value}')
+                    for audio_path in audio_paths]
+    write_subtitle_files(audio_paths, output_paths, subtitle_format,
+                         SubtitlesConfig(subtitles_max_line_width, subtitles_max_line_count, subtitles_model,
+                                         subtitles_language, subtitles_device, subtitles_compute_type,
+                                         subtitles_cpu_threads, subtitles_num_workers, subtitles_max_cue_duration,
+                                         subtitles_split_pause, subtitles_split_on_punctuation))
+    print(f"Общее время создания субтитров: {time.time() - start_time:.2f}")
 
-    #  Шаг 1. Удаляем все файлы без суффикса '_subtitles'
-    for f in folder.glob("*.mp4"):
-        if not f.name.endswith("_subtitles.mp4"):
-            f.unlink()  # удаление файла
-            print(f"Deleted:  {f.name}")
 
-    # Шаг 2. Переименовываем оставшиеся файлы
-    for f in folder.glob("*_subtitles.mp4"):
-        new_name = f.name.replace("_subtitles.mp4", ".mp4")
-        target = f.with_name(new_name)
-        f.rename(target)
-        print(f"Renamed:  {f.name}  ->  {new_name}")
+@app.command(name='concat-videos')
+def concat_videos_command(video_path: list[str] = typer.Option(..., help="Видео в порядке склейки, опция "
+                                                                           "повторяется для каждого видео"),
+                          output_path: str = typer.Option(),
+                          crossfade: float = typer.Option(0.0, help="Длительность плавного перехода между видео "
+                                                                    "в секундах, 0 - без переходов"),
+                          encoder_profile_name: EncoderProfileName = typer.Option(EncoderProfileName.STILL,
+                                                                                  '--encoder-profile',
+                                                                                  help="Настройки кодирования "
+                                                                                       "переходов и вставок")):
+    """
+    Склеивает видео в одно без перекодирования. Перекодируются только переходы и вставки
+    с другими параметрами (заставки, концовки).
+    """
+    start_time = time.time()
+    concat_videos(video_path, output_path, crossfade, encoder_profile(encoder_profile_name))
+    print(f"Общее время склейки: {time.time() - start_time:.2f}")
+
+
+@app.command(name='coordinate')
+def coordinate(config: str = typer.Option(help="Файл настроек create-videos"),
+               local_workers: int = typer.Option(0, help="Сколько обработчиков запустить на этой машине"),
+               report_interval: float = typer.Option(10, help="Как часто печатать ход пакета, в секундах"),
+               resume: bool = typer.Option(False, help="Продолжить прерванный пакет вместо нового")):
+    """
+    Готовит пакет для нескольких машин: папка с видео (общая для всех машин) становится очередью заданий.
+    Обработчики запускаются командой montage с файлом пакета, на этой машине - опцией --local-workers.
+    Печатает общий ход пакета и производительность, пока все видео не будут готовы.
+    """
+    with open(config, 'r', encoding='utf-8') as file:
+        batch_config = {**json.load(file), 'task-type': 'create-videos', 'sharded': True}
+    output_folder = batch_config['output-video-folder-path']
+    stale_after = batch_config.get('stale-after', default_shard_config.stale_after)
+    max_attempts = batch_config.get('max-attempts', DEFAULT_MAX_ATTEMPTS)
+    manifest = prepare_sharded_batch(output_folder, resume)
+    plan = plan_batch(batch_config['source-audio-folder-path'], batch_config['source-images-folder-path'],
+                      output_folder)
+    print_plan(plan)
+    register_plan(manifest, plan)
+    batch_config_path = os.path.abspath(os.path.join(output_folder, BATCH_CONFIG_NAME))
+    with open(batch_config_path, 'w', encoding='utf-8') as file:
+        json.dump(batch_config, file, ensure_ascii=False, indent=2)
+    print(f"Запуск обработчика на другой машине: python montajer.py montage --config {batch_config_path}")
+
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'montage', '--config', batch_config_path])
+               for _ in range(local_workers)]
+    start_time = time.time()
+    initial = batch_progress(manifest, max_attempts)
+    try:
+        while True:
+            time.sleep(report_interval)
+            progress = batch_progress(manifest, max_attempts)
+            print(format_progress(progress, time.time() - start_time, progress.done - initial.done,
+                                  progress.done_duration - initial.done_duration))
+            if not progress.pending and not progress.running and not progress.retryable:
+                break
+            # without other machines nobody is left to finish the batch
+            if workers and all(worker.poll() is not None for worker in workers) and not manifest.active(stale_after):
+                break
+    except KeyboardInterrupt:
+        print("Наблюдение остановлено")
+    for worker in workers:
+        worker.wait()
+
+    progress = batch_progress(manifest, max_attempts)
+    if not progress.running:
+        # files of workers which died while writing them
+        remove_partial_files(output_folder)
+    print(f"Общее время пакета: {time.time() - start_time:.2f}")
+    for worker, count in sorted(progress.workers.items()):
+        print(f"  {worker}: {count} видео")
+    failed = [item for item in manifest.items() if item['state'] == ItemState.FAILED]
+    if failed or progress.done < progress.total:
+        print(f"Не удалось смонтировать {len(failed)} видео, "
+              f"не обработано {progress.total - progress.done - len(failed)}:")
+        for item in failed:
+            print(f"  {item['audio_path']}: {item['error']}")
+        raise typer.Exit(code=1)
+
+
+@cache_app.command(name='stats')
+def cache_stats(cache_dir: str = typer.Option()):
+    """
+    Выводит количество и размер закэшированных артефактов по этапам.
+    """
+    stats = ArtifactCache(cache_dir).stats()
+    for stage, stage_stats in sorted(stats.items()):
+        print(f"{stage}: {stage_stats['count']} файлов, {stage_stats['size'] / GB:.2f} ГБ")
+    total = sum(stage_stats['size'] for stage_stats in stats.values())
+    print(f"Всего: {sum(stage_stats['count'] for stage_stats in stats.values())} файлов, {total / GB:.2f} ГБ")
+
+
+@cache_app.command(name='prune')
+def cache_prune(cache_dir: str = typer.Option(),
+                max_size_gb: float = typer.Option(DEFAULT_CACHE_MAX_SIZE / GB)):
+    """
+    Удаляет давно не использованные артефакты, пока кэш не уложится в заданный размер.
+    """
+    removed = ArtifactCache(cache_dir).prune(int(max_size_gb * GB))
+    print(f"Удалено файлов: {removed}")
 
 
 @app.command(name="montage")
@@ -75,25 +313,114 @@ def montage(config: str = typer.Option()):
     """
 
     with open(config, 'r', encoding='utf-8') as file:
-        config = json.load(file)
-        task_type = config['task-type']
-        if task_type == 'create-videos':
-            create_videos(source_audio_folder_path=config['source-audio-folder-path'],
-                          source_images_folder_path=config['source-images-folder-path'],
-                          output_video_folder_path=config['output-video-folder-path'],
-                          video_caption_text=config['video-caption-text'],
-                          subtitles_enabled=config['subtitles-enabled'],
-                          subtitles_max_line_width=config['subtitles-max-line-width'],
-                          subtitles_max_line_count=config['subtitles-max-line-count'],
-                          subtitles_model=config['subtitles-model'],
-                          subtitles_language=config['subtitles-language'],
-                          threads=config['threads'])
-        elif task_type == 'cleanup-audio':
-            cleanup_audio(config['audio-path'])
-        else:
-            raise ValueError("Неверный task-type")
-
-    clean_subtitle_videos(config['output-video-folder-path'])
+        run_config(json.load(file))
+
+
+def run_config(config: dict):
+    """
+    Выполняет задание в формате файла настроек (используется командами montage и serve).
+    """
+    task_type = config['task-type']
+    if task_type == 'create-videos':
+        pipeline_workers = config.get('pipeline-workers', {})
+        encoder = config.get('encoder', {})
+        create_videos(source_audio_folder_path=config['source-audio-folder-path'],
+                      source_images_folder_path=config['source-images-folder-path'],
+                      output_video_folder_path=config['output-video-folder-path'],
+                      video_caption_text=config['video-caption-text'],
+                      subtitles_enabled=config['subtitles-enabled'],
+                      subtitles_max_line_width=config['subtitles-max-line-width'],
+                      subtitles_max_line_count=config['subtitles-max-line-count'],
+                      subtitles_model=config['subtitles-model'],
+                      subtitles_language=config['subtitles-language'],
+                      subtitles_device=config.get('subtitles-device', 'auto'),
+                      subtitles_compute_type=config.get('subtitles-compute-type'),
+                      subtitles_cpu_threads=config.get('subtitles-cpu-threads', 0),
+                      subtitles_num_workers=config.get('subtitles-num-workers', 1),
+                      subtitles_max_cue_duration=config.get('subtitles-max-cue-duration',
+                                                            default_subtitle_config.max_cue_duration),
+                      subtitles_split_pause=config.get('subtitles-split-pause', default_subtitle_config.split_pause),
+                      subtitles_split_on_punctuation=config.get('subtitles-split-on-punctuation',
+                                                                default_subtitle_config.split_on_punctuation),
+                      threads=config['threads'],
+                      silence_threshold_db=config.get('silence-threshold-db', default_silence_config.threshold_db),
+                      min_silence_duration=config.get('min-silence-duration', default_silence_config.min_duration),
+                      keep_silence=config.get('keep-silence', default_silence_config.keep_silence),
+                      render_backend=RenderBackend(config.get('render-backend', RenderBackend.MOVIEPY)),
+                      executor=ExecutorType(config.get('executor', ExecutorType.THREAD)),
+                      max_encoders=config.get('max-encoders', default_stage_limits.encoders),
+                      max_transcribers=config.get('max-transcribers', default_stage_limits.transcribers),
+                      cleanup_workers=pipeline_workers.get('cleanup', default_pipeline_workers.cleanup),
+                      subtitles_workers=pipeline_workers.get('subtitles', default_pipeline_workers.subtitles),
+                      render_workers=pipeline_workers.get('render', default_pipeline_workers.render),
+                      cache_dir=config.get('cache-dir'),
+                      cache_max_size_gb=config.get('cache-max-size-gb', DEFAULT_CACHE_MAX_SIZE / GB),
+                      metrics_report=config.get('metrics-report'),
+                      profile=config.get('profile', False),
+                      resume=config.get('resume', False),
+                      max_attempts=config.get('max-attempts', DEFAULT_MAX_ATTEMPTS),
+                      encoder_profile_name=EncoderProfileName(config.get('encoder-profile', EncoderProfileName.STILL)),
+                      video_codec=encoder.get('codec'),
+                      preset=encoder.get('preset'),
+                      crf=encoder.get('crf'),
+                      fps=encoder.get('fps'),
+                      gop_seconds=encoder.get('gop-seconds'),
+                      encoder_threads=encoder.get('threads'),
+                      audio_bitrate=encoder.get('audio-bitrate'),
+                      dry_run=config.get('dry-run', False),
+                      plan_output=config.get('plan-output'),
+                      sharded=config.get('sharded', False),
+                      worker_id=config.get('worker-id'),
+                      heartbeat_interval=config.get('heartbeat-interval', default_shard_config.heartbeat_interval),
+                      stale_after=config.get('stale-after', default_shard_config.stale_after))
+    elif task_type == 'concat-videos':
+        concat_videos_command(video_path=config['video-paths'], output_path=config['output-path'],
+                              crossfade=config.get('crossfade', 0.0),
+                              encoder_profile_name=EncoderProfileName(config.get('encoder-profile',
+                                                                                 EncoderProfileName.STILL)))
+    elif task_type == 'cleanup-audio':
+        cleanup_audio(config['audio-path'], config.get('output-path'),
+                      silence_threshold_db=config.get('silence-threshold-db', default_silence_config.threshold_db),
+                      min_silence_duration=config.get('min-silence-duration', default_silence_config.min_duration),
+                      keep_silence=config.get('keep-silence', default_silence_config.keep_silence),
+                      streaming=config.get('streaming', False))
+    else:
+        raise ValueError("Неверный task-type")
+
+
+def _run_service_job(config: dict):
+    try:
+        run_config(config)
+    except typer.Exit as e:
+        if e.exit_code:
+            raise RuntimeError(f"Задание завершилось с кодом {e.exit_code}") from e
+
+
+@app.command(name='serve')
+def serve(host: str = typer.Option('127.0.0.1'),
+          port: int = typer.Option(8765),
+          socket_path: str = typer.Option(None, help="Слушать unix-сокет вместо TCP-порта"),
+          max_jobs: int = typer.Option(1, help="Сколько заданий выполняется одновременно"),
+          max_queued: int = typer.Option(DEFAULT_MAX_QUEUED, help="Сколько заданий может ждать в очереди"),
+          max_finished: int = typer.Option(DEFAULT_MAX_FINISHED, help="Сколько завершенных заданий хранить, "
+                                                                      "более старые забываются"),
+          preload_model: str = typer.Option(None, help="Загрузить модель whisper при запуске"),
+          preload_device: str = typer.Option('auto')):
+    """
+    Запускает постоянный сервис монтажа с очередью заданий и HTTP API.
+    Задание - json в формате файла настроек montage:
+        POST /jobs - добавить, GET /jobs - список, GET /jobs/<id> - статус,
+        POST /jobs/<id>/cancel или DELETE /jobs/<id> - отменить, GET /health - состояние.
+    """
+    load_font(FONT_PATH, CAPTION_FONT_SIZE)
+    if preload_model:
+        load_whisper_model(preload_model, preload_device)
+    service = RenderService(_run_service_job, max_jobs, max_queued, max_finished)
+    print(f"Сервис слушает {socket_path or f'http://{host}:{port}'}")
+    try:
+        asyncio.run(service.serve(host, port, socket_path))
+    except KeyboardInterrupt:
+        print("Сервис остановлен")
 
 
 # TODO
@@ -0,0 +1,215 @@
+import errno
+import math
+import os
+import shutil
+import tempfile
+from typing import Iterable, Iterator
+
+import numpy as np
+from scipy.io.wavfile import write, read
+from scipy.signal import resample_poly
+
+from .ffmpeg_utils import encode_audio, frame_levels_db, FRAME_DURATION
+
+# whisper expects 16kHz mono float32 samples
+WHISPER_SAMPLE_RATE = 16000
+
+# large cleaned tracks are spilled into a memory-mapped file, on linux preferably in RAM-backed tmpfs
+SHM_DIR = '/dev/shm'
+
+
+def spill_dir(size: int) -> str:
+    """
+    Chooses folder for a temporary file of about size bytes: /dev/shm if it has room for the file,
+    otherwise the temp dir (docker limits /dev/shm to 64 MB by default).
+    """
+    try:
+        stat = os.statvfs(SHM_DIR)
+    except (OSError, AttributeError):  # no /dev/shm, windows has no statvfs
+        return tempfile.gettempdir()
+    if os.access(SHM_DIR, os.W_OK) and stat.f_bavail * stat.f_frsize > size:
+        return SHM_DIR
+    return tempfile.gettempdir()
+
+
+class AudioBuffer:
+    """
+    Decoded 16-bit PCM audio passed between stages of a job instead of intermediate audiofiles.
+
+    Samples are kept in memory or, for very large tracks, in a memory-mapped spill file which is
+    deleted by close(). Encoders read samples from an ffmpeg stdin pipe, so the cleaned track
+    is never re-encoded to a lossy format before the final mux.
+    """
+
+    def __init__(self, samples: np.ndarray, rate: int, spill_path: str = None):
+        """
+        :param samples: samples array with shape (n, channels)
+        :param rate: sample rate
+        :param spill_path: file backing memory-mapped samples, removed on close
+        """
+        self.samples = samples
+        self.rate = rate
+        self.spill_path = spill_path
+
+    @property
+    def channels(self) -> int:
+        return self.samples.shape[1]
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.rate
+
+    @classmethod
+    def from_samples(cls, aud: np.ndarray, rate: int) -> 'AudioBuffer':
+        """
+        :param aud: samples array with shape (n,) or (n, channels)
+        """
+        return cls(aud.reshape(len(aud), -1), rate)
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[np.ndarray], rate: int, channels: int,
+                    max_size: int = 0) -> 'AudioBuffer':
+        """
+        Collects chunks produced block by block (i.e. by the streaming silence cutter) into a memory-mapped
+        spill file, so the whole track is never held in process memory.
+        If /dev/shm runs out of space (i.e. it is shared by concurrent jobs), the file is moved to the temp dir.
+        :param chunks: sample arrays with shape (n, channels)
+        :param max_size: upper bound of the size of samples in bytes, used to choose the spill folder
+        """
+        fd, spill_path = tempfile.mkstemp(prefix='montajer-', suffix='.pcm', dir=spill_dir(max_size))
+        length = 0
+        f = os.fdopen(fd, 'wb', buffering=0)
+        try:
+            for chunk in chunks:
+                data = np.ascontiguousarray(chunk, dtype='<i2').tobytes()
+                try:
+                    _write_all(f, data)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC or os.path.dirname(spill_path) != SHM_DIR:
+                        raise
+                    f, spill_path = _move_spill(f, spill_path, length * channels * 2)
+                    _write_all(f, data)
+                length += len(chunk)
+            f.close()
+            if not length:
+                os.remove(spill_path)
+                return cls(np.empty((0, channels), dtype=np.int16), rate)
+            samples = np.memmap(spill_path, dtype='<i2', mode='r', shape=(length, channels))
+        except BaseException:
+            f.close()
+            if os.path.exists(spill_path):
+                os.remove(spill_path)
+            raise
+        return cls(samples, rate, spill_path)
+
+    @classmethod
+    def load(cls, path: str) -> 'AudioBuffer':
+        """
+        Opens WAV file written by save, samples are memory-mapped.
+        """
+        rate, aud = read(path, mmap=True)
+        return cls.from_samples(aud, rate)
+
+    def save(self, path: str):
+        """
+        Writes samples losslessly to a WAV file (used by the artifact cache).
+        """
+        write(path, self.rate, self.samples)
+
+    def encode(self, output_path: str):
+        """
+        Encodes samples to audiofile. Format is specified by extension of output path.
+        """
+        encode_audio(self.samples, self.rate, output_path)
+
+    def trim(self, duration: float = None) -> 'AudioBuffer':
+        """
+        :return: buffer with at most duration seconds of samples (shares samples and spill file with this one)
+        """
+        if not duration or duration >= self.duration:
+            return self
+        return AudioBuffer(self.samples[:int(duration * self.rate)], self.rate, self.spill_path)
+
+    def whisper_samples(self, block_duration: int = 60) -> np.ndarray:
+        """
+        Downmixes and resamples audio to the input format of whisper.
+        Conversion is done in blocks, so memory of the intermediate float copy does not grow with the track.
+        :return: 16kHz mono float32 samples
+        """
+        gcd = math.gcd(self.rate, WHISPER_SAMPLE_RATE)
+        up, down = WHISPER_SAMPLE_RATE // gcd, self.rate // gcd
+        block = block_duration * self.rate
+        # one second of context on both sides of a block hides edge effects of the resampling filter
+        pad = self.rate
+        parts = []
+        for start in range(0, len(self.samples), block):
+            low, high = max(0, start - pad), min(len(self.samples), start + block + pad)
+            mono = self.samples[low:high].mean(axis=1, dtype=np.float32) / 32768
+            if up == down:
+                parts.append(mono[start - low:start - low + block])
+                continue
+            resampled = resample_poly(mono, up, down)
+            head = (start - low) * up // down
+            length = math.ceil(min(block, len(self.samples) - start) * up / down)
+            parts.append(resampled[head:head + length].astype(np.float32, copy=False))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.float32)
+
+    def whisper_chunks(self, chunk_duration: int = 600,
+                       search_duration: float = 5.0) -> Iterator[tuple[float, np.ndarray]]:
+        """
+        Splits audio into whisper inputs of about chunk_duration seconds, so a long spilled track is
+        transcribed without its whole float copy in memory. Every chunk ends at the quietest frame of
+        the last search_duration seconds before its nominal end, words are not cut in half.
+        :return: iterator of chunk start in seconds and its 16kHz mono float32 samples
+        """
+        chunk, search = int(chunk_duration * self.rate), int(search_duration * self.rate)
+        frame_size = max(1, int(round(FRAME_DURATION * self.rate)))
+        start = 0
+        while start < len(self.samples):
+            end = min(start + chunk, len(self.samples))
+            if end < len(self.samples):
+                low = max(start + 1, end - search)
+                levels = frame_levels_db(self.samples[low:end], self.rate)
+                end = low + int(np.argmin(levels)) * frame_size
+            yield start / self.rate, AudioBuffer(self.samples[start:end], self.rate).whisper_samples()
+            start = end
+
+    def close(self):
+        """
+        Releases samples and deletes the spill file.
+        """
+        self.samples = np.empty((0, self.channels), dtype=np.int16)
+        if self.spill_path:
+            try:
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                pass
+            self.spill_path = None
+
+
+def _write_all(f, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[f.write(view):]
+
+
+def _move_spill(f, spill_path: str, size: int):
+    """
+    Moves the first size bytes of a spill file to the temp dir.
+    :return: file opened for appending and its path
+    """
+    f.close()
+    fd, new_path = tempfile.mkstemp(prefix='montajer-', suffix='.pcm', dir=tempfile.gettempdir())
+    new_file = os.fdopen(fd, 'wb', buffering=0)
+    try:
+        with open(spill_path, 'rb') as old_file:
+            shutil.copyfileobj(old_file, new_file)
+        new_file.truncate(size)
+        new_file.seek(size)
+    except BaseException:
+        new_file.close()
+        os.remove(new_path)
+        raise
+    finally:
+        os.remove(spill_path)
+    return new_file, new_path
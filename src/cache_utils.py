@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 ** 3
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ArtifactCache:
+    """
+    Persistent on-disk cache of intermediate and final artifacts (cleaned audio, word timestamps, videos).
+
+    Artifacts are addressed by a key built from content hash of input files and the parameters
+    that affect the result, so a key stays valid as long as the inputs don't change.
+    Artifacts are stored as <cache_dir>/<stage>/<key[:2]>/<key><suffix>. Modification time of a file
+    is its last use, the least recently used artifacts are evicted when the cache exceeds max_size.
+    The size is counted by the cache object, the cache folder is scanned only when the counter exceeds
+    the limit (other processes writing to the same cache are taken into account then).
+    Writes are atomic, so the cache can be shared between threads and processes.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        # (path, size, mtime) -> content hash, so the same background image is hashed once per process
+        self._file_hashes = {}
+        # size of the cache counted since the last scan, None - not scanned yet
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def __getstate__(self):
+        # workers of a process pool count the size of the cache themselves
+        return {'cache_dir': self.cache_dir, 'max_size': self.max_size, 'file_hashes': self._file_hashes}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'], state['max_size'])
+        self._file_hashes = state['file_hashes']
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._file_hashes:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            self._file_hashes[memo_key] = digest.hexdigest()
+        return self._file_hashes[memo_key]
+
+    def key(self, files: list[str] = (), **params) -> str:
+        """
+        Builds artifact key.
+        :param files: input files, their content is hashed (paths are ignored)
+        :param params: parameters affecting the artifact, must be json-serializable
+        """
+        payload = json.dumps({'files': [self.file_hash(path) for path in files], 'params': params},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, stage: str, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, stage, key[:2], key + suffix)
+
+    def get(self, stage: str, key: str, suffix: str) -> str | None:
+        """
+        :return: path of the cached artifact or None if it is absent
+        """
+        path = self._path(stage, key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, stage: str, key: str, suffix: str, source_path: str) -> str:
+        """
+        Copies artifact into the cache and evicts least recently used artifacts if the cache became too big.
+        :return: path of the cached artifact
+        """
+        path = self._path(stage, key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(stat.st_size for _, _, stat in self._artifacts())
+            else:
+                self._size += os.path.getsize(path)
+            over_limit = self._size > self.max_size
+        if over_limit:
+            self.prune()
+        return path
+
+    def get_json(self, stage: str, key: str):
+        path = self.get(stage, key, '.json')
+        if path is None:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def put_json(self, stage: str, key: str, value):
+        fd, tmp_path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+            self.put(stage, key, '.json', tmp_path)
+        finally:
+            os.remove(tmp_path)
+
+    def _artifacts(self) -> list[tuple[str, str, os.stat_result]]:
+        artifacts = []
+        if not os.path.isdir(self.cache_dir):
+            return artifacts
+        for stage in os.listdir(self.cache_dir):
+            for root, _, files in os.walk(os.path.join(self.cache_dir, stage)):
+                for name in files:
+                    if name.endswith('.tmp'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        artifacts.append((stage, path, os.stat(path)))
+                    except FileNotFoundError:
+                        continue
+        return artifacts
+
+    def stats(self) -> dict[str, dict]:
+        """
+        :return: stage -> {'count': number of artifacts, 'size': total size in bytes}
+        """
+        result = {}
+        for stage, _, stat in self._artifacts():
+            stage_stats = result.setdefault(stage, {'count': 0, 'size': 0})
+            stage_stats['count'] += 1
+            stage_stats['size'] += stat.st_size
+        return result
+
+    def prune(self, max_size: int = None) -> int:
+        """
+        Removes least recently used artifacts until the cache fits into max_size.
+        :param max_size: size limit in bytes, by default the limit of the cache
+        :return: number of removed artifacts
+        """
+        max_size = self.max_size if max_size is None else max_size
+        artifacts = sorted(self._artifacts(), key=lambda artifact: artifact[2].st_mtime)
+        total = sum(stat.st_size for _, _, stat in artifacts)
+        removed = 0
+        for _, path, stat in artifacts:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+            removed += 1
+        with self._size_lock:
+            self._size = total
+        return removed
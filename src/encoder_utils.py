@@ -0,0 +1,244 @@
+import os
+from collections import namedtuple
+from enum import Enum
+
+# codec - ffmpeg video encoder, preset / crf / tune - encoder settings (None - encoder default),
+# fps - frame rate of the output, gop_seconds - distance between keyframes,
+# threads - ffmpeg threads per encode (0 - divide cores between concurrent encodes), audio_* - audio encoder
+EncoderProfile = namedtuple('EncoderProfile', ['codec', 'preset', 'crf', 'fps', 'gop_seconds', 'tune', 'threads',
+                                               'audio_codec', 'audio_bitrate'])
+
+
+class EncoderProfileName(str, Enum):
+    STILL = 'still'
+    STILL_FAST = 'still-fast'
+    STANDARD = 'standard'
+
+
+ENCODER_PROFILES = {
+    # a still image with a caption: one frame per second, a keyframe every 10s, x264 tuned for still images
+    EncoderProfileName.STILL: EncoderProfile('libx264', 'veryfast', 23, 1, 10, 'stillimage', 0, 'aac', '128k'),
+    # the fastest encode for drafts and huge batches, slightly larger files
+    EncoderProfileName.STILL_FAST: EncoderProfile('libx264', 'ultrafast', 26, 1, 30, 'stillimage', 0, 'aac', '128k'),
+    # regular video settings, as the videos were encoded before profiles existed
+    EncoderProfileName.STANDARD: EncoderProfile('libx264', 'medium', 23, 24, 10, None, 0, 'aac', '192k'),
+}
+default_encoder_profile = ENCODER_PROFILES[EncoderProfileName.STILL]
+
+# crf and tune are options of software x264/x265, hardware encoders (nvenc, qsv, videotoolbox...) don't accept them
+_SOFTWARE_CODECS = ('libx264', 'libx265')
+# codec of the stream -> software encoder producing it
+_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+
+
+def encoder_profile(name: EncoderProfileName = EncoderProfileName.STILL, **overrides) -> EncoderProfile:
+    """
+    Returns built-in profile with some of its fields replaced.
+    :param name: built-in profile
+    :param overrides: fields of EncoderProfile, None values are ignored
+    """
+    return ENCODER_PROFILES[EncoderProfileName(name)]._replace(
+        **{key: value for key, value in overrides.items() if value is not None})
+
+
+def encoder_codec(encoder: str) -> str:
+    """
+    :return: ffprobe name of the codec produced by an ffmpeg encoder, i.e. h264 for libx264 and h264_nvenc
+    """
+    for codec, software_encoder in _ENCODERS.items():
+        if encoder == software_encoder:
+            return codec
+    return encoder.split('_')[0]
+
+
+def matching_profile(profile: EncoderProfile, codec: str) -> EncoderProfile:
+    """
+    Returns profile whose encoder produces the given codec, so new parts can be joined with existing videos.
+    """
+    if encoder_codec(profile.codec) == codec:
+        return profile
+    if codec not in _ENCODERS:
+        raise ValueError(f'No encoder for codec {codec}')
+    return profile._replace(codec=_ENCODERS[codec])
+
+
+# fields of the H.264 parameter sets which depend on encoder settings: profile_idc / level_idc of the SPS,
+# ref - default number of reference frames, cabac - entropy coder, init_qp - base qp of slices (crf of x264),
+# weighted_* / transform_8x8 / chroma_qp_offset - prediction and transform tools of the PPS
+H264Params = namedtuple('H264Params', ['profile_idc', 'level_idc', 'ref', 'cabac', 'init_qp', 'weighted_pred',
+                                       'weighted_bipred', 'transform_8x8', 'chroma_qp_offset'])
+
+# profile_idc -> x264 profile
+_H264_PROFILES = {66: 'baseline', 77: 'main', 100: 'high'}
+
+
+class _BitReader:
+    """
+    Reads fields of a NAL unit payload (RBSP) in the order of the H.264 syntax.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+        # the payload ends with a stop bit followed by zero bits
+        last = len(data) - 1
+        while last >= 0 and not data[last]:
+            last -= 1
+        self.end = last * 8 + 7 - ((data[last] & -data[last]).bit_length() - 1) if last >= 0 else 0
+
+    def u(self, bits: int) -> int:
+        value = 0
+        for _ in range(bits):
+            if self.pos >= len(self.data) * 8:
+                raise ValueError('Truncated parameter set')
+            value = (value << 1) | ((self.data[self.pos // 8] >> (7 - self.pos % 8)) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value % 2 else -(value // 2)
+
+    def more_data(self) -> bool:
+        return self.pos < self.end
+
+
+def _rbsp(nal: bytes) -> bytes:
+    """
+    Removes the NAL header and emulation prevention bytes (00 00 03 -> 00 00).
+    """
+    return nal[1:].replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def parse_h264_params(parameter_sets: list[bytes]) -> H264Params | None:
+    """
+    Reads encoder dependent fields of the first SPS and PPS of an H.264 stream.
+    :param parameter_sets: NAL units of the parameter sets without start codes
+    :return: None if the stream has no SPS or PPS, or it uses tools x264 doesn't produce (slice groups)
+    """
+    sps = next((nal for nal in parameter_sets if nal and nal[0] & 0x1f == 7), None)
+    pps = next((nal for nal in parameter_sets if nal and nal[0] & 0x1f == 8), None)
+    if sps is None or pps is None or len(sps) < 4:
+        return None
+    sps_data = _rbsp(sps)
+    reader = _BitReader(_rbsp(pps))
+    try:
+        reader.ue()  # pic_parameter_set_id
+        reader.ue()  # seq_parameter_set_id
+        cabac = reader.u(1)
+        reader.u(1)  # bottom_field_pic_order_in_frame_present_flag
+        if reader.ue():  # num_slice_groups_minus1
+            return None
+        ref = reader.ue() + 1
+        reader.ue()  # num_ref_idx_l1_default_active_minus1
+        weighted_pred = reader.u(1)
+        weighted_bipred = reader.u(2)
+        init_qp = reader.se() + 26
+        reader.se()  # pic_init_qs_minus26
+        chroma_qp_offset = reader.se()
+        reader.u(3)  # deblocking filter control, constrained intra pred, redundant pic cnt
+        transform_8x8 = reader.u(1) if reader.more_data() else 0
+    except ValueError:
+        return None
+    return H264Params(sps_data[0], sps_data[2], ref, cabac, init_qp, weighted_pred, weighted_bipred, transform_8x8,
+                      chroma_qp_offset)
+
+
+def stream_args(profile: EncoderProfile, parameter_sets: list[bytes]) -> list[str]:
+    """
+    Builds encoder options which make x264 write parameter sets of an existing H.264 stream, so new parts
+    can be joined with it by stream copy: mp4 keeps parameter sets of the first part only, parts with
+    other profile, reference frames or entropy coder are decoded wrongly.
+    Options of the profile (preset, tune) are overridden. Other encoders get no options,
+    parts encoded by them must be checked against the stream.
+    """
+    params = parse_h264_params(parameter_sets) if profile.codec == 'libx264' else None
+    if params is None:
+        return []
+    args = []
+    if params.profile_idc in _H264_PROFILES:
+        args += ['-profile:v', _H264_PROFILES[params.profile_idc]]
+    args += ['-level:v', f'{params.level_idc / 10:g}']
+    # x264 writes the crf as the base qp, new parts get the quality of the stream
+    x264_params = {'crf': params.init_qp, 'ref': params.ref, 'weightp': 2 if params.weighted_pred else 0,
+                   'weightb': int(params.weighted_bipred == 2), 'chroma-qp-offset': params.chroma_qp_offset,
+                   # psy options shift the chroma qp offset written to the PPS
+                   'psy': 0}
+    if params.profile_idc != 66:
+        x264_params.update({'cabac': params.cabac, '8x8dct': params.transform_8x8})
+    if params.weighted_bipred == 2:
+        # weighted bi-prediction is signalled only by streams with B-frames (x264 default number of them)
+        x264_params['bframes'] = 3
+    return args + ['-x264-params', ':'.join(f'{key}={value}' for key, value in x264_params.items())]
+
+
+def threads_per_encode(concurrent_encodes: int, cpu_count: int = None) -> int:
+    """
+    Divides cores between encodes running at the same time, so a parallel batch doesn't oversubscribe the CPU.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    return max(1, cpu_count // max(1, concurrent_encodes))
+
+
+def fit_to_cpu(profile: EncoderProfile, concurrent_encodes: int) -> EncoderProfile:
+    """
+    Sets ffmpeg threads of a profile with automatic threads (0) according to the number of concurrent encodes.
+    """
+    if profile.threads:
+        return profile
+    return profile._replace(threads=threads_per_encode(concurrent_encodes))
+
+
+def video_args(profile: EncoderProfile, fps: int = None, keep_frame_rate: bool = False) -> list[str]:
+    """
+    Builds ffmpeg output options of the video and audio encoders.
+    :param fps: frame rate overriding the one of the profile
+    :param keep_frame_rate: don't change frame rate of the input (i.e. when re-encoding an existing video)
+    """
+    fps = fps or profile.fps
+    args = ['-c:v', profile.codec]
+    if profile.preset:
+        args += ['-preset', profile.preset]
+    if profile.codec in _SOFTWARE_CODECS:
+        if profile.crf is not None:
+            args += ['-crf', str(profile.crf)]
+        if profile.tune:
+            args += ['-tune', profile.tune]
+    args += ['-pix_fmt', 'yuv420p']
+    if not keep_frame_rate:
+        args += ['-r', str(fps), '-g', str(fps * profile.gop_seconds)]
+    if profile.threads:
+        args += ['-threads', str(profile.threads)]
+    return args
+
+
+def audio_args(profile: EncoderProfile) -> list[str]:
+    args = ['-c:a', profile.audio_codec]
+    if profile.audio_bitrate:
+        args += ['-b:a', profile.audio_bitrate]
+    return args
+
+
+def moviepy_params(profile: EncoderProfile, fps: int = None) -> dict:
+    """
+    Converts profile to keyword arguments of moviepy write_videofile.
+    Options that moviepy has no arguments for are passed in ffmpeg_params.
+    """
+    fps = fps or profile.fps
+    ffmpeg_params = ['-g', str(fps * profile.gop_seconds)]
+    if profile.codec in _SOFTWARE_CODECS:
+        if profile.crf is not None:
+            ffmpeg_params += ['-crf', str(profile.crf)]
+        if profile.tune:
+            ffmpeg_params += ['-tune', profile.tune]
+    params = dict(codec=profile.codec, audio_codec=profile.audio_codec, audio_bitrate=profile.audio_bitrate,
+                  fps=fps, threads=profile.threads or None, ffmpeg_params=ffmpeg_params)
+    if profile.preset:
+        params['preset'] = profile.preset
+    return params
@@ -1,37 +1,95 @@
+import json
+import math
+import os
 import subprocess
+from collections import namedtuple
+from typing import Iterator
 
 import numpy as np
-from scipy.io.wavfile import write, read
-from tqdm import tqdm
 
+from .encoder_utils import EncoderProfile, default_encoder_profile, video_args, audio_args
 
-def convert_audiofile(input_path: str, output_path: str):
+
+SilenceConfig = namedtuple('SilenceConfig', ['threshold_db', 'min_duration', 'keep_silence'])
+default_silence_config = SilenceConfig(-35.0, 0.5, 0.5)
+
+AudioInfo = namedtuple('AudioInfo', ['sample_rate', 'channels', 'duration'])
+
+# parameters of a video file that must be equal for stream copy concatenation, audio_* are None without audio
+MediaInfo = namedtuple('MediaInfo', ['codec', 'profile', 'width', 'height', 'pix_fmt', 'frame_rate',
+                                     'audio_codec', 'sample_rate', 'channels', 'duration'])
+# presentation and decoding time of a keyframe, they differ for video with B-frames
+Keyframe = namedtuple('Keyframe', ['pts', 'dts'])
+# part [inpoint, outpoint) of a video file in seconds, None - from the start / to the end,
+# outpoint_dts - decoding time of the keyframe at outpoint, video with B-frames is cut by it
+ConcatSegment = namedtuple('ConcatSegment', ['path', 'inpoint', 'outpoint', 'outpoint_dts'], defaults=[None])
+
+# length of the analysis window used by the in-process silence detector
+FRAME_DURATION = 0.01
+
+
+def probe_audio(path: str) -> AudioInfo:
+    """
+    Reads sample rate, channel count and duration of the first audio stream without decoding it.
+    :param path: path to audiofile
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0',
+               '-show_entries', 'stream=sample_rate,channels:format=duration', '-of', 'json', path]
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    info = json.loads(result.stdout)
+    if not info.get('streams'):
+        raise ValueError(f'No audio stream found in {path}')
+    stream = info['streams'][0]
+    return AudioInfo(int(stream['sample_rate']), int(stream['channels']),
+                     float(info.get('format', {}).get('duration', 0.0)))
+
+
+def decode_audio(path: str) -> tuple[int, np.ndarray]:
+    """
+    Decodes audiofile to 16-bit PCM samples in memory.
+    :param path: path to audiofile
+    :return: tuple of sample rate and samples array with shape (n,) for mono or (n, channels)
     """
-    Convert audiofile from one format to another.
-    Formats will be specified by extension of both paths.
+    info = probe_audio(path)
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-i', path,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', str(info.channels), '-ar', str(info.sample_rate), '-']
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    aud = np.frombuffer(result.stdout, dtype='<i2')
+    if info.channels > 1:
+        aud = aud[:len(aud) - len(aud) % info.channels].reshape(-1, info.channels)
+    return info.sample_rate, aud
+
 
-    :param input_path: path to input audiofile (extension included)
-    :param output_path: path to output audiofile (extension also included)
+def encode_audio(aud: np.ndarray, rate: int, output_path: str):
     """
-    command = ['ffmpeg', '-hide_banner', '-y', '-i', input_path, output_path]
+    Encodes 16-bit PCM samples to audiofile. Format is specified by extension of output path.
+    :param aud: samples array with shape (n,) or (n, channels)
+    :param rate: sample rate
+    :param output_path: path to output audiofile
+    """
+    channels = 1 if aud.ndim == 1 else aud.shape[1]
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y',
+               '-f', 's16le', '-ar', str(rate), '-ac', str(channels), '-i', '-', output_path]
+    samples = np.ascontiguousarray(aud.astype('<i2', copy=False))
     try:
-        subprocess.run(command, check=True)
+        subprocess.run(command, input=memoryview(samples).cast('B'), check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
-        print(e.stdout)
         print(e.stderr)
         raise
 
 
-def detect_silence(path: str, time: float):
+def detect_silence(path: str, time: float, threshold_db: float = -35.0):
     """
     This function is a python wrapper to run the ffmpeg command in python and extract the desired output
 
     path= Audio file path
     time = silence time threshold
+    threshold_db = noise level below which audio is considered silent
 
     returns = list of tuples with start and end point of silences
     """
-    command = "ffmpeg -i " + path + " -af silencedetect=n=-35dB:d=" + str(time) + " -f null -"
+    command = ['ffmpeg', '-i', path, '-af', f'silencedetect=n={threshold_db}dB:d={time}', '-f', 'null', '-']
     out = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdout, stderr = out.communicate()
     s = stdout.decode("utf-8")
@@ -64,60 +122,602 @@ def detect_silence(path: str, time: float):
     return list(zip(start, end))
 
 
-# todo разобраться, почему зависает на секунд 10 во время многопоточного выполнения
-def remove_silence(path: str, sil, keep_sil, out_path: str):
+def _full_scale(dtype) -> float:
+    if np.issubdtype(dtype, np.integer):
+        return float(-np.iinfo(dtype).min) if np.iinfo(dtype).min < 0 else float(np.iinfo(dtype).max + 1) / 2
+    return 1.0
+
+
+def frame_levels_db(aud: np.ndarray, rate: int, frame_duration: float = FRAME_DURATION,
+                    block_frames: int = 65536) -> np.ndarray:
+    """
+    Computes RMS level of every analysis frame in dBFS. For multichannel audio the loudest channel is taken,
+    so a frame is silent only if all channels are silent. The last partial frame is included.
+
+    :param aud: samples array, shape (n,) or (n, channels)
+    :param rate: sample rate
+    :param frame_duration: length of analysis frame in seconds
+    :param block_frames: number of frames converted to float at once (bounds temporary memory)
+    :return: array of levels, one per frame
+    """
+    frame_size = max(1, int(round(frame_duration * rate)))
+    samples = aud.reshape(len(aud), -1)
+    offset = (float(np.iinfo(aud.dtype).max + 1) / 2) if np.issubdtype(aud.dtype, np.unsignedinteger) else 0.0
+    scale = _full_scale(aud.dtype)
+
+    n_frames = -(-len(samples) // frame_size)
+    levels = np.empty(n_frames, dtype=np.float32)
+    block_size = frame_size * block_frames
+    for block_start in range(0, len(samples), block_size):
+        block = (samples[block_start:block_start + block_size].astype(np.float32) - offset) / scale
+        full = len(block) // frame_size * frame_size
+        frames = block[:full].reshape(-1, frame_size, block.shape[1])
+        energy = np.einsum('ijk,ijk->ik', frames, frames).max(axis=1) / frame_size
+        if full < len(block):
+            energy = np.append(energy, np.square(block[full:]).mean(axis=0).max())
+        first = block_start // frame_size
+        levels[first:first + len(energy)] = 10 * np.log10(np.maximum(energy, 1e-20))
+    return levels
+
+
+def silent_runs(silent: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
     """
-    Removes silence from the audio.
+    Finds runs of consecutive True values.
+    :param silent: boolean array
+    :return: tuple of arrays with start (inclusive) and end (exclusive) indexes of every run
+    """
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
 
-    Input:
-    path = Input audio file path
-    sil = List of silence time slots that needs to be removed
-    keep_sil = Time to keep as allowed silence after removing silence
-    out_path = Output path of audio file
 
-    returns:
-    Non - silent patches and save the new audio in out path
+def detect_silence_in_samples(aud: np.ndarray, rate: int, threshold_db: float = -35.0, min_duration: float = 0.5,
+                              frame_duration: float = FRAME_DURATION) -> list[tuple[float, float]]:
     """
-    rate, aud = read(path)
-    if not sil:
-        write(out_path, rate, aud)
-        return None
+    In-process replacement of detect_silence working on already decoded samples.
+
+    :param aud: samples array, shape (n,) or (n, channels)
+    :param rate: sample rate
+    :param threshold_db: level in dBFS below which a frame is considered silent
+    :param min_duration: minimal length of silence in seconds
+    :param frame_duration: length of analysis frame in seconds
+    :return: list of tuples with start and end point of silences in seconds
+    """
+    if not len(aud):
+        return []
+    frame_size = max(1, int(round(frame_duration * rate)))
+    starts, ends = silent_runs(frame_levels_db(aud, rate, frame_duration) < threshold_db)
+    duration = len(aud) / rate
+    return [(float(start * frame_size / rate), float(min(end * frame_size / rate, duration)))
+            for start, end in zip(starts, ends)
+            if min(end * frame_size, len(aud)) - start * frame_size >= min_duration * rate]
+
+
+def iter_audio_blocks(path: str, info: AudioInfo, block_duration: float = 10.0) -> Iterator[np.ndarray]:
+    """
+    Decodes audiofile from an ffmpeg pipe in fixed-size blocks of 16-bit PCM samples.
+    :param path: path to audiofile
+    :param info: audio parameters returned by probe_audio
+    :param block_duration: length of every block in seconds (the last one may be shorter)
+    :return: iterator of sample arrays with shape (n, channels)
+    """
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-i', path,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', str(info.channels), '-ar', str(info.sample_rate), '-']
+    frame_bytes = 2 * info.channels
+    block_bytes = max(1, int(block_duration * info.sample_rate)) * frame_bytes
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % frame_bytes]
+            yield np.frombuffer(data, dtype='<i2').reshape(-1, info.channels)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+class StreamingSilenceCutter:
+    """
+    Removes silence from audio that is fed block by block.
+
+    Silence detection state is carried over block boundaries, so a pause split between two blocks is handled
+    the same way as in detect_silence_in_samples. Only the current silence (at most min_duration of samples) is buffered,
+    memory does not depend on the length of the track.
+    """
+
+    def __init__(self, rate: int, channels: int, silence_config: SilenceConfig = default_silence_config,
+                 frame_duration: float = FRAME_DURATION):
+        self.rate = rate
+        self.silence_config = silence_config
+        self.frame_duration = frame_duration
+        self.frame_size = max(1, int(round(frame_duration * rate)))
+        self.min_frames = max(1, math.ceil(silence_config.min_duration * rate / self.frame_size))
+        self.keep_size = int(round(silence_config.keep_silence / 2 * rate))
+        self._remainder = np.empty((0, channels), dtype=np.int16)
+        self._pending = []
+        self._tail = np.empty((0, channels), dtype=np.int16)
+        self._silent_frames = 0
+        self._long_silence = False
 
+    def feed(self, block: np.ndarray) -> list[np.ndarray]:
+        """
+        :param block: samples array with shape (n, channels)
+        :return: list of sample arrays that should be written to the output
+        """
+        samples = np.concatenate((self._remainder, block)) if len(self._remainder) else block
+        full = len(samples) // self.frame_size * self.frame_size
+        self._remainder = samples[full:]
+        return self._process(samples[:full])
+
+    def finish(self) -> list[np.ndarray]:
+        """
+        Processes the last partial frame and flushes the buffered silence.
+        :return: list of sample arrays that should be written to the output
+        """
+        output = self._process(self._remainder)
+        self._remainder = self._remainder[:0]
+        self._flush_silence(output)
+        return output
+
+    def _process(self, samples: np.ndarray) -> list[np.ndarray]:
+        output = []
+        if not len(samples):
+            return output
+        silent = frame_levels_db(samples, self.rate, self.frame_duration) < self.silence_config.threshold_db
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(silent.astype(np.int8))) + 1, [len(silent)]))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            part = samples[start * self.frame_size:end * self.frame_size]
+            if silent[start]:
+                self._on_silence(part, end - start, output)
+            else:
+                self._flush_silence(output)
+                output.append(part)
+        return output
+
+    def _on_silence(self, part: np.ndarray, frames: int, output: list[np.ndarray]):
+        self._silent_frames += frames
+        if self._long_silence:
+            self._tail = self._keep_last(np.concatenate((self._tail, part)))
+            return
+
+        self._pending.append(part)
+        if self._silent_frames >= self.min_frames:
+            silence = np.concatenate(self._pending)
+            self._pending = []
+            self._long_silence = True
+            output.append(silence[:self.keep_size])
+            self._tail = self._keep_last(silence[self.keep_size:])
+
+    def _keep_last(self, samples: np.ndarray) -> np.ndarray:
+        return samples[len(samples) - min(self.keep_size, len(samples)):]
+
+    def _flush_silence(self, output: list[np.ndarray]):
+        if self._long_silence:
+            output.append(self._tail)
+        else:
+            output.extend(self._pending)
+        self._pending = []
+        self._tail = self._tail[:0]
+        self._silent_frames = 0
+        self._long_silence = False
+
+
+def stream_clean_samples(audio_path: str, info: AudioInfo,
+                         silence_config: SilenceConfig = default_silence_config,
+                         block_duration: float = 10.0) -> Iterator[np.ndarray]:
+    """
+    Removes silence from audiofile with constant memory: audio is decoded from an ffmpeg pipe block by block.
+    :param audio_path: path to audiofile
+    :param info: audio parameters returned by probe_audio
+    :param silence_config: thresholds of silence detection
+    :param block_duration: length of decoded blocks in seconds
+    :return: iterator of kept sample arrays with shape (n, channels)
+    """
+    cutter = StreamingSilenceCutter(info.sample_rate, info.channels, silence_config)
+    for block in iter_audio_blocks(audio_path, info, block_duration):
+        yield from cutter.feed(block)
+    yield from cutter.finish()
+
+
+def stream_clean_audiotrack(audio_path: str, output_path: str,
+                            silence_config: SilenceConfig = default_silence_config,
+                            block_duration: float = 10.0):
+    """
+    Removes silence from audiofile with constant memory, kept samples are piped straight into an encoder process.
+    :param audio_path: path to audiofile
+    :param output_path: path to output audiofile
+    :param silence_config: thresholds of silence detection
+    :param block_duration: length of decoded blocks in seconds
+    """
+    info = probe_audio(audio_path)
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y',
+               '-f', 's16le', '-ar', str(info.sample_rate), '-ac', str(info.channels), '-i', '-', output_path]
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    try:
+        for chunk in stream_clean_samples(audio_path, info, silence_config, block_duration):
+            encoder.stdin.write(chunk.tobytes())
+    finally:
+        encoder.stdin.close()
+        encoder.wait()
+    if encoder.returncode:
+        raise subprocess.CalledProcessError(encoder.returncode, command)
+
+
+def non_silent_intervals(sil, keep_sil, duration: float) -> list[tuple[float, float]]:
+    """
+    Converts silence time slots into the time slots that should be kept.
+
+    :param sil: list of (start, end) silence time slots in seconds
+    :param keep_sil: time to keep as allowed silence after removing silence
+    :param duration: duration of the whole audio in seconds
+    :return: list of (start, end) non-silent time slots in seconds
+    """
     a = float(keep_sil) / 2
     sil_updated = [(i[0] + a, i[1] - a) for i in sil]
 
-    # convert the silence patch to non-sil patches
     non_sil = []
     tmp = 0
-    ed = len(aud) / rate
     for i in range(len(sil_updated)):
         non_sil.append((tmp, sil_updated[i][0]))
         tmp = sil_updated[i][1]
-    if sil_updated[-1][1] + a / 2 < ed:
-        non_sil.append((sil_updated[-1][1], ed))
+    if sil_updated[-1][1] + a / 2 < duration:
+        non_sil.append((sil_updated[-1][1], duration))
     if non_sil[0][0] == non_sil[0][1]:
         del non_sil[0]
-
-    # cut the audio
-    ans = []
-    ad = list(aud)
-    for i in tqdm(non_sil, desc='Remove silence parts...'):
-        ans = ans + ad[int(i[0] * rate):int(i[1] * rate)]
-    write(out_path, rate, np.array(ans))
     return non_sil
 
 
+def speech_segments(non_sil, keep_sil, duration: float, min_length: float = 0.1) -> list[tuple[float, float]]:
+    """
+    Maps kept time slots to speech segments on the timeline of the cleaned audio.
+    Allowed silence left around every cut is excluded, so the segments can be passed to the transcriber
+    to skip non-speech parts without running VAD again.
+
+    :param non_sil: kept time slots returned by non_silent_intervals
+    :param keep_sil: time kept as allowed silence after removing silence
+    :param duration: duration of the original audio in seconds
+    :param min_length: segments shorter than this are dropped
+    :return: list of (start, end) speech segments in seconds of the cleaned audio
+    """
+    a = float(keep_sil) / 2
+    segments = []
+    offset = 0.0
+    for start, end in non_sil:
+        length = max(0.0, end - start)
+        speech_start = offset + (a if start > 0 else 0.0)
+        speech_end = offset + length - (a if end < duration else 0.0)
+        if speech_end - speech_start >= min_length:
+            segments.append((speech_start, speech_end))
+        offset += length
+    return segments
+
+
+def _crossfade(tail: np.ndarray, head: np.ndarray, dtype) -> np.ndarray:
+    """
+    Mixes the end of one segment with the beginning of the next one using a linear ramp.
+    """
+    ramp = np.linspace(0.0, 1.0, len(head), endpoint=False, dtype=np.float32)
+    if head.ndim > 1:
+        ramp = ramp[:, np.newaxis]
+    mixed = tail * (1.0 - ramp) + head * ramp
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        mixed = np.clip(np.rint(mixed), info.min, info.max)
+    return mixed.astype(dtype)
+
+
+def cut_audio(aud: np.ndarray, rate: int, non_sil, crossfade: float = 0.0) -> np.ndarray:
+    """
+    Assembles the given time slots of the audio into a single preallocated buffer.
+    Dtype and channel layout of the input are preserved.
+
+    :param aud: samples array, shape (n,) or (n, channels)
+    :param rate: sample rate
+    :param non_sil: list of (start, end) time slots in seconds to keep
+    :param crossfade: length of crossfade at every cut point in seconds (0 disables crossfades)
+    :return: new samples array
+    """
+    bounds = np.clip(np.rint(np.asarray(non_sil, dtype=np.float64).reshape(-1, 2) * rate).astype(np.int64),
+                     0, len(aud))
+    starts, ends = bounds[:, 0], np.maximum(bounds[:, 1], bounds[:, 0])
+    lengths = ends - starts
+    result = np.empty((int(lengths.sum()),) + aud.shape[1:], dtype=aud.dtype)
+
+    fade = int(crossfade * rate)
+    pos = 0
+    prev_length = 0
+    for start, end, length in zip(starts, ends, lengths):
+        n = min(fade, prev_length, length) if pos else 0
+        if n:
+            result[pos - n:pos] = _crossfade(result[pos - n:pos], aud[start:start + n], aud.dtype)
+        result[pos:pos + length - n] = aud[start + n:end]
+        pos += length - n
+        prev_length = length
+    return result[:pos]
+
+
+def render_still_video(image_path: str, audio_path: str, output_path: str, duration: float = None,
+                       fps: int = None, video_filter: str = None,
+                       audio_samples: np.ndarray = None, sample_rate: int = None,
+                       profile: EncoderProfile = default_encoder_profile):
+    """
+    Encodes a video from a single still image and an audiotrack.
+    The image is looped by ffmpeg at low frame rate, so every frame is not composited and piped separately.
+    :param image_path: path to pre-rendered video frame
+    :param audio_path: path to audiofile, ignored if audio_samples are given
+    :param output_path: path to output video
+    :param duration: max duration of the video. If None the video is as long as the audio
+    :param fps: frame rate of the output video, by default the one of the profile
+    :param video_filter: optional ffmpeg video filter applied during the encode (i.e. subtitles)
+    :param audio_samples: 16-bit PCM samples with shape (n,) or (n, channels) piped to ffmpeg instead of audiofile
+    :param sample_rate: sample rate of audio_samples
+    :param profile: encoder settings
+    """
+    fps = fps or profile.fps
+    if audio_samples is not None:
+        channels = 1 if audio_samples.ndim == 1 else audio_samples.shape[1]
+        audio_input = ['-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels), '-i', '-']
+        samples = memoryview(np.ascontiguousarray(audio_samples.astype('<i2', copy=False))).cast('B')
+        audio_duration = len(audio_samples) / sample_rate
+    else:
+        audio_input = ['-i', audio_path]
+        samples = None
+        audio_duration = probe_audio(audio_path).duration
+    # -shortest alone lets the frames buffered by the encoder lookahead through, at low frame rate
+    # that makes the video several seconds longer than the audio
+    duration = min(duration, audio_duration) if duration else audio_duration
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y',
+               '-loop', '1', '-framerate', str(fps), '-i', image_path,
+               *audio_input,
+               '-map', '0:v', '-map', '1:a',
+               *video_args(profile, fps), *audio_args(profile), '-shortest']
+    if video_filter:
+        command += ['-vf', video_filter]
+    if duration:
+        command += ['-t', str(duration)]
+    command.append(output_path)
+    try:
+        subprocess.run(command, input=samples, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr)
+        raise
+
+
 def to_unix_path(path: str) -> str:
     unix_path = path.replace('\\', '/')
     return unix_path
 
 
-# add font
-def burn_subtitles_into_video(video_path: str, subtitles_path: str, output_path: str):
-    command = f'ffmpeg -y -i {video_path} -vf \"subtitles=\'{to_unix_path(subtitles_path)}\':force_style=\'Alignment=2,MarginV=50\'" -c:a copy {output_path}'
+def subtitles_filter(subtitles_path: str, fonts_dir: str = None) -> str:
+    """
+    Builds ffmpeg video filter which draws subtitles from the given file.
+    ASS subtitles are drawn with their own styles, other formats get a default style.
+    :param fonts_dir: folder with fonts used by ASS styles
+    """
+    if subtitles_path.endswith('.ass'):
+        fonts = f":fontsdir='{to_unix_path(fonts_dir)}'" if fonts_dir else ''
+        return f"subtitles='{to_unix_path(subtitles_path)}'{fonts}"
+    return f"subtitles='{to_unix_path(subtitles_path)}':force_style='Alignment=2,MarginV=50'"
+
+
+def probe_media(path: str) -> MediaInfo:
+    """
+    Reads parameters of the first video and audio streams of a video file without decoding it.
+    """
+    command = ['ffprobe', '-v', 'error',
+               '-show_entries', 'stream=codec_type,codec_name,profile,width,height,pix_fmt,r_frame_rate,'
+                                'sample_rate,channels:format=duration', '-of', 'json', path]
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    info = json.loads(result.stdout)
+    streams = info.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise ValueError(f'No video stream found in {path}')
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+    return MediaInfo(video['codec_name'], video.get('profile'), int(video['width']), int(video['height']),
+                     video.get('pix_fmt'), video.get('r_frame_rate'), audio.get('codec_name'),
+                     int(audio['sample_rate']) if audio else None, int(audio['channels']) if audio else None,
+                     float(info.get('format', {}).get('duration', 0.0)))
+
+
+# nal unit types of parameter sets: SPS and PPS of H.264, VPS, SPS and PPS of HEVC
+_PARAMETER_SET_TYPES = {'h264': (7, 8), 'hevc': (32, 33, 34)}
+
+
+def split_nal_units(stream: bytes) -> list[bytes]:
+    """
+    Splits an Annex B stream into NAL units without start codes.
+    """
+    return [nal.rstrip(b'\x00') for nal in stream.split(b'\x00\x00\x01') if nal.rstrip(b'\x00')]
+
+
+def nal_type(nal: bytes, codec: str) -> int:
+    return (nal[0] >> 1) & 0x3f if codec == 'hevc' else nal[0] & 0x1f
+
+
+def parameter_sets(path: str, codec: str) -> list[bytes]:
+    """
+    Reads parameter sets of the first video stream from its first packet. Mp4 stores them once per file,
+    so a file joined by stream copy is decoded with the parameter sets of its first part.
+    :param codec: codec of the stream (h264, hevc), other codecs have no parameter sets to read
+    :return: NAL units of the parameter sets without start codes, in the order of the stream
+    """
+    if codec not in _PARAMETER_SET_TYPES:
+        return []
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-i', path, '-map', '0:v:0', '-c', 'copy',
+               '-bsf:v', f'{codec}_mp4toannexb', '-frames:v', '1', '-f', codec, '-']
+    try:
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr)
+        raise
+    found = []
+    for nal in split_nal_units(result.stdout):
+        # headers repeated before a keyframe are read once
+        if nal_type(nal, codec) in _PARAMETER_SET_TYPES[codec] and nal not in found:
+            found.append(nal)
+    return found
+
+
+def keyframes(path: str, start: float = None, end: float = None) -> list[Keyframe]:
+    """
+    Reads timestamps of keyframes of the first video stream from the packet index, nothing is decoded.
+    :param start: read packets from this time, None - from the start
+    :param end: read packets up to this time, None - to the end
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,dts_time,flags', '-of', 'json']
+    if start is not None or end is not None:
+        command += ['-read_intervals', f"{'' if start is None else start}%{'' if end is None else end}"]
+    command.append(path)
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    packets = json.loads(result.stdout).get('packets', [])
+    return sorted(Keyframe(float(packet['pts_time']), float(packet.get('dts_time', packet['pts_time'])))
+                  for packet in packets if 'K' in packet.get('flags', '') and 'pts_time' in packet)
+
+
+def copy_segment(segment: ConcatSegment, output_path: str):
+    """
+    Cuts part of a video file without re-encoding. The inpoint and the outpoint must be keyframes.
+    Audio and video are read as separate inputs and cut at their own timestamps: stream copy cuts video
+    by decoding time, audio must not lose the reordering delay of B-frames.
+    """
+    seek = ['-ss', str(segment.inpoint)] if segment.inpoint else []
+    video_limit = audio_limit = []
+    if segment.outpoint is not None:
+        outpoint_dts = segment.outpoint if segment.outpoint_dts is None else segment.outpoint_dts
+        video_limit = ['-t', str(outpoint_dts - (segment.inpoint or 0))]
+        audio_limit = ['-t', str(segment.outpoint - (segment.inpoint or 0))]
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y',
+               *seek, *video_limit, '-i', segment.path, *seek, *audio_limit, '-i', segment.path,
+               # packets preceding the inpoint are dropped, they belong to the previous part
+               '-map', '0:v:0', '-map', '1:a:0?', '-c', 'copy', '-copypriorss:a', '0', output_path]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr)
+        raise
+
+
+def concat_files(video_paths: list[str], output_path: str, list_path: str):
+    """
+    Joins video files with the concat demuxer and stream copy: packets are only remuxed.
+    Files must have equal codecs and stream parameters.
+    :param list_path: where to write the concat list
+    """
+    lines = ['ffconcat version 1.0']
+    for path in video_paths:
+        escaped = to_unix_path(os.path.abspath(path)).replace("'", "'\\''")
+        lines.append(f"file '{escaped}'")
+    with open(list_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', list_path,
+               '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-movflags', '+faststart', output_path]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr)
+        raise
+
+
+def render_crossfades(segments: list[ConcatSegment], output_path: str, crossfade: float, info: MediaInfo,
+                      profile: EncoderProfile = default_encoder_profile, encoder_args: list[str] = None):
+    """
+    Encodes parts of video files joined with crossfades of video and audio.
+    Output has stream parameters of info, so it can be concatenated with the sources without re-encoding.
+    :param segments: parts of files, every part is longer than the crossfades at its ends
+    :param crossfade: duration of every crossfade in seconds
+    :param info: parameters of the sources
+    :param encoder_args: options added to the ones of the profile (i.e. matching parameter sets of the sources)
+    """
+    inputs, video_chain, audio_chain = [], [], []
+    video_label, audio_label = '[0:v]', '[0:a]'
+    length = 0.0
+    for i, segment in enumerate(segments):
+        if segment.inpoint:
+            inputs += ['-ss', str(segment.inpoint)]
+        if segment.outpoint is not None:
+            inputs += ['-to', str(segment.outpoint)]
+        inputs += ['-i', segment.path]
+        if i == 0:
+            length = segment.outpoint - (segment.inpoint or 0)
+            continue
+        # xfade starts the transition crossfade seconds before the end of everything joined so far
+        video_chain.append(f'{video_label}[{i}:v]xfade=transition=fade:duration={crossfade}:'
+                           f'offset={length - crossfade:.6f}[v{i}]')
+        video_label = f'[v{i}]'
+        length += segment.outpoint - (segment.inpoint or 0) - crossfade
+        if info.audio_codec:
+            audio_chain.append(f'{audio_label}[{i}:a]acrossfade=d={crossfade}[a{i}]')
+            audio_label = f'[a{i}]'
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y', *inputs,
+               '-filter_complex', ';'.join(video_chain + audio_chain),
+               '-map', video_label, *video_args(profile, keep_frame_rate=True), *(encoder_args or [])]
+    if info.audio_codec:
+        command += ['-map', audio_label, *audio_args(profile), '-ar', str(info.sample_rate),
+                    '-ac', str(info.channels)]
+    command.append(output_path)
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr)
+        raise
+
+
+def conform_video(video_path: str, output_path: str, info: MediaInfo,
+                  profile: EncoderProfile = default_encoder_profile, encoder_args: list[str] = None):
+    """
+    Re-encodes a video (i.e. an intro or an outro clip) to the stream parameters of info, so it can be
+    concatenated with videos having these parameters without re-encoding them.
+    The picture is scaled to fit and padded, silence is added if the video has no audio.
+    :param encoder_args: options added to the ones of the profile (i.e. matching parameter sets of the sources)
+    """
+    source = probe_media(video_path)
+    video_filter = (f'scale={info.width}:{info.height}:force_original_aspect_ratio=decrease,'
+                    f'pad={info.width}:{info.height}:(ow-iw)/2:(oh-ih)/2,setsar=1,'
+                    f'fps={info.frame_rate},format={info.pix_fmt}')
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y', '-i', video_path]
+    if info.audio_codec and not source.audio_codec:
+        layout = 'mono' if info.channels == 1 else 'stereo'
+        command += ['-f', 'lavfi', '-i', f'anullsrc=r={info.sample_rate}:cl={layout}', '-shortest']
+    command += ['-map', '0:v:0', '-vf', video_filter, *video_args(profile, keep_frame_rate=True),
+                *(encoder_args or [])]
+    if info.audio_codec:
+        command += ['-map', '0:a:0' if source.audio_codec else '1:a:0', *audio_args(profile),
+                    '-ar', str(info.sample_rate), '-ac', str(info.channels)]
+    else:
+        command += ['-an']
+    command.append(output_path)
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr)
+        raise
+
 
+def encode_files(video_paths: list[str], output_path: str, info: MediaInfo,
+                 profile: EncoderProfile = default_encoder_profile, encoder_args: list[str] = None):
+    """
+    Joins video files with the concat filter and encodes the result, for files which can't be joined
+    by stream copy. Files must have equal stream parameters (info).
+    """
+    inputs, labels = [], []
+    for i, path in enumerate(video_paths):
+        inputs += ['-i', path]
+        labels.append(f'[{i}:v:0][{i}:a:0]' if info.audio_codec else f'[{i}:v:0]')
+    audio = 1 if info.audio_codec else 0
+    outputs = '[v][a]' if audio else '[v]'
+    command = ['ffmpeg', '-hide_banner', '-v', 'error', '-y', *inputs,
+               '-filter_complex', f"{''.join(labels)}concat=n={len(video_paths)}:v=1:a={audio}{outputs}",
+               '-map', '[v]', *video_args(profile, keep_frame_rate=True), *(encoder_args or [])]
+    if audio:
+        command += ['-map', '[a]', *audio_args(profile)]
+    command += ['-movflags', '+faststart', output_path]
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        print(result.stdout)
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
-        print(f"Error: {e.stderr}")
+        print(e.stderr)
+        raise
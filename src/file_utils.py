@@ -1,5 +1,9 @@
+import glob
 import os
 import re
+from contextlib import contextmanager
+
+PARTIAL_MARK = '.partial'
 
 
 def remove_files(files_for_remove: list[str]):
@@ -11,23 +15,66 @@ def remove_files(files_for_remove: list[str]):
         os.remove(file_path)
 
 
-def fix_filenames(folder: str):
+def sanitize_filename(name: str) -> str:
+    """
+    Replaces spaces with underscores and removes special characters from a filename without extension.
+    """
+    return re.sub(r'[^\w\s]', '', name.replace(' ', '_'))
+
+
+def unique_output_names(paths: list[str], extension: str) -> dict[str, str]:
+    """
+    Builds sanitized output filenames for input files, sources are not renamed.
+    Inputs whose names are equal after sanitizing get numbered suffixes, inputs with already clean names
+    keep them, so outputs are named as they were when the sources themselves were renamed.
+    :return: input path -> output filename
+    """
+    names = {}
+    used = set()
+    stems = {path: os.path.splitext(os.path.basename(path))[0] for path in paths}
+    for path in sorted(paths, key=lambda path: sanitize_filename(stems[path]) != stems[path]):
+        base = sanitize_filename(stems[path]) or 'video'
+        name, number = base, 1
+        while name.lower() in used:
+            number += 1
+            name = f'{base}_{number}'
+        used.add(name.lower())
+        names[path] = name + extension
+    return {path: names[path] for path in paths}
+
+
+def partial_path(path: str, tag: str = None) -> str:
     """
-    Fixes filenames in the specified folder by replacing spaces with underscores
-    and removing special characters except dots in file extensions.
+    Temporary name of a file being written: hidden file in the same folder with the same extension.
+    :param tag: distinguishes writers of the same file (workers of a sharded batch)
     """
-    if not folder.endswith('/'):
-        folder = folder + '/'
+    folder, name = os.path.split(path)
+    root, extension = os.path.splitext(name)
+    if tag:
+        root = f'{root}.{sanitize_filename(tag)}'
+    return os.path.join(folder, f'.{root}{PARTIAL_MARK}{extension}')
 
-    for filename in os.listdir(folder):
-        name, extension = os.path.splitext(filename)
-        fixed_name = name.replace(' ', '_')
-        fixed_name = re.sub(r'[^\w\s]', '', fixed_name)
-        fixed_filename = fixed_name + extension
-        os.rename(os.path.join(folder, filename), os.path.join(folder, fixed_filename))
 
+@contextmanager
+def atomic_output(path: str, tag: str = None):
+    """
+    Yields temporary path to write the file to. The file is renamed to path only if the block succeeds,
+    so a crash or an error never leaves a half-written file under the final name.
+    """
+    tmp_path = partial_path(path, tag)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-def find_first_mp3_file(files: list[str]):
-    for file in files:
-        if file.endswith('.mp3'):
-            return file
+
+def remove_partial_files(folder: str) -> list[str]:
+    """
+    Deletes files left by writes interrupted by a crash.
+    :return: list of deleted paths
+    """
+    paths = glob.glob(os.path.join(glob.escape(folder), f'.*{PARTIAL_MARK}.*'))
+    remove_files(paths)
+    return paths
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+from typing import Literal
+
+from PIL import Image, ImageDraw, ImageFont
+
+VideoType = Literal['plain', 'short']
+
+VIDEO_SIZES = {'plain': (1920, 1080), 'short': (1080, 1920)}
+
+CAPTION_WIDTH = 900
+CAPTION_FONT_SIZE = 60
+
+# composed frames are shared between threads and processes through this folder
+LAYERS_DIR = os.path.join(tempfile.gettempdir(), 'montajer-layers')
+
+
+def render_background(video_type: VideoType, image_path: str) -> Image.Image:
+    """
+    Resizes background image to the height of the video and centers it on a black canvas.
+    Resized backgrounds are memoized, the same image is decoded and resized once per process.
+    :param video_type: type of video, determines resolution
+    :param image_path: path to background image
+    :return: RGB image with size of the video
+    """
+    return _render_background(video_type, os.path.abspath(image_path), os.stat(image_path).st_mtime_ns).copy()
+
+
+@lru_cache(maxsize=32)
+def _render_background(video_type: VideoType, image_path: str, mtime_ns: int) -> Image.Image:
+    if video_type not in VIDEO_SIZES:
+        raise ValueError(f"Invalid video_type. Expected values: {list(VIDEO_SIZES)}")
+    size = VIDEO_SIZES[video_type]
+
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        width = round(image.width * size[1] / image.height)
+        image = image.resize((width, size[1]), Image.LANCZOS)
+
+    canvas = Image.new('RGB', size, (0, 0, 0))
+    canvas.paste(image, ((size[0] - width) // 2, 0))
+    return canvas
+
+
+@lru_cache(maxsize=None)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_path, font_size)
+
+
+def _wrap_text(text: str, font: ImageFont.FreeTypeFont, width: int) -> list[str]:
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            candidate = f'{line} {word}' if line else word
+            if line and font.getlength(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def render_caption(text: str, font_path: str, width: int = CAPTION_WIDTH, font_size: int = CAPTION_FONT_SIZE,
+                   color: str = 'white') -> Image.Image:
+    """
+    Rasterizes caption text with Pillow. Lines are wrapped to the given width and centered.
+    Rendered captions are memoized.
+    :param text: caption text
+    :param font_path: path to ttf font
+    :param width: width of the caption block
+    :param font_size: font size in pixels
+    :param color: text color
+    :return: RGBA image with transparent background
+    """
+    return _render_caption(text, font_path, width, font_size, color).copy()
+
+
+@lru_cache(maxsize=32)
+def _render_caption(text: str, font_path: str, width: int, font_size: int, color: str) -> Image.Image:
+    font = load_font(font_path, font_size)
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent
+    lines = _wrap_text(text, font, width)
+
+    caption = Image.new('RGBA', (width, line_height * len(lines)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(caption)
+    for i, line in enumerate(lines):
+        draw.text(((width - font.getlength(line)) / 2, i * line_height), line, font=font, fill=color)
+    return caption
+
+
+def render_frame(video_type: VideoType, image_path: str, text: str, font_path: str,
+                 padding_top: int = 75) -> Image.Image:
+    """
+    Composes background image and caption into a single video frame.
+    :param video_type: type of video, determines resolution
+    :param image_path: path to background image
+    :param text: caption text on top of the frame
+    :param font_path: path to ttf font
+    :param padding_top: distance between top of the frame and caption
+    :return: RGB image with size of the video
+    """
+    frame = render_background(video_type, image_path)
+    caption = render_caption(text, font_path)
+    frame.paste(caption, ((frame.width - caption.width) // 2, padding_top), caption)
+    return frame
+
+
+def frame_layer_path(video_type: VideoType, image_path: str, text: str, font_path: str,
+                     padding_top: int = 75, layers_dir: str = LAYERS_DIR) -> str:
+    """
+    Returns path to PNG with background and caption composed into a single frame, rendering it only
+    if the same frame was not rendered before. The file is shared by all workers and can be used
+    by any render backend.
+    :param video_type: type of video, determines resolution
+    :param image_path: path to background image
+    :param text: caption text on top of the frame
+    :param font_path: path to ttf font
+    :param padding_top: distance between top of the frame and caption
+    :param layers_dir: folder with rendered frames
+    :return: path to PNG file
+    """
+    stat = os.stat(image_path)
+    key = json.dumps([os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns, video_type, text,
+                      os.path.abspath(font_path), CAPTION_WIDTH, CAPTION_FONT_SIZE, padding_top])
+    path = os.path.join(layers_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.png')
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(layers_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=layers_dir)
+    os.close(fd)
+    try:
+        render_frame(video_type, image_path, text, font_path, padding_top).save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
@@ -0,0 +1,279 @@
+import os
+import sqlite3
+import threading
+import time
+from enum import Enum
+
+# manifest of a batch is kept in its output folder
+MANIFEST_NAME = 'montajer-manifest.db'
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    name TEXT PRIMARY KEY,
+    audio_path TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    wall_time REAL,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, stage)
+);
+"""
+
+# columns added after the first version of the manifest, added to old manifests on open
+_ITEM_COLUMNS = {'priority': 'REAL NOT NULL DEFAULT 0', 'worker': 'TEXT', 'heartbeat': 'REAL'}
+
+
+class ItemState(str, Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class BatchManifest:
+    """
+    SQLite journal of a batch: state of every input and of every stage of it.
+
+    Every state change is committed immediately, so after a crash the manifest tells which inputs
+    are finished, which failed (and how many times) and which were interrupted. Every thread and
+    process opens its own connection, the manifest can be passed to workers of a process pool.
+
+    A shared manifest is also a work table of a sharded batch: workers on several hosts claim inputs,
+    send heartbeats while they process them and take over inputs of workers which stopped sending them.
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        """
+        :param path: path to the database
+        :param shared: the manifest is used by processes on several hosts through a shared folder.
+            WAL needs memory shared by all processes, so a rollback journal is used instead
+        """
+        self.path = path
+        self.shared = shared
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+            columns = {row['name'] for row in connection.execute('PRAGMA table_info(items)')}
+            for column, definition in _ITEM_COLUMNS.items():
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE items ADD COLUMN {column} {definition}')
+
+    def __getstate__(self):
+        return {'path': self.path, 'shared': self.shared}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.shared = state.get('shared', False)
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.row_factory = sqlite3.Row
+            connection.execute(f"PRAGMA journal_mode={'DELETE' if self.shared else 'WAL'}")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        connection = self._connect()
+        with connection:
+            return connection.execute(sql, params).fetchall()
+
+    def reset(self):
+        """
+        Forgets all items (a new batch is started in the same output folder).
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute('DELETE FROM stages')
+            connection.execute('DELETE FROM items')
+
+    def register(self, name: str, audio_path: str, output_path: str, priority: float = 0):
+        """
+        Adds input to the manifest, state of an already known input is kept.
+        :param priority: inputs with higher priority are claimed first (duration of the audio)
+        """
+        self._execute('INSERT INTO items (name, audio_path, output_path, state, updated, priority) '
+                      'VALUES (?, ?, ?, ?, ?, ?) '
+                      'ON CONFLICT(name) DO UPDATE SET audio_path = excluded.audio_path, '
+                      'output_path = excluded.output_path, priority = excluded.priority',
+                      (name, audio_path, output_path, ItemState.PENDING.value, time.time(), priority))
+
+    def item(self, name: str) -> dict | None:
+        rows = self._execute('SELECT * FROM items WHERE name = ?', (name,))
+        return dict(rows[0]) if rows else None
+
+    def items(self) -> list[dict]:
+        return [dict(row) for row in self._execute('SELECT * FROM items ORDER BY name')]
+
+    def stages(self, name: str) -> list[dict]:
+        return [dict(row) for row in self._execute('SELECT * FROM stages WHERE name = ? ORDER BY updated', (name,))]
+
+    def should_run(self, name: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> bool:
+        """
+        Decides whether input should be processed when a batch is resumed: finished inputs whose output
+        still exists are skipped, failed ones are retried until they used max_attempts.
+        Interrupted inputs (left running by a crash) are always processed again.
+        """
+        item = self.item(name)
+        if item is None:
+            return True
+        if item['state'] == ItemState.DONE:
+            return not os.path.exists(item['output_path'])
+        if item['state'] == ItemState.FAILED:
+            return item['attempts'] < max_attempts
+        return True
+
+    def start(self, name: str):
+        """
+        Marks input as scheduled for processing, every call is counted as an attempt.
+        """
+        self._execute('UPDATE items SET state = ?, stage = NULL, error = NULL, attempts = attempts + 1, updated = ? '
+                      'WHERE name = ?', (ItemState.PENDING.value, time.time(), name))
+
+    def stage_started(self, name: str, stage: str, worker: str = None):
+        """
+        :param worker: worker of a sharded batch, the input is updated only while the worker owns it
+        """
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.execute('UPDATE items SET state = ?, stage = ?, updated = ? WHERE name = ? '
+                               'AND (? IS NULL OR worker = ?)',
+                               (ItemState.RUNNING.value, stage, now, name, worker, worker))
+            connection.execute('INSERT OR REPLACE INTO stages (name, stage, state, updated) VALUES (?, ?, ?, ?)',
+                               (name, stage, ItemState.RUNNING.value, now))
+
+    def stage_done(self, name: str, stage: str, wall_time: float = None, last: bool = False, worker: str = None):
+        """
+        :param last: the stage was the last one, the input is finished
+        """
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.execute('UPDATE stages SET state = ?, wall_time = ?, updated = ? WHERE name = ? AND stage = ?',
+                               (ItemState.DONE.value, wall_time, now, name, stage))
+            if last:
+                connection.execute('UPDATE items SET state = ?, updated = ? WHERE name = ? '
+                                   'AND (? IS NULL OR worker = ?)',
+                                   (ItemState.DONE.value, now, name, worker, worker))
+
+    def stage_failed(self, name: str, stage: str, error: str, worker: str = None):
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.execute('UPDATE stages SET state = ?, error = ?, updated = ? WHERE name = ? AND stage = ?',
+                               (ItemState.FAILED.value, error, now, name, stage))
+            connection.execute('UPDATE items SET state = ?, error = ?, updated = ? WHERE name = ? '
+                               'AND (? IS NULL OR worker = ?)',
+                               (ItemState.FAILED.value, error, now, name, worker, worker))
+
+    def claim(self, worker: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS, stale_after: float = 60) -> dict | None:
+        """
+        Takes the next input of a sharded batch: a pending one with the highest priority, a running one
+        whose worker stopped sending heartbeats or a failed one which has attempts left.
+        Inputs of lost workers which used all attempts are marked as failed.
+        :param worker: id of the claiming worker
+        :param stale_after: seconds without a heartbeat after which a worker is considered dead
+        :return: claimed input or None if there is nothing to do now
+        """
+        now = time.time()
+        stale = now - stale_after
+        connection = self._connect()
+        with connection:
+            # the write lock is taken before the select, so two workers never claim the same input
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute("UPDATE items SET state = ?, error = 'worker lost', updated = ? "
+                               'WHERE state = ? AND (heartbeat IS NULL OR heartbeat < ?) AND attempts >= ?',
+                               (ItemState.FAILED.value, now, ItemState.RUNNING.value, stale, max_attempts))
+            rows = connection.execute('SELECT name FROM items WHERE state = ? '
+                                      'OR (state = ? AND (heartbeat IS NULL OR heartbeat < ?)) '
+                                      'OR (state = ? AND attempts < ?) '
+                                      'ORDER BY state = ?, priority DESC LIMIT 1',
+                                      (ItemState.PENDING.value, ItemState.RUNNING.value, stale,
+                                       ItemState.FAILED.value, max_attempts, ItemState.FAILED.value)).fetchall()
+            if not rows:
+                return None
+            name = rows[0]['name']
+            connection.execute('UPDATE items SET state = ?, stage = NULL, error = NULL, attempts = attempts + 1, '
+                               'worker = ?, heartbeat = ?, updated = ? WHERE name = ?',
+                               (ItemState.RUNNING.value, worker, now, now, name))
+            return dict(connection.execute('SELECT * FROM items WHERE name = ?', (name,)).fetchone())
+
+    def release(self, name: str, worker: str) -> bool:
+        """
+        Returns input claimed by the worker to the queue, the attempt is not counted (the batch was cancelled).
+        :return: False if the input was taken over by another worker
+        """
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute('UPDATE items SET state = ?, stage = NULL, attempts = MAX(attempts - 1, 0), '
+                                        'worker = NULL, heartbeat = NULL, updated = ? '
+                                        'WHERE name = ? AND worker = ? AND state = ?',
+                                        (ItemState.PENDING.value, time.time(), name, worker,
+                                         ItemState.RUNNING.value))
+            return cursor.rowcount == 1
+
+    def heartbeat(self, name: str, worker: str) -> bool:
+        """
+        Tells other workers that the input is still being processed.
+        :return: False if the input was taken over by another worker
+        """
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute('UPDATE items SET heartbeat = ? WHERE name = ? AND worker = ? AND state = ?',
+                                        (time.time(), name, worker, ItemState.RUNNING.value))
+            return cursor.rowcount == 1
+
+    def active(self, stale_after: float = 60) -> int:
+        """
+        :return: number of inputs being processed by live workers
+        """
+        rows = self._execute('SELECT COUNT(*) AS count FROM items WHERE state = ? AND heartbeat >= ?',
+                             (ItemState.RUNNING.value, time.time() - stale_after))
+        return rows[0]['count']
+
+    def progress(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> dict:
+        """
+        :return: states - state -> (number of inputs, their total priority), retryable - failed inputs
+            with attempts left, workers - worker -> number of inputs it finished
+        """
+        states = {row['state']: (row['count'], row['priority'] or 0.0)
+                  for row in self._execute('SELECT state, COUNT(*) AS count, SUM(priority) AS priority '
+                                           'FROM items GROUP BY state')}
+        retryable = self._execute('SELECT COUNT(*) AS count FROM items WHERE state = ? AND attempts < ?',
+                                  (ItemState.FAILED.value, max_attempts))[0]['count']
+        workers = {row['worker']: row['count']
+                   for row in self._execute('SELECT worker, COUNT(*) AS count FROM items '
+                                            'WHERE state = ? AND worker IS NOT NULL GROUP BY worker',
+                                            (ItemState.DONE.value,))}
+        return {'states': states, 'retryable': retryable, 'workers': workers}
+
+    def summary(self) -> dict[str, int]:
+        """
+        :return: state -> number of inputs in it
+        """
+        return {row['state']: row['count']
+                for row in self._execute('SELECT state, COUNT(*) AS count FROM items GROUP BY state')}
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -0,0 +1,164 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# report_path - JSON-lines file with one record per stage span, profile_dir - folder for cProfile dumps (or None)
+MetricsConfig = namedtuple('MetricsConfig', ['report_path', 'profile_dir'])
+
+# metrics settings of the current batch, every job of the render service has its own.
+# Threads of a batch are started in a copy of the batch context, so they see the settings of their batch
+_config: ContextVar[MetricsConfig | None] = ContextVar('metrics_config', default=None)
+_write_lock = threading.Lock()
+# only one cProfile profiler can be active in a process (python 3.12+ raises ValueError for a second one)
+_profile_lock = threading.Lock()
+
+
+def configure_metrics(config: MetricsConfig, reset: bool = False):
+    """
+    Enables stage spans in the current context (the batch and threads it starts). Workers of a process pool
+    call it from their initializer, all of them append to the same report.
+    :param config: where to write report and profiles, None disables metrics
+    :param reset: truncate existing report (done once by the main process at the start of a batch)
+    """
+    _config.set(config)
+    if not config:
+        return
+    if reset:
+        os.makedirs(os.path.dirname(os.path.abspath(config.report_path)), exist_ok=True)
+        open(config.report_path, 'w').close()
+    if config.profile_dir:
+        os.makedirs(config.profile_dir, exist_ok=True)
+
+
+def _read_io() -> dict[str, int]:
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read_bytes': int(values['read_bytes']), 'write_bytes': int(values['write_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def _children_cpu() -> float:
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_mb(who) -> float | None:
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def _start_profiler() -> cProfile.Profile | None:
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # another profiler is active (i.e. the whole program runs under cProfile)
+        _profile_lock.release()
+        return None
+    return profiler
+
+
+@contextmanager
+def span(stage: str, file: str, profile: bool = False):
+    """
+    Measures a stage of processing of one input file: wall time, cpu time of the calling thread,
+    cpu time of finished subprocesses (ffmpeg), peak rss and bytes read/written by the process.
+    Process-wide counters include concurrent jobs of the same process.
+    Does nothing unless configure_metrics was called in the current context.
+    :param stage: stage name
+    :param file: input file the stage works on
+    :param profile: capture cProfile output of the stage if profiling is enabled (for Python-side stages).
+        A stage which starts while another stage of the process is being profiled is measured, but not profiled
+    """
+    config = _config.get()
+    if not config:
+        yield
+        return
+
+    profiler = _start_profiler() if profile and config.profile_dir else None
+    io_before = _read_io()
+    children_cpu = _children_cpu()
+    cpu = time.thread_time()
+    start = time.time()
+    wall = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            _profile_lock.release()
+        io_after = _read_io()
+        record = {
+            'file': file,
+            'stage': stage,
+            'pid': os.getpid(),
+            'start': start,
+            'wall_time': time.perf_counter() - wall,
+            'cpu_time': time.thread_time() - cpu,
+            'subprocess_cpu_time': _children_cpu() - children_cpu,
+            'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            'subprocess_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+            'read_bytes': io_after.get('read_bytes', 0) - io_before.get('read_bytes', 0),
+            'write_bytes': io_after.get('write_bytes', 0) - io_before.get('write_bytes', 0),
+            'error': error,
+            'profiled': profiler is not None,
+        }
+        if profiler:
+            name = f'{os.path.splitext(os.path.basename(file))[0]}_{stage}_{os.getpid()}.prof'
+            profiler.dump_stats(os.path.join(config.profile_dir, name))
+        with _write_lock, open(config.report_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def read_metrics(report_path: str) -> list[dict]:
+    with open(report_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_metrics(report_path: str) -> str:
+    """
+    Builds a table with totals of every stage over all files of the report.
+    """
+    stages = {}
+    for record in read_metrics(report_path):
+        stats = stages.setdefault(record['stage'], {'count': 0, 'errors': 0, 'wall_time': 0.0, 'max_wall_time': 0.0,
+                                                     'cpu_time': 0.0, 'subprocess_cpu_time': 0.0,
+                                                     'peak_rss_mb': 0.0, 'read_bytes': 0, 'write_bytes': 0})
+        stats['count'] += 1
+        stats['errors'] += bool(record['error'])
+        stats['max_wall_time'] = max(stats['max_wall_time'], record['wall_time'])
+        stats['peak_rss_mb'] = max(stats['peak_rss_mb'], record['peak_rss_mb'] or 0.0)
+        for key in ('wall_time', 'cpu_time', 'subprocess_cpu_time', 'read_bytes', 'write_bytes'):
+            stats[key] += record[key]
+
+    header = f"{'этап':<16}{'файлов':>8}{'ошибок':>8}{'wall, с':>10}{'max, с':>9}{'cpu, с':>9}" \
+             f"{'ffmpeg cpu, с':>15}{'rss, МБ':>10}{'чтение, МБ':>12}{'запись, МБ':>12}"
+    lines = [header, '-' * len(header)]
+    for stage, stats in stages.items():
+        lines.append(f"{stage:<16}{stats['count']:>8}{stats['errors']:>8}{stats['wall_time']:>10.2f}"
+                     f"{stats['max_wall_time']:>9.2f}{stats['cpu_time']:>9.2f}{stats['subprocess_cpu_time']:>15.2f}"
+                     f"{stats['peak_rss_mb']:>10.0f}{stats['read_bytes'] / 2 ** 20:>12.1f}"
+                     f"{stats['write_bytes'] / 2 ** 20:>12.1f}")
+    return '\n'.join(lines)
@@ -1,102 +1,355 @@
-import glob
+import math
 import os
 import random
-from concurrent.futures import ThreadPoolExecutor
-from typing import Tuple, Literal
-
-from moviepy.editor import ImageClip, AudioFileClip, CompositeVideoClip, TextClip
-
-from .ffmpeg_utils import convert_audiofile, detect_silence, remove_silence, burn_subtitles_into_video
-from .file_utils import fix_filenames, remove_files, find_first_mp3_file
-from .subtitles_utils import write_subtitle_file, SubtitleFormat, SubtitlesConfig
-
-
-def clean_audiotrack(audio_path: str, output_path: str):
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from functools import partial
+from typing import Callable
+
+import numpy as np
+from moviepy.audio.AudioClip import AudioClip
+from moviepy.editor import ImageClip
+from moviepy.tools import find_extension
+
+from .audio_utils import AudioBuffer, spill_dir
+from .ffmpeg_utils import decode_audio, probe_audio, stream_clean_samples, stream_clean_audiotrack, speech_segments, \
+    detect_silence_in_samples, non_silent_intervals, cut_audio, subtitles_filter, render_still_video, SilenceConfig, \
+    default_silence_config, MediaInfo, Keyframe, ConcatSegment, probe_media, keyframes, copy_segment, concat_files, \
+    render_crossfades, conform_video, parameter_sets, encode_files
+from .image_utils import VideoType, VIDEO_SIZES, frame_layer_path
+from .encoder_utils import EncoderProfile, default_encoder_profile, moviepy_params, fit_to_cpu, matching_profile, \
+    stream_args
+from .file_utils import remove_files, atomic_output, remove_partial_files
+from .manifest_utils import BatchManifest, MANIFEST_NAME, DEFAULT_MAX_ATTEMPTS
+from .planning_utils import BatchPlan, plan_batch, print_plan, determine_video_type
+from .sharding_utils import ShardConfig, shared_manifest, register_plan, run_sharded
+from .scheduler_utils import ExecutorType, StageLimits, default_stage_limits, PipelineWorkers, \
+    default_pipeline_workers, Stage, init_worker, run_jobs, run_pipeline, stage_slot, current_cancel_event, \
+    check_cancelled
+from .cache_utils import ArtifactCache
+from .metrics_utils import MetricsConfig, configure_metrics, span
+from .subtitles_utils import iter_word_timestamps, iter_chunked_word_timestamps, get_whisper_model, write_subtitles, \
+    SubtitleEntry, SubtitleFormat, SubtitlesConfig
+
+
+# inputs larger than this are cleaned in streaming mode by default
+STREAMING_THRESHOLD_BYTES = 100 * 1024 * 1024
+
+
+def _clean_audio(audio_path: str, silence_config: SilenceConfig,
+                 streaming: bool) -> tuple[AudioBuffer, list[tuple[float, float]] | None]:
+    """
+    Decodes audiofile once and removes silence in memory.
+    :return: cleaned audio and its speech segments, None if they are unknown (streaming mode)
+    """
+    if streaming:
+        with span('streaming_cleanup', audio_path):
+            info = probe_audio(audio_path)
+            # cleaned track is never longer than the source
+            max_size = math.ceil(info.duration * info.sample_rate) * info.channels * 2
+            return AudioBuffer.from_chunks(stream_clean_samples(audio_path, info, silence_config),
+                                           info.sample_rate, info.channels, max_size), None
+    with span('decode', audio_path):
+        rate, aud = decode_audio(audio_path)
+    duration = len(aud) / rate
+    with span('detect_silence', audio_path, profile=True):
+        sil = detect_silence_in_samples(aud, rate, silence_config.threshold_db, silence_config.min_duration)
+    if not sil:
+        return AudioBuffer.from_samples(aud, rate), None
+    with span('remove_silence', audio_path, profile=True):
+        non_sil = non_silent_intervals(sil, silence_config.keep_silence, duration)
+        aud = cut_audio(aud, rate, non_sil)
+    return AudioBuffer.from_samples(aud, rate), speech_segments(non_sil, silence_config.keep_silence, duration)
+
+
+def clean_audiotrack(audio_path: str, output_path: str = None,
+                     silence_config: SilenceConfig = default_silence_config,
+                     streaming: bool = False):
     """
         Removes all silence from audiotrack and deletes all temporary files
         :param audio_path: path to audiofile
         :param output_path path o output audiofile
+        :param silence_config: thresholds of silence detection
+        :param streaming: process audio block by block with constant memory
         """
-    files_for_remove = []
-    try:
-        files_for_remove, audiotrack = _clean_audiotrack(audio_path)
-        print(f"files for remove: {files_for_remove}")
-        audiotrack.write_audiofile(output_path)
-    finally:
-        remove_files([file for file in files_for_remove if not file.endswith(".mp3")])
+    if not output_path:
+        output_path = f"{audio_path[:-4]}_fixed.mp3"
+    if streaming:
+        with span('streaming_cleanup', audio_path):
+            stream_clean_audiotrack(audio_path, output_path, silence_config)
+        return
+    audio, _ = _clean_audio(audio_path, silence_config, streaming=False)
+    with span('encode_audio', audio_path):
+        audio.encode(output_path)
 
 
-def clean_audiotrack(audio_path: str):
-    clean_audiotrack(audio_path, f"{audio_path[:-4]}_fixed.mp3")
+class RenderBackend(str, Enum):
+    MOVIEPY = 'moviepy'
+    FFMPEG = 'ffmpeg'
 
 
-def _clean_audiotrack(audio_path: str, duration: int = None) -> Tuple[list[str], AudioFileClip]:
-    """
-    Removes all silence from audiotrack.
-    :param audio_path: path to audiofile
-    :return tuple with creaeted filepaths and audioclip (created filepaths can be used in future tasks (i.e creating subtitles)
-    """
-    filename = audio_path[:-4]
-    wav_path = filename + '.wav'
-    convert_audiofile(audio_path, wav_path)
+FONT_PATH = 'fonts/OpenSans-Bold.ttf'
 
-    output_path = f"{filename}_fixed.mp3"
-    remove_silence(wav_path, detect_silence(wav_path, 0.5), 0.5, output_path)
-    # todo убрать лишнюю конвертацию в mp3
-    result = AudioFileClip(output_path)
-    files_for_remove = [output_path, wav_path]
+# subtitles are timed with 0.1s precision, so still videos with subtitles need more than 1 frame per second
+SUBTITLES_FPS = 10
 
-    if not duration:
-        return files_for_remove, result
-    return files_for_remove, result.set_duration(duration)
 
+def _moviepy_params(profile: EncoderProfile, subtitles_path: str = None) -> dict:
+    params = moviepy_params(profile, max(profile.fps, SUBTITLES_FPS) if subtitles_path else None)
+    if subtitles_path:
+        params['ffmpeg_params'] += ['-vf', subtitles_filter(subtitles_path, os.path.dirname(FONT_PATH))]
+    return params
 
-VideoType = Literal['plain', 'short']
 
+def export_frame_video(frame_path: str,
+                       audio: AudioBuffer,
+                       output_path: str,
+                       subtitles_path: str = None,
+                       profile: EncoderProfile = default_encoder_profile):
+    """
+    Encodes pre-rendered frame with audio using moviepy. The frame already contains caption,
+    so no compositing is done per frame.
+    Moviepy 1.x always encodes the audio into a temporary file first and muxes it into the video (there is no
+    way to pass it to the video encoder directly), the file is written to the temp dir and deleted afterwards.
+    Use the ffmpeg backend to write nothing but the final video.
+    """
+    params = _moviepy_params(profile, subtitles_path)
+    fd, audio_path = tempfile.mkstemp(prefix='montajer-', suffix=f'.{find_extension(params["audio_codec"])}')
+    os.close(fd)
+    try:
+        video_clip = ImageClip(frame_path).set_duration(audio.duration).set_audio(_audio_clip(audio))
+        video_clip.write_videofile(output_path, audio_fps=audio.rate, temp_audiofile=audio_path, **params)
+    finally:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
 
-def add_background_image(video_type: VideoType, image_path: str, duration: int) -> ImageClip:
-    image_clip = ImageClip(image_path).set_duration(duration)
 
-    if video_type == 'plain':
-        # Resize to fit height, keeping aspect ratio
-        image_clip = image_clip.resize(height=1080)
+def _audio_clip(audio: AudioBuffer) -> AudioClip:
+    """
+    Wraps samples into a moviepy clip which converts them to float chunk by chunk while moviepy
+    encodes the audio, the whole track is never copied (samples of large tracks stay memory-mapped).
+    """
+    samples = audio.samples
+    last = max(0, len(samples) - 1)
 
-        # If the resized image width is less than 1920, add padding
-        if image_clip.size[0] < 1920:
-            image_clip = image_clip.on_color(size=(1920, 1080), color=(0, 0, 0), pos=('center', 'center'))
-    elif video_type == 'short':
-        image_clip = image_clip.resize(height=1920)
-        image_clip = image_clip.on_color(size=(1080, 1920), color=(0, 0, 0))
-    else:
-        raise ValueError(f"Invalid video_type. Expected values: ['plain', 'short']")
+    def make_frame(t):
+        index = np.clip((np.asarray(t) * audio.rate).astype(np.int64), 0, last)
+        return samples[index].astype(np.float32) / 32768
 
-    return image_clip
+    return AudioClip(make_frame, duration=audio.duration, fps=audio.rate)
 
 
-def add_text_on_background(text: str, duration: int, font_path: str, padding_top: int = 75) -> TextClip:
-    text_clip = TextClip(text, size=(900, 0), fontsize=60, color='white', font=font_path)
+def export_still_video(frame_path: str,
+                       audio: AudioBuffer,
+                       output_path: str,
+                       duration=None,
+                       subtitles_path: str = None,
+                       profile: EncoderProfile = default_encoder_profile):
+    """
+    Lets ffmpeg loop pre-rendered frame as a still image, audio samples are piped to its stdin.
+    Subtitles, if given, are burned during the same encode.
+    """
+    if subtitles_path:
+        render_still_video(frame_path, None, output_path, duration, fps=max(profile.fps, SUBTITLES_FPS),
+                           video_filter=subtitles_filter(subtitles_path, os.path.dirname(FONT_PATH)),
+                           audio_samples=audio.samples, sample_rate=audio.rate, profile=profile)
+    else:
+        render_still_video(frame_path, None, output_path, duration,
+                           audio_samples=audio.samples, sample_rate=audio.rate, profile=profile)
 
-    text_clip = text_clip.set_duration(duration)
 
-    text_clip = text_clip.set_position(('center', padding_top))
+@dataclass
+class VideoJob:
+    """
+    Parameters of a single video and intermediate results passed between pipeline stages.
+    """
+    image_path: str
+    audio_path: str
+    output_path: str
+    text: str
+    subtitles_enabled: bool = False
+    subtitles_config: SubtitlesConfig = None
+    duration: int = None
+    silence_config: SilenceConfig = default_silence_config
+    render_backend: RenderBackend = RenderBackend.MOVIEPY
+    encoder_profile: EncoderProfile = default_encoder_profile
+    cache: ArtifactCache = None
+    manifest: BatchManifest = None
+    cancel_event: threading.Event = None
+    worker: str = None
+    files_for_remove: list[str] = field(default_factory=list)
+    audio: AudioBuffer = None
+    speech_segments: list = None
+    video_type: VideoType = None
+    subtitle_path: str = None
+    cache_keys: dict = field(default_factory=dict)
+    completed: bool = False
+
+
+def _cache_keys(job: VideoJob) -> dict[str, str]:
+    """
+    Keys of artifacts of the job. Every key includes keys of the artifacts it is built from,
+    so a change of the source audio or of any parameter invalidates all following stages.
+    """
+    cache = job.cache
+    keys = {'audio': cache.key([job.audio_path], silence_config=list(job.silence_config))}
+    if job.subtitles_enabled:
+        keys['words'] = cache.key(audio=keys['audio'], model=job.subtitles_config.model,
+                                  language=job.subtitles_config.language)
+    # grouping of words into cues affects the video
+    config = job.subtitles_config
+    keys['video'] = cache.key([job.image_path, FONT_PATH], audio=keys['audio'], words=keys.get('words'),
+                              subtitles_config=[config.max_line_width, config.max_line_count, config.max_cue_duration,
+                                                config.split_pause, config.split_on_punctuation]
+                              if job.subtitles_enabled else None,
+                              text=job.text, duration=job.duration, render_backend=job.render_backend.value,
+                              # threads don't change the result
+                              encoder_profile=list(job.encoder_profile._replace(threads=0)))
+    return keys
+
+
+def _cache_audio(job: VideoJob, audio: AudioBuffer):
+    fd, tmp_path = tempfile.mkstemp(suffix='.wav', dir=spill_dir(audio.samples.nbytes))
+    os.close(fd)
+    try:
+        audio.save(tmp_path)
+        job.cache.put('audio', job.cache_keys['audio'], '.wav', tmp_path)
+    finally:
+        os.remove(tmp_path)
+    if job.speech_segments is not None:
+        job.cache.put_json('segments', job.cache_keys['audio'], job.speech_segments)
 
-    return text_clip
 
+def cleanup_stage(job: VideoJob):
+    """
+    Removes silence from the audiotrack of the job and determines video type.
+    Cleaned audio stays in memory, the source is the only file read by the job.
+    If the final video is already cached, it is copied to the output and the job is completed.
+    """
+    audio = None
+    if job.cache:
+        job.cache_keys = _cache_keys(job)
+        cached_video = job.cache.get('video', job.cache_keys['video'], '.mp4')
+        if cached_video:
+            with atomic_output(job.output_path, job.worker) as tmp_path:
+                shutil.copyfile(cached_video, tmp_path)
+            job.completed = True
+            return
+        cached_audio = job.cache.get('audio', job.cache_keys['audio'], '.wav')
+        if cached_audio:
+            audio = AudioBuffer.load(cached_audio)
+            job.speech_segments = job.cache.get_json('segments', job.cache_keys['audio'])
+
+    if audio is None:
+        streaming = os.path.getsize(job.audio_path) > STREAMING_THRESHOLD_BYTES
+        audio, job.speech_segments = _clean_audio(job.audio_path, job.silence_config, streaming)
+        if job.cache:
+            _cache_audio(job, audio)
+    job.audio = audio.trim(job.duration)
+    if job.speech_segments and job.audio is not audio:
+        job.speech_segments = [(start, min(end, job.audio.duration)) for start, end in job.speech_segments
+                               if start < job.audio.duration]
+    if job.video_type is None:
+        job.video_type = determine_video_type(job.audio.duration)
+
+
+def subtitles_stage(job: VideoJob):
+    """
+    Generates ASS subtitles styled with the caption font for the cleaned audiotrack.
+    They are burned later during rendering.
+    """
+    if not job.subtitles_enabled or job.completed:
+        return
+    # subtitles are written to a temporary file, not next to the source, so jobs never collide
+    fd, job.subtitle_path = tempfile.mkstemp(prefix='montajer-', suffix='.ass')
+    os.close(fd)
+    job.files_for_remove.append(job.subtitle_path)
+
+    def write(word_timestamps):
+        write_subtitles(word_timestamps, job.subtitle_path, SubtitleFormat.ASS, job.subtitles_config, FONT_PATH,
+                        VIDEO_SIZES[job.video_type])
+
+    cached_words = job.cache.get_json('words', job.cache_keys['words']) if job.cache else None
+    if cached_words is not None:
+        write(SubtitleEntry(*word) for word in cached_words)
+        return
+    with stage_slot('transcribers'), span('transcribe', job.audio_path, profile=True):
+        model = get_whisper_model(job.subtitles_config)
+        if job.audio.spill_path:
+            # a streamed track is transcribed in chunks, its whisper copy never has to fit in memory
+            word_timestamps = iter_chunked_word_timestamps(job.audio.whisper_chunks(), model,
+                                                           job.subtitles_config.language)
+        else:
+            # silence intervals found during cleanup are reused, whisper skips non-speech parts
+            word_timestamps = iter_word_timestamps(job.audio.whisper_samples(), model,
+                                                   job.subtitles_config.language, job.speech_segments)
+        if not job.cache:
+            # cues are written while whisper is still decoding
+            write(word_timestamps)
+            return
+        word_timestamps = list(word_timestamps)
+    job.cache.put_json('words', job.cache_keys['words'], word_timestamps)
+    write(word_timestamps)
+
+
+def render_stage(job: VideoJob):
+    """
+    Encodes the video with the cleaned audiotrack, caption and subtitles.
+    """
+    if job.completed:
+        return
+    # background and caption are composed once per (image, video type, text) and shared by all jobs
+    with span('frame_layer', job.audio_path, profile=True):
+        frame_path = frame_layer_path(job.video_type, job.image_path, job.text, FONT_PATH)
+    # the video appears under its final name only when it is completely written
+    with stage_slot('encoders'), span('render', job.audio_path, profile=job.render_backend == RenderBackend.MOVIEPY), \
+            atomic_output(job.output_path, job.worker) as tmp_path:
+        if job.render_backend == RenderBackend.FFMPEG:
+            export_still_video(frame_path, job.audio, tmp_path, job.duration, job.subtitle_path, job.encoder_profile)
+        else:
+            export_frame_video(frame_path, job.audio, tmp_path, job.subtitle_path, job.encoder_profile)
+    if job.cache:
+        job.cache.put('video', job.cache_keys['video'], '.mp4', job.output_path)
+
+
+def run_stage(name: str, fn: Callable[[VideoJob], None], job: VideoJob, last: bool = False):
+    """
+    Runs stage of the job and records its outcome in the batch manifest.
+    :param name: stage name
+    :param fn: stage function
+    :param last: the stage is the last one, the job is finished when it succeeds
+    """
+    check_cancelled(job.cancel_event)
+    if job.manifest is None:
+        fn(job)
+        return
+    job.manifest.stage_started(job.audio_path, name, job.worker)
+    start = time.perf_counter()
+    try:
+        fn(job)
+    except Exception as e:
+        job.manifest.stage_failed(job.audio_path, name, repr(e), job.worker)
+        raise
+    job.manifest.stage_done(job.audio_path, name, time.perf_counter() - start, last, job.worker)
 
-def export_video(image_clip: ImageClip,
-                 audio_clip: AudioFileClip,
-                 text_clip: TextClip,
-                 output_path: str,
-                 duration=None):
-    video_clip = image_clip.set_audio(audio_clip)
 
-    video_with_caption = CompositeVideoClip([video_clip, text_clip])
+# subtitles are generated before rendering, so they are burned in the one and only encode
+STAGES = [('cleanup', cleanup_stage), ('subtitles', subtitles_stage), ('render', render_stage)]
 
-    if duration:
-        video_with_caption.set_duration(duration)
-        text_clip.set_duration(duration)
 
-    video_with_caption.write_videofile(output_path, codec='libx264', audio_codec='aac', fps=24)
+def release_job(job: VideoJob):
+    """
+    Releases audio samples and deletes temporary files of the job.
+    """
+    if job.audio:
+        job.audio.close()
+        job.audio = None
+    remove_files(job.files_for_remove)
+    job.files_for_remove = []
 
 
 def create_video_with_image(image_path: str,
@@ -105,7 +358,15 @@ def create_video_with_image(image_path: str,
                             text: str,
                             subtitles_enabled=False,
                             subtitles_config: SubtitlesConfig = None,
-                            duration: int = None):
+                            duration: int = None,
+                            silence_config: SilenceConfig = default_silence_config,
+                            render_backend: RenderBackend = RenderBackend.MOVIEPY,
+                            encoder_profile: EncoderProfile = default_encoder_profile,
+                            cache: ArtifactCache = None,
+                            manifest: BatchManifest = None,
+                            cancel_event: threading.Event = None,
+                            video_type: VideoType = None,
+                            worker: str = None):
     """
     Creates video based on audio and background image
     :param image_path: path to background image
@@ -115,34 +376,25 @@ def create_video_with_image(image_path: str,
     :param duration: max duration of generated video. If None that output video duration will be same as clean-up audiotrack
     :param subtitles_enabled: option for generating subtitles
     :param subtitles_config: some parameters for subtitles generation
+    :param silence_config: thresholds of silence detection
+    :param render_backend: moviepy composites every frame, ffmpeg loops a single pre-rendered frame
+    :param encoder_profile: encoder settings
+    :param cache: cache of artifacts, stages whose result is already cached are skipped
+    :param manifest: batch manifest, progress of every stage is recorded in it
+    :param cancel_event: when set, the job stops before its next stage
+    :param video_type: type of video if it is known before cleanup, None - determined by the cleaned audio
+    :param worker: worker of a sharded batch which claimed the video, the manifest is updated only while it owns it
     :return: None
     """
-
     # todo разобраться, почему не сохраняются видео в нужную папку с субтитрами
-    def determine_video_type(duration_in_seconds: int) -> VideoType:
-        return 'plain' if duration_in_seconds > 60 else 'short'
-
-    # Use the font path from the environment variable
-    font_path = 'fonts/OpenSans-Bold.ttf'
-    audio_clip = None
-    files_for_remove = []
-
+    job = VideoJob(image_path, audio_path, output_path, text, subtitles_enabled, subtitles_config, duration,
+                   silence_config, render_backend, encoder_profile, cache, manifest, cancel_event,
+                   video_type=video_type, worker=worker)
     try:
-        files_for_remove, audio_clip = _clean_audiotrack(audio_path, duration)
-        video_type = determine_video_type(audio_clip.duration)
-        image_clip = add_background_image(video_type, image_path, audio_clip.duration)
-        text_clip = add_text_on_background(text, audio_clip.duration, font_path)
-
-        # todo сделать так, чтобы субтитры сразу вставлялись в видео
-        export_video(image_clip, audio_clip, text_clip, output_path)
-        if subtitles_enabled:
-            subtitle_path = f'{audio_path[:-4]}.srt'
-            write_subtitle_file(find_first_mp3_file(files_for_remove), subtitle_path, SubtitleFormat.SRT,
-                                subtitles_config)
-            burn_subtitles_into_video(output_path, subtitle_path, f'{output_path[:-4]}_subtitles.mp4')
+        for i, (name, fn) in enumerate(STAGES):
+            run_stage(name, fn, job, last=i == len(STAGES) - 1)
     finally:
-        audio_clip.close()
-        remove_files(files_for_remove)
+        release_job(job)
 
 
 def create_videos_with_image(source_audio_folder_path: str,
@@ -151,27 +403,302 @@ def create_videos_with_image(source_audio_folder_path: str,
                              video_caption_text: str, 
                              subtitles_enabled=False,
                              subtitles_config: SubtitlesConfig = None,
-                             threads=1):
-    fix_filenames(source_audio_folder_path)
-    audio_paths = glob.glob(os.path.join(source_audio_folder_path, '*.mp3')) + \
-                  glob.glob(os.path.join(source_audio_folder_path, '*.m4a'))
-    background_image_paths = glob.glob(os.path.join(source_images_folder_path, '*.jpg'))
-
-    def create_video_helper(audio_path: str):
-        random_image_path = random.choice(background_image_paths)
-        output_path = f'{output_video_folder_path}/{os.path.basename(audio_path)[:-4]}.mp4'
-        create_video_with_image(
-            image_path=random_image_path,
-            audio_path=audio_path,
-            output_path=output_path,
+                             threads=1,
+                             silence_config: SilenceConfig = default_silence_config,
+                             render_backend: RenderBackend = RenderBackend.MOVIEPY,
+                             executor: ExecutorType = ExecutorType.THREAD,
+                             stage_limits: StageLimits = default_stage_limits,
+                             pipeline_workers: PipelineWorkers = default_pipeline_workers,
+                             cache: ArtifactCache = None,
+                             metrics_config: MetricsConfig = None,
+                             resume: bool = False,
+                             max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                             encoder_profile: EncoderProfile = default_encoder_profile,
+                             dry_run: bool = False,
+                             plan_path: str = None,
+                             shard_config: ShardConfig = None) -> dict[str, Exception]:
+    """
+    Creates video for every audiofile in the folder.
+    All inputs are probed and validated before the batch starts, corrupt or unsupported files are reported
+    and skipped, longest audiofiles are processed first. Source files are never renamed, output names are
+    sanitized names of the sources.
+    Progress is recorded in a manifest in the output folder, videos are written under temporary names
+    and renamed when they are complete.
+    :param executor: thread pool, process pool or staged pipeline
+    :param stage_limits: max number of videos simultaneously being encoded / transcribed (thread and process pools)
+    :param pipeline_workers: number of workers of every pipeline stage
+    :param cache: cache of artifacts, only changed audiofiles are processed again
+    :param metrics_config: where to write per-stage metrics of every file (and cProfile output), None - disabled
+    :param resume: continue the previous batch of the output folder: finished videos are skipped,
+        failed ones are retried unless they failed max_attempts times already
+    :param max_attempts: max number of attempts of a video when resuming
+    :param encoder_profile: encoder settings, automatic threads are divided between concurrent encodes
+    :param dry_run: only print the plan of the batch, nothing is decoded or written
+    :param plan_path: where to save the plan of the batch as JSON, None - not saved
+    :param shard_config: run as a worker of a sharded batch: videos are claimed from the manifest shared with
+        workers on other hosts, `threads` threads claim them. The output folder is prepared by the coordinator
+    :return: audio path -> exception for every video which failed (including invalid inputs)
+    """
+    if threads == -1:
+        threads = os.cpu_count()
+    # encodes running at the same time share the cores instead of starting a thread per core each
+    concurrent_encodes = pipeline_workers.render if executor == ExecutorType.PIPELINE else \
+        min(threads, stage_limits.encoders or threads)
+    encoder_profile = fit_to_cpu(encoder_profile, concurrent_encodes)
+
+    plan = plan_batch(source_audio_folder_path, source_images_folder_path, output_video_folder_path, encoder_profile)
+    print_plan(plan, verbose=dry_run)
+    if plan_path:
+        plan.save(plan_path)
+    if dry_run:
+        return {}
+    if plan.valid_videos and not plan.image_paths:
+        raise ValueError(f'No valid background images in {source_images_folder_path}')
+
+    if shard_config is not None:
+        return _run_shard(plan, output_video_folder_path, video_caption_text, subtitles_enabled, subtitles_config,
+                          threads, silence_config, render_backend, stage_limits, cache, metrics_config, max_attempts,
+                          encoder_profile, shard_config)
+
+    configure_metrics(metrics_config, reset=True)
+    os.makedirs(output_video_folder_path, exist_ok=True)
+    removed = remove_partial_files(output_video_folder_path)
+    if removed:
+        print(f"Удалено недописанных файлов: {len(removed)}")
+    manifest = BatchManifest(os.path.join(output_video_folder_path, MANIFEST_NAME))
+    if not resume:
+        manifest.reset()
+    invalid = _record_invalid_inputs(plan, manifest)
+
+    jobs = {
+        video.audio_path: dict(
+            image_path=_background_image(plan.image_paths, video.audio_path, cache),
+            audio_path=video.audio_path,
+            output_path=video.output_path,
             text=video_caption_text,
             subtitles_enabled=subtitles_enabled,
-            subtitles_config=subtitles_config
+            subtitles_config=subtitles_config,
+            silence_config=silence_config,
+            render_backend=render_backend,
+            encoder_profile=encoder_profile,
+            cache=cache,
+            manifest=manifest,
+            # events can't be passed to other processes, a process pool batch is not cancellable
+            cancel_event=current_cancel_event.get() if executor != ExecutorType.PROCESS else None,
+            video_type=video.video_type
         )
+        for video in plan.valid_videos
+    }
+    for name, kwargs in list(jobs.items()):
+        if resume and not manifest.should_run(name, max_attempts):
+            del jobs[name]
+            continue
+        manifest.register(name, kwargs['audio_path'], kwargs['output_path'])
+        manifest.start(name)
+    if resume:
+        print(f"Пропущено готовых или исчерпавших попытки видео: {len(plan.valid_videos) - len(jobs)}")
+
+    font_path = FONT_PATH
+    subtitles_config = subtitles_config if subtitles_enabled else None
+    if executor == ExecutorType.PIPELINE:
+        if subtitles_config and subtitles_config.num_workers < pipeline_workers.subtitles:
+            # subtitles workers share one model, it must allow that many parallel transcriptions
+            subtitles_config = subtitles_config._replace(num_workers=pipeline_workers.subtitles)
+            for kwargs in jobs.values():
+                kwargs['subtitles_config'] = subtitles_config
+        # video N is encoded while video N+1 is transcribed and N+2 is cleaned
+        init_worker({}, font_path, subtitles_config, metrics_config)
+        workers = [pipeline_workers.cleanup, pipeline_workers.subtitles, pipeline_workers.render]
+        stages = [Stage(name, partial(run_stage, name, fn, last=i == len(STAGES) - 1), workers[i])
+                  for i, (name, fn) in enumerate(STAGES)]
+        return invalid | run_pipeline({name: VideoJob(**kwargs) for name, kwargs in jobs.items()}, stages,
+                                      release_job)
+
+    return invalid | run_jobs(create_video_with_image, jobs, executor, threads, stage_limits, font_path,
+                              subtitles_config, metrics_config)
+
+
+def _background_image(image_paths: list[str], audio_path: str, cache: ArtifactCache = None) -> str:
+    """
+    Picks background image of the video. The choice depends only on the audiofile (on its content if the cache
+    is enabled), so a rerun of an unchanged batch renders the same videos and takes them from the cache.
+    """
+    seed = cache.file_hash(audio_path) if cache else os.path.basename(audio_path)
+    return random.Random(seed).choice(image_paths)
 
-    if threads == -1:
-        threads = os.cpu_count()
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = [executor.submit(create_video_helper, audio_path) for audio_path in audio_paths]
-        for future in futures:
-            future.result()
+
+def _run_shard(plan: BatchPlan, output_folder: str, text: str, subtitles_enabled: bool,
+               subtitles_config: SubtitlesConfig, threads: int, silence_config: SilenceConfig,
+               render_backend: RenderBackend, stage_limits: StageLimits, cache: ArtifactCache,
+               metrics_config: MetricsConfig, max_attempts: int, encoder_profile: EncoderProfile,
+               shard_config: ShardConfig) -> dict[str, Exception]:
+    """
+    Runs this process as a worker of a sharded batch. Every worker registers the inputs it sees,
+    registration keeps the state of inputs already registered or claimed by other workers.
+    Partial files and the manifest are never cleaned here, they belong to all workers.
+    """
+    # metrics of other workers in the same report file are kept
+    configure_metrics(metrics_config, reset=False)
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = shared_manifest(output_folder)
+    # invalid inputs are reported by every worker, but never claimed
+    invalid = {video.audio_path: ValueError(video.error) for video in plan.invalid_videos}
+    cancel_event = current_cancel_event.get()
+    register_plan(manifest, plan)
+    jobs = {
+        video.audio_path: dict(
+            image_path=_background_image(plan.image_paths, video.audio_path, cache),
+            audio_path=video.audio_path,
+            output_path=video.output_path,
+            text=text,
+            subtitles_enabled=subtitles_enabled,
+            subtitles_config=subtitles_config,
+            silence_config=silence_config,
+            render_backend=render_backend,
+            encoder_profile=encoder_profile,
+            cache=cache,
+            manifest=manifest,
+            video_type=video.video_type
+        )
+        for video in plan.valid_videos
+    }
+    subtitles_config = subtitles_config if subtitles_enabled else None
+    return invalid | run_sharded(create_video_with_image, jobs, manifest, threads, shard_config, max_attempts,
+                                 stage_limits, FONT_PATH, subtitles_config, metrics_config, cancel_event)
+
+
+def _record_invalid_inputs(plan: BatchPlan, manifest: BatchManifest) -> dict[str, Exception]:
+    """
+    Marks inputs rejected by the planning pre-pass as failed at the 'plan' stage.
+    :return: audio path -> error for every invalid input
+    """
+    invalid = {}
+    for video in plan.invalid_videos:
+        manifest.register(video.audio_path, video.audio_path, video.output_path)
+        manifest.start(video.audio_path)
+        manifest.stage_started(video.audio_path, 'plan')
+        manifest.stage_failed(video.audio_path, 'plan', video.error)
+        invalid[video.audio_path] = ValueError(video.error)
+    return invalid
+
+
+# keyframes near a join are looked for this many seconds around it before the whole video is scanned
+KEYFRAME_SEARCH_WINDOW = 60
+
+
+def _keyframe_before(path: str, position: float) -> Keyframe | None:
+    for start in (max(0.0, position - KEYFRAME_SEARCH_WINDOW), None):
+        found = [keyframe for keyframe in keyframes(path, start, position) if keyframe.pts <= position]
+        if found:
+            return found[-1]
+    return None
+
+
+def _keyframe_after(path: str, position: float) -> Keyframe | None:
+    for end in (position + KEYFRAME_SEARCH_WINDOW, None):
+        found = [keyframe for keyframe in keyframes(path, position, end) if keyframe.pts >= position]
+        if found:
+            return found[0]
+    return None
+
+
+def _join_plan(videos: list[tuple[str, float]], crossfade: float) -> list[ConcatSegment | list[ConcatSegment]]:
+    """
+    Splits videos into parts copied as they are and transitions to re-encode.
+    A copied part starts and ends at keyframes, a transition is a list of parts joined with crossfades:
+    the tail of a video after its last keyframe before the crossfade and the head of the next one
+    up to its first keyframe after the crossfade.
+    :param videos: paths and durations of videos
+    :return: parts (ConcatSegment) and transitions (list of ConcatSegment) in the order of output
+    """
+    if not crossfade:
+        return [ConcatSegment(path, None, None) for path, _ in videos]
+    plan, transition = [], []
+    for i, (path, duration) in enumerate(videos):
+        first = Keyframe(0.0, 0.0) if i == 0 else _keyframe_after(path, crossfade)
+        last = None if i == len(videos) - 1 else _keyframe_before(path, duration - crossfade)
+        copy_in = first.pts if first else duration
+        copy_out = last.pts if last else (duration if i == len(videos) - 1 else 0.0)
+        if copy_in >= copy_out:
+            # no keyframe between the crossfades, the whole video is a part of the transition
+            transition.append(ConcatSegment(path, None, duration))
+            continue
+        if transition:
+            transition.append(ConcatSegment(path, None, copy_in))
+            plan.append(transition)
+        plan.append(ConcatSegment(path, copy_in or None, last.pts if last else None, last.dts if last else None))
+        transition = [ConcatSegment(path, copy_out, duration)] if last else []
+    if transition:
+        plan.append(transition)
+    return plan
+
+
+def _stream_params(info: MediaInfo) -> MediaInfo:
+    return info._replace(duration=None)
+
+
+def concat_videos(video_paths: list[str], output_path: str, crossfade: float = 0.0,
+                  encoder_profile: EncoderProfile = default_encoder_profile):
+    """
+    Joins videos into one in the given order.
+    Videos with equal stream parameters and parameter sets (i.e. made with the same encoder profile) are joined
+    with the concat demuxer and stream copy, so joining takes as long as copying the files. Videos with other
+    parameters (i.e. intro and outro clips) are re-encoded once to the parameters of the longest video.
+    With crossfade only short transitions between the nearest keyframes around every join are re-encoded.
+    Re-encoded parts get encoder settings of the longest video, if their parameter sets still differ
+    from its ones, the joined parts are encoded once more as a whole.
+    :param video_paths: paths to videos
+    :param output_path: path to output video
+    :param crossfade: duration of crossfades between videos in seconds, 0 - videos are joined as they are
+    :param encoder_profile: encoder settings of re-encoded parts, the codec is changed to the one of the videos,
+        profile, reference frames, entropy coder and quality are taken from the videos
+    """
+    if not video_paths:
+        raise ValueError('No videos to concatenate')
+    infos = [probe_media(path) for path in video_paths]
+    for path, info in zip(video_paths, infos):
+        if crossfade and info.duration <= 2 * crossfade:
+            raise ValueError(f'{path} is shorter than two crossfades')
+    reference_index = max(range(len(infos)), key=lambda i: infos[i].duration)
+    reference = infos[reference_index]
+    profile = matching_profile(encoder_profile, reference.codec)
+    # mp4 keeps parameter sets of the first part only, every part must have the ones of the reference
+    reference_sets = parameter_sets(video_paths[reference_index], reference.codec)
+    encoder_args = stream_args(profile, reference_sets)
+    # temporary parts are written next to the output, they are as large as the output
+    with tempfile.TemporaryDirectory(prefix='.montajer-concat-',
+                                     dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        videos, encoded = [], []
+        for i, (path, info) in enumerate(zip(video_paths, infos)):
+            if _stream_params(info) != _stream_params(reference) or \
+                    parameter_sets(path, info.codec) != reference_sets:
+                conformed_path = os.path.join(tmp_dir, f'conformed_{i}.mp4')
+                with span('conform', path):
+                    conform_video(path, conformed_path, reference, profile, encoder_args)
+                path, info = conformed_path, probe_media(conformed_path)
+                encoded.append(path)
+            videos.append((path, info.duration))
+
+        parts = []
+        for i, part in enumerate(_join_plan(videos, crossfade)):
+            if isinstance(part, list):
+                part_path = os.path.join(tmp_dir, f'transition_{i}.mp4')
+                with span('transition', output_path):
+                    render_crossfades(part, part_path, crossfade, reference, profile, encoder_args)
+                encoded.append(part_path)
+            elif part.inpoint or part.outpoint is not None:
+                part_path = os.path.join(tmp_dir, f'part_{i}.mp4')
+                copy_segment(part, part_path)
+            else:
+                part_path = part.path
+            parts.append(part_path)
+        mismatched = [path for path in encoded if parameter_sets(path, reference.codec) != reference_sets]
+        if mismatched:
+            # the encoder can't reproduce the parameter sets of the videos, stream copy would be decoded wrongly
+            print(f"Параметры кодирования {video_paths[reference_index]} не удалось повторить, "
+                  "видео будет перекодировано целиком")
+            with span('concat_encode', output_path), atomic_output(output_path) as tmp_path:
+                encode_files(parts, tmp_path, reference, profile, encoder_args)
+            return
+        with span('concat', output_path), atomic_output(output_path) as tmp_path:
+            concat_files(parts, tmp_path, os.path.join(tmp_dir, 'concat.txt'))
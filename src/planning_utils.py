@@ -0,0 +1,175 @@
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+
+from PIL import Image
+
+from .encoder_utils import EncoderProfile
+from .ffmpeg_utils import probe_audio
+from .file_utils import unique_output_names
+from .image_utils import VideoType
+
+AUDIO_EXTENSIONS = ('.mp3', '.m4a')
+IMAGE_EXTENSIONS = ('.jpg',)
+
+# longer videos are horizontal, shorter ones are vertical shorts
+SHORT_VIDEO_MAX_DURATION = 60
+
+# share of speech in a typical recording, used to estimate cleaned duration before any audio is decoded
+DEFAULT_SPEECH_RATIO = 0.8
+
+# probing is a short ffprobe process per file, mostly waiting for disk
+PROBE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+def determine_video_type(duration_in_seconds: float) -> VideoType:
+    return 'plain' if duration_in_seconds > SHORT_VIDEO_MAX_DURATION else 'short'
+
+
+@dataclass
+class PlannedVideo:
+    """
+    Input of a batch as seen by the planning pre-pass, before anything is decoded.
+    """
+    audio_path: str
+    output_path: str
+    size: int
+    duration: float = None
+    sample_rate: int = None
+    channels: int = None
+    estimated_duration: float = None
+    # known up front only when cleanup can't change it, otherwise determined from the cleaned audio
+    video_type: VideoType = None
+    error: str = None
+
+    @property
+    def valid(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class BatchPlan:
+    """
+    Validated inputs of a batch in the order of execution (longest first) and settings shared by all videos.
+    """
+    videos: list[PlannedVideo]
+    image_paths: list[str]
+    invalid_images: dict[str, str] = field(default_factory=dict)
+    encoder_profile: EncoderProfile = None
+
+    @property
+    def valid_videos(self) -> list[PlannedVideo]:
+        return [video for video in self.videos if video.valid]
+
+    @property
+    def invalid_videos(self) -> list[PlannedVideo]:
+        return [video for video in self.videos if not video.valid]
+
+    def to_dict(self) -> dict:
+        return {'videos': [asdict(video) for video in self.videos],
+                'image_paths': self.image_paths,
+                'invalid_images': self.invalid_images,
+                'encoder_profile': self.encoder_profile._asdict() if self.encoder_profile else None,
+                'total_duration': sum(video.duration for video in self.valid_videos),
+                'estimated_duration': sum(video.estimated_duration for video in self.valid_videos)}
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+def find_files(folder: str, extensions: tuple[str, ...]) -> list[str]:
+    """
+    Lists files of the folder with one of the extensions (case-insensitive).
+    """
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if os.path.splitext(name)[1].lower() in extensions and os.path.isfile(os.path.join(folder, name)))
+
+
+def probe_video(audio_path: str, output_path: str, speech_ratio: float = DEFAULT_SPEECH_RATIO) -> PlannedVideo:
+    """
+    Reads duration and format of the audiofile from its headers and checks that it can be processed.
+    Errors are stored in the result instead of being raised.
+    """
+    video = PlannedVideo(audio_path, output_path, os.path.getsize(audio_path))
+    try:
+        info = probe_audio(audio_path)
+    except subprocess.CalledProcessError as e:
+        # the last line of ffprobe output is the reason, the previous ones are details of the demuxer
+        lines = (e.stderr or b'').decode('utf-8', 'replace').strip().splitlines()
+        video.error = lines[-1] if lines else f'ffprobe exited with code {e.returncode}'
+        return video
+    except (ValueError, KeyError) as e:
+        video.error = str(e)
+        return video
+    video.duration, video.sample_rate, video.channels = info.duration, info.sample_rate, info.channels
+    if info.duration <= 0:
+        video.error = 'audio is empty or its duration is unknown'
+        return video
+    if info.sample_rate <= 0 or info.channels <= 0:
+        video.error = f'unsupported audio format: {info.sample_rate} Hz, {info.channels} channels'
+        return video
+    video.estimated_duration = info.duration * speech_ratio
+    # cleanup only makes audio shorter
+    if info.duration <= SHORT_VIDEO_MAX_DURATION:
+        video.video_type = determine_video_type(info.duration)
+    return video
+
+
+def validate_image(image_path: str) -> str | None:
+    """
+    Checks that the image can be decoded, only headers and compressed data are read.
+    :return: error or None
+    """
+    try:
+        with Image.open(image_path) as image:
+            image.verify()
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+def plan_batch(audio_folder: str, images_folder: str, output_folder: str,
+               encoder_profile: EncoderProfile = None, workers: int = PROBE_WORKERS) -> BatchPlan:
+    """
+    Probes and validates all inputs of a batch in parallel without decoding audio.
+    Output names are sanitized input names, source files are never renamed.
+    :param encoder_profile: encoder settings of the batch (already fitted to the CPU)
+    :param workers: number of files probed at the same time
+    """
+    audio_paths = find_files(audio_folder, AUDIO_EXTENSIONS)
+    image_paths = find_files(images_folder, IMAGE_EXTENSIONS)
+    output_names = unique_output_names(audio_paths, '.mp4')
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        videos = list(pool.map(lambda path: probe_video(path, os.path.join(output_folder, output_names[path])),
+                               audio_paths))
+        image_errors = dict(zip(image_paths, pool.map(validate_image, image_paths)))
+    # the longest videos go first, so they don't end up as the tail of a parallel batch
+    videos.sort(key=lambda video: (video.valid, video.duration or 0), reverse=True)
+    return BatchPlan(videos, [path for path, error in image_errors.items() if error is None],
+                     {path: error for path, error in image_errors.items() if error is not None}, encoder_profile)
+
+
+def print_plan(plan: BatchPlan, verbose: bool = False):
+    """
+    Prints summary of the plan, with verbose - every video in the order of execution.
+    """
+    valid = plan.valid_videos
+    total = sum(video.duration for video in valid)
+    estimated = sum(video.estimated_duration for video in valid)
+    print(f"Аудиофайлов: {len(valid)}, общая длительность {total / 60:.1f} мин, "
+          f"после удаления тишины ~{estimated / 60:.1f} мин. Картинок: {len(plan.image_paths)}")
+    if plan.encoder_profile and verbose:
+        profile = plan.encoder_profile
+        print(f"Кодирование: {profile.codec} {profile.preset or ''} crf={profile.crf} fps={profile.fps} "
+              f"потоков ffmpeg={profile.threads}")
+    if verbose:
+        for video in valid:
+            video_type = video.video_type or f'~{determine_video_type(video.estimated_duration)}'
+            print(f"  {video.duration:8.1f} с  {video_type:7} {video.audio_path} -> {video.output_path}")
+    for video in plan.invalid_videos:
+        print(f"Пропущен {video.audio_path}: {video.error}")
+    for image_path, error in plan.invalid_images.items():
+        print(f"Пропущена картинка {image_path}: {error}")
@@ -0,0 +1,207 @@
+import contextvars
+import multiprocessing
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum
+from functools import partial
+from typing import Callable
+
+from .image_utils import load_font
+from .metrics_utils import MetricsConfig, configure_metrics
+from .subtitles_utils import SubtitlesConfig, get_whisper_model
+
+
+class ExecutorType(str, Enum):
+    THREAD = 'thread'
+    PROCESS = 'process'
+    PIPELINE = 'pipeline'
+
+
+# max number of jobs which are allowed to be in the same stage simultaneously (None - no limit)
+StageLimits = namedtuple('StageLimits', ['encoders', 'transcribers'])
+default_stage_limits = StageLimits(None, 1)
+
+# number of workers of every stage of the pipeline executor
+PipelineWorkers = namedtuple('PipelineWorkers', ['cleanup', 'subtitles', 'render'])
+default_pipeline_workers = PipelineWorkers(2, 1, 2)
+
+Stage = namedtuple('Stage', ['name', 'fn', 'workers'])
+
+# set by the render service while it runs a batch, the batch stops starting new stages when the event is set
+current_cancel_event: ContextVar[threading.Event | None] = ContextVar('current_cancel_event', default=None)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def check_cancelled(event: threading.Event | None):
+    """
+    Raises JobCancelled if cancellation of the batch was requested.
+    """
+    if event is not None and event.is_set():
+        raise JobCancelled()
+
+
+# stage semaphores of the current batch, concurrent batches of the render service have their own
+_stage_semaphores: ContextVar[dict] = ContextVar('stage_semaphores', default={})
+
+
+def make_stage_semaphores(stage_limits: StageLimits, executor_type: ExecutorType) -> dict:
+    """
+    Creates semaphores of the limited stages, shared by threads or by processes of a pool.
+    """
+    factory = multiprocessing.BoundedSemaphore if executor_type == ExecutorType.PROCESS else threading.BoundedSemaphore
+    return {stage: factory(limit) for stage, limit in stage_limits._asdict().items() if limit}
+
+
+def init_worker(stage_semaphores: dict, font_path: str = None, subtitles_config: SubtitlesConfig = None,
+                metrics_config: MetricsConfig = None):
+    """
+    Prepares worker before the first job: installs stage semaphores shared by all workers, enables metrics
+    and preloads font and whisper model, so jobs do not pay for it.
+    Semaphores and metrics are set in the current context, threads of the batch must be started in a copy of it.
+    """
+    _stage_semaphores.set(stage_semaphores)
+    configure_metrics(metrics_config)
+    if font_path:
+        load_font(font_path, 60)
+    if subtitles_config:
+        get_whisper_model(subtitles_config)
+
+
+@contextmanager
+def stage_slot(stage: str):
+    """
+    Waits until there is a free slot for the given stage ('encoders', 'transcribers').
+    Does nothing if the stage is not limited.
+    """
+    semaphore = _stage_semaphores.get().get(stage)
+    if semaphore is None:
+        yield
+        return
+    with semaphore:
+        yield
+
+
+def run_jobs(fn: Callable,
+             jobs: dict[str, dict],
+             executor_type: ExecutorType = ExecutorType.THREAD,
+             workers: int = 1,
+             stage_limits: StageLimits = default_stage_limits,
+             font_path: str = None,
+             subtitles_config: SubtitlesConfig = None,
+             metrics_config: MetricsConfig = None) -> dict[str, Exception]:
+    """
+    Runs jobs in a thread or process pool. Jobs are submitted in the given order,
+    so callers should put the longest jobs first to minimize total time.
+    :param fn: module-level function called with keyword arguments of every job
+    :param jobs: job name -> keyword arguments
+    :param executor_type: thread or process pool
+    :param workers: number of workers
+    :param stage_limits: concurrency limits of heavy stages
+    :param font_path: font preloaded by every worker
+    :param subtitles_config: if given, whisper model is preloaded by every worker
+    :param metrics_config: metrics settings of every worker
+    :return: job name -> exception for every failed job
+    """
+    stage_semaphores = make_stage_semaphores(stage_limits, executor_type)
+    initargs = (stage_semaphores, font_path, subtitles_config, metrics_config)
+    if executor_type == ExecutorType.PROCESS:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=initargs)
+    else:
+        init_worker(*initargs)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    failures = {}
+    with executor:
+        if executor_type == ExecutorType.PROCESS:
+            futures = {executor.submit(fn, **kwargs): name for name, kwargs in jobs.items()}
+        else:
+            # thread pool jobs run in the context of the batch, which holds its semaphores and metrics settings
+            futures = {executor.submit(contextvars.copy_context().run, partial(fn, **kwargs)): name
+                       for name, kwargs in jobs.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures[name] = e
+                print(f"Ошибка при обработке {name}: {e!r}")
+    return failures
+
+
+_STOP = object()
+
+
+def run_pipeline(jobs: dict[str, object],
+                 stages: list[Stage],
+                 release: Callable = None,
+                 queue_size: int = 1) -> dict[str, Exception]:
+    """
+    Runs jobs through a sequence of stages connected by bounded queues. Every stage has its own
+    worker threads, so different jobs are in different stages at the same time. A stage blocks when
+    the queue of the next stage is full, which bounds the number of jobs holding intermediate results.
+    :param jobs: job name -> job object passed to every stage function
+    :param stages: stages in the order of execution
+    :param release: called for every job after the last stage or after a failure
+    :param queue_size: capacity of the queue between two stages
+    :return: job name -> exception for every failed job
+    """
+    names = {id(job): name for name, job in jobs.items()}
+    queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in stages[1:]] + [None]
+    for job in jobs.values():
+        queues[0].put(job)
+    queues[0].put(_STOP)
+
+    failures = {}
+    lock = threading.Lock()
+    remaining = [max(1, stage.workers) for stage in stages]
+
+    def finish(job):
+        if release:
+            try:
+                release(job)
+            except Exception as e:
+                print(f"Ошибка при освобождении ресурсов {names[id(job)]}: {e!r}")
+
+    def work(i: int):
+        stage, source, target = stages[i], queues[i], queues[i + 1]
+        while True:
+            job = source.get()
+            if job is _STOP:
+                # let the other workers of this stage see the sentinel too
+                source.put(_STOP)
+                break
+            try:
+                stage.fn(job)
+            except Exception as e:
+                with lock:
+                    failures[names[id(job)]] = e
+                print(f"Ошибка при обработке {names[id(job)]} на этапе {stage.name}: {e!r}")
+                finish(job)
+                continue
+            if target is None:
+                finish(job)
+            else:
+                target.put(job)
+
+        with lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last and target is not None:
+            target.put(_STOP)
+
+    # every thread gets its own copy of the batch context, a context can't be entered by two threads at once
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(work, i), name=f'{stage.name}-{n}',
+                                daemon=True)
+               for i, stage in enumerate(stages) for n in range(remaining[i])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
@@ -0,0 +1,242 @@
+import asyncio
+import collections
+import contextvars
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable
+
+from .scheduler_utils import current_cancel_event
+
+DEFAULT_MAX_QUEUED = 100
+# finished jobs kept for GET /jobs, older ones are forgotten
+DEFAULT_MAX_FINISHED = 1000
+# job specs are small json objects, larger requests are rejected before reading the body
+DEFAULT_MAX_BODY = 1024 * 1024
+
+_REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            409: 'Conflict', 413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+class JobState(str, Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+@dataclass
+class ServiceJob:
+    """
+    Job submitted to the render service: a task in the format of the montage config.
+    """
+    id: str
+    spec: dict
+    state: JobState = JobState.QUEUED
+    submitted: float = field(default_factory=time.time)
+    started: float = None
+    finished: float = None
+    error: str = None
+    result: object = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'state': self.state.value, 'spec': self.spec, 'submitted': self.submitted,
+                'started': self.started, 'finished': self.finished, 'error': self.error, 'result': self.result,
+                'cancel_requested': self.cancel_event.is_set()}
+
+
+class RenderService:
+    """
+    Long-running worker which executes submitted jobs from an in-process queue.
+
+    Jobs run in threads of this process, so whisper models, fonts and rendered layers loaded by one job
+    stay warm for the next ones. At most max_jobs jobs run at the same time, every job is parallelized
+    by its own settings (threads, executor). A running job is cancelled between stages of its videos.
+    Only the last max_finished finished jobs are kept, so a service running for weeks doesn't grow.
+    """
+
+    def __init__(self, handler: Callable[[dict], object], max_jobs: int = 1, max_queued: int = DEFAULT_MAX_QUEUED,
+                 max_finished: int = DEFAULT_MAX_FINISHED, max_body: int = DEFAULT_MAX_BODY):
+        """
+        :param handler: runs a job spec in a worker thread, its return value is stored as the job result
+        :param max_jobs: number of jobs running at the same time
+        :param max_queued: number of waiting jobs, new submits are rejected when the queue is full
+        :param max_finished: number of finished jobs kept for the API, the oldest ones are forgotten
+        :param max_body: max size of a request body in bytes, larger requests get 413
+        """
+        self.handler = handler
+        self.max_jobs = max(1, max_jobs)
+        self.max_queued = max_queued
+        self.max_finished = max(0, max_finished)
+        self.max_body = max_body
+        self.jobs: dict[str, ServiceJob] = {}
+        # ids of finished jobs in the order they finished
+        self._finished = collections.deque()
+        self._queue: asyncio.Queue = None
+        self._executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix='job')
+        self._workers = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.max_jobs)]
+
+    async def stop(self):
+        # running jobs stop after their current stages
+        for job in self.jobs.values():
+            if job.state == JobState.RUNNING:
+                job.cancel_event.set()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    def submit(self, spec: dict) -> ServiceJob:
+        """
+        :raises asyncio.QueueFull: if the queue is full
+        """
+        job = ServiceJob(uuid.uuid4().hex, spec)
+        self._queue.put_nowait(job)
+        self.jobs[job.id] = job
+        return job
+
+    def cancel(self, job_id: str) -> ServiceJob:
+        """
+        Cancels a queued job at once, a running job stops before the next stage of its videos.
+        :raises KeyError: if there is no such job
+        """
+        job = self.jobs[job_id]
+        job.cancel_event.set()
+        if job.state == JobState.QUEUED:
+            job.state = JobState.CANCELLED
+            job.finished = time.time()
+            self._forget_finished(job)
+        return job
+
+    def _forget_finished(self, job: ServiceJob):
+        self._finished.append(job.id)
+        while len(self._finished) > self.max_finished:
+            self.jobs.pop(self._finished.popleft(), None)
+
+    def _run(self, job: ServiceJob):
+        current_cancel_event.set(job.cancel_event)
+        return self.handler(job.spec)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.state != JobState.QUEUED:
+                    continue
+                job.state = JobState.RUNNING
+                job.started = time.time()
+                try:
+                    # a fresh context per job, so the cancel event doesn't leak to the next job of the thread
+                    job.result = await loop.run_in_executor(self._executor, contextvars.copy_context().run,
+                                                            self._run, job)
+                    job.state = JobState.CANCELLED if job.cancel_event.is_set() else JobState.DONE
+                except Exception as e:
+                    job.error = repr(e)
+                    job.state = JobState.CANCELLED if job.cancel_event.is_set() else JobState.FAILED
+                job.finished = time.time()
+                self._forget_finished(job)
+            finally:
+                self._queue.task_done()
+
+    async def handle_request(self, method: str, path: str, body: bytes) -> tuple[int, object]:
+        """
+        Routes a request of the HTTP API:
+            POST /jobs - submit job (JSON body in the format of the montage config)
+            GET /jobs - list jobs, GET /jobs/<id> - status of a job
+            POST /jobs/<id>/cancel or DELETE /jobs/<id> - cancel job
+            GET /health - state of the service
+        :return: status code and JSON-serializable response
+        """
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts == ['health'] and method == 'GET':
+            return 200, {'queued': self._queue.qsize(), 'max_jobs': self.max_jobs,
+                         'running': sum(job.state == JobState.RUNNING for job in self.jobs.values())}
+        if not parts or parts[0] != 'jobs':
+            return 404, {'error': 'not found'}
+        if len(parts) == 1:
+            if method == 'GET':
+                return 200, [job.to_dict() for job in self.jobs.values()]
+            if method == 'POST':
+                try:
+                    spec = json.loads(body or b'{}')
+                except ValueError as e:
+                    return 400, {'error': f'invalid json: {e}'}
+                if not isinstance(spec, dict) or 'task-type' not in spec:
+                    return 400, {'error': 'job must be an object with task-type'}
+                try:
+                    return 201, self.submit(spec).to_dict()
+                except asyncio.QueueFull:
+                    return 429, {'error': 'queue is full'}
+            return 405, {'error': 'method not allowed'}
+        job = self.jobs.get(parts[1])
+        if job is None:
+            return 404, {'error': 'job not found'}
+        if len(parts) == 2 and method == 'GET':
+            return 200, job.to_dict()
+        if (len(parts) == 2 and method == 'DELETE') or (parts[2:] == ['cancel'] and method == 'POST'):
+            if job.state in (JobState.DONE, JobState.FAILED, JobState.CANCELLED):
+                return 409, {'error': f'job is {job.state.value}'}
+            return 200, self.cancel(job.id).to_dict()
+        return 405, {'error': 'method not allowed'}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length = -1
+            if len(request_line) < 2 or length < 0 or 'transfer-encoding' in headers:
+                status, response = 400, {'error': 'bad request'}
+            elif length > self.max_body:
+                # the body is not read, the connection is closed after the response
+                status, response = 413, {'error': f'request body is larger than {self.max_body} bytes'}
+            else:
+                body = await reader.readexactly(length)
+                try:
+                    status, response = await self.handle_request(request_line[0].upper(), request_line[1], body)
+                except Exception as e:
+                    status, response = 500, {'error': repr(e)}
+            payload = json.dumps(response, ensure_ascii=False, default=str).encode('utf-8')
+            writer.write(f'HTTP/1.1 {status} {_REASONS.get(status, "")}\r\n'
+                         f'Content-Type: application/json; charset=utf-8\r\n'
+                         f'Content-Length: {len(payload)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8765, socket_path: str = None):
+        """
+        Starts the workers and serves the HTTP API on a TCP port or on a unix socket until cancelled.
+        """
+        await self.start()
+        if socket_path:
+            server = await asyncio.start_unix_server(self._handle_connection, path=socket_path)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
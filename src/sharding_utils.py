@@ -0,0 +1,195 @@
+import contextvars
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable
+
+from .file_utils import remove_partial_files
+from .manifest_utils import BatchManifest, MANIFEST_NAME, DEFAULT_MAX_ATTEMPTS
+from .metrics_utils import MetricsConfig
+from .planning_utils import BatchPlan
+from .scheduler_utils import ExecutorType, StageLimits, default_stage_limits, JobCancelled, init_worker, \
+    make_stage_semaphores
+from .subtitles_utils import SubtitlesConfig
+
+# config of a sharded batch written by the coordinator, every worker is started with it
+BATCH_CONFIG_NAME = 'montajer-batch.json'
+
+# worker_id - name of the worker process in the manifest (None - host name and pid),
+# heartbeat_interval - seconds between heartbeats of a claimed input,
+# stale_after - seconds without a heartbeat after which the input is taken over by another worker,
+# poll_interval - seconds between claims while other workers finish the last inputs
+ShardConfig = namedtuple('ShardConfig', ['worker_id', 'heartbeat_interval', 'stale_after', 'poll_interval'])
+default_shard_config = ShardConfig(None, 10.0, 60.0, 5.0)
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def shared_manifest(output_folder: str) -> BatchManifest:
+    return BatchManifest(os.path.join(output_folder, MANIFEST_NAME), shared=True)
+
+
+def prepare_sharded_batch(output_folder: str, resume: bool = False) -> BatchManifest:
+    """
+    Prepares the output folder before workers start: deletes partial files of interrupted runs and,
+    unless the batch is resumed, forgets the previous batch. Workers never do it, they would delete
+    files and progress of each other.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    removed = remove_partial_files(output_folder)
+    if removed:
+        print(f"Удалено недописанных файлов: {len(removed)}")
+    manifest = shared_manifest(output_folder)
+    if not resume:
+        manifest.reset()
+    return manifest
+
+
+def register_plan(manifest: BatchManifest, plan: BatchPlan):
+    """
+    Adds valid inputs of the plan to the work table, longest audio is claimed first.
+    State of inputs registered by the coordinator or by other workers is kept.
+    """
+    for video in plan.valid_videos:
+        manifest.register(video.audio_path, video.audio_path, video.output_path, priority=video.duration)
+
+
+@contextmanager
+def heartbeat(manifest: BatchManifest, name: str, worker: str, interval: float, cancel_event: threading.Event,
+              parent_event: threading.Event = None):
+    """
+    Sends heartbeats of a claimed input from a background thread.
+    Sets cancel_event when the input was taken over by another worker or parent_event is set,
+    the job stops before its next stage.
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            try:
+                owned = manifest.heartbeat(name, worker)
+            except sqlite3.Error as e:
+                # a busy shared folder delays a heartbeat, the next one is sent in time
+                print(f"Не удалось отправить heartbeat {name}: {e!r}")
+                continue
+            if not owned or (parent_event is not None and parent_event.is_set()):
+                cancel_event.set()
+
+    thread = threading.Thread(target=beat, name=f'heartbeat-{worker}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_sharded(fn: Callable,
+                jobs: dict[str, dict],
+                manifest: BatchManifest,
+                workers: int = 1,
+                shard_config: ShardConfig = default_shard_config,
+                max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                stage_limits: StageLimits = default_stage_limits,
+                font_path: str = None,
+                subtitles_config: SubtitlesConfig = None,
+                metrics_config: MetricsConfig = None,
+                cancel_event: threading.Event = None) -> dict[str, Exception]:
+    """
+    Runs jobs of a sharded batch: instead of taking its own list of jobs the process claims them one by one
+    from the shared manifest, together with worker processes on other hosts. Every thread is a separate
+    worker in the manifest. Workers exit when nothing is left to claim and no live worker holds an input
+    which could still be taken over.
+    :param fn: function called with keyword arguments of every job, it accepts cancel_event and worker
+    :param jobs: job name (name of the input in the manifest) -> keyword arguments
+    :param workers: number of threads claiming jobs
+    :param cancel_event: cancellation of the batch: workers stop claiming inputs, inputs they process
+        are returned to the queue without using an attempt
+    :return: job name -> exception for every job which failed in this process
+    """
+    worker_id = shard_config.worker_id or default_worker_id()
+    init_worker(make_stage_semaphores(stage_limits, ExecutorType.THREAD), font_path, subtitles_config,
+                metrics_config)
+    failures = {}
+
+    def work(slot: int):
+        worker = f'{worker_id}/{slot}'
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            item = manifest.claim(worker, max_attempts, shard_config.stale_after)
+            if item is None:
+                if not manifest.active(shard_config.stale_after):
+                    return
+                # inputs of live workers are taken over if they stop sending heartbeats
+                time.sleep(shard_config.poll_interval)
+                continue
+            name = item['name']
+            if name not in jobs:
+                manifest.stage_failed(name, 'claim', f'input is not available to worker {worker}', worker)
+                continue
+            job_event = threading.Event()
+            with heartbeat(manifest, name, worker, shard_config.heartbeat_interval, job_event, cancel_event):
+                try:
+                    fn(**{**jobs[name], 'cancel_event': job_event, 'worker': worker})
+                except JobCancelled:
+                    if cancel_event is not None and cancel_event.is_set():
+                        manifest.release(name, worker)
+                        print(f"{name} возвращен в очередь: пакет отменен")
+                    else:
+                        print(f"{name} передан другому обработчику")
+                except Exception as e:
+                    failures[name] = e
+                    print(f"Ошибка при обработке {name}: {e!r}")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='shard') as executor:
+        # workers run in copies of the batch context, which holds its semaphores and metrics settings
+        for future in [executor.submit(contextvars.copy_context().run, work, slot) for slot in range(max(1, workers))]:
+            future.result()
+    return failures
+
+
+BatchProgress = namedtuple('BatchProgress', ['total', 'done', 'running', 'failed', 'pending', 'retryable',
+                                             'done_duration', 'total_duration', 'workers'])
+
+
+def batch_progress(manifest: BatchManifest, max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> BatchProgress:
+    """
+    Aggregates state of all inputs of a sharded batch.
+    """
+    progress = manifest.progress(max_attempts)
+    states = progress['states']
+
+    def count(state: str) -> int:
+        return states.get(state, (0, 0))[0]
+
+    return BatchProgress(sum(value[0] for value in states.values()), count('done'), count('running'),
+                         count('failed'), count('pending'), progress['retryable'],
+                         states.get('done', (0, 0.0))[1], sum(value[1] for value in states.values()),
+                         progress['workers'])
+
+
+def format_progress(progress: BatchProgress, elapsed: float, done_since_start: int = None,
+                    duration_since_start: float = None) -> str:
+    """
+    :param elapsed: seconds since the coordinator started
+    :param done_since_start: videos finished since the coordinator started (resumed batches have done videos)
+    :param duration_since_start: seconds of audio of these videos
+    """
+    done_since_start = progress.done if done_since_start is None else done_since_start
+    duration_since_start = progress.done_duration if duration_since_start is None else duration_since_start
+    minutes = max(elapsed, 1e-9) / 60
+    rate = done_since_start / minutes
+    line = (f"Готово {progress.done}/{progress.total}, в работе {progress.running}, ошибок {progress.failed}, "
+            f"{rate:.1f} видео/мин, {duration_since_start / 60 / minutes:.1f} мин аудио/мин")
+    remaining = progress.total - progress.done - progress.failed + progress.retryable
+    if rate > 0 and remaining > 0:
+        line += f", осталось ~{remaining / rate:.1f} мин"
+    return line
@@ -1,76 +1,330 @@
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from typing import Iterable, Iterator, TextIO
 
 from faster_whisper import WhisperModel
+from PIL import ImageFont
 
 SubtitleEntry = namedtuple('WordTimestamp', ['start', 'end', 'word'])
 
 
-class SubtitleFormat(Enum):
-    SRT = 1,
+class SubtitleFormat(str, Enum):
+    SRT = 'srt'
+    VTT = 'vtt'
+    ASS = 'ass'
 
 
-SubtitlesConfig = namedtuple('SubtitlesConfig', ['max_line_width', 'max_line_count', 'model', 'language'])
+# max_cue_duration - max time a cue stays on screen, split_pause - a pause between words this long starts a new cue,
+# split_on_punctuation - a word ending a sentence ends the cue (None / False disables these rules)
+SubtitlesConfig = namedtuple('SubtitlesConfig',
+                             ['max_line_width', 'max_line_count', 'model', 'language',
+                              'device', 'compute_type', 'cpu_threads', 'num_workers',
+                              'max_cue_duration', 'split_pause', 'split_on_punctuation'],
+                             defaults=['auto', None, 0, 1, 7.0, 1.0, True])
 default_subtitle_config = SubtitlesConfig(25, 2, 'base', None)
 
+SENTENCE_END = ('.', '!', '?', '…')
 
-def generate_word_timestamps(audio_path: str, model, language) -> list[SubtitleEntry]:
+# style of burned subtitles: size relative to the shorter side of the video, margin from the bottom
+ASS_FONT_SCALE = 0.055
+ASS_MARGIN_SCALE = 0.05
+
+# max number of whisper models kept in memory, least recently used one is evicted
+MAX_LOADED_MODELS = 2
+
+_loaded_models = OrderedDict()
+_loaded_models_lock = threading.Lock()
+# requested key -> key of the cpu model used instead after a failed load
+_fallback_keys = {}
+
+
+def _cuda_available() -> bool:
+    try:
+        import ctranslate2
+        return ctranslate2.get_cuda_device_count() > 0
+    except Exception:
+        return False
+
+
+def _resolve_device(device: str, compute_type: str) -> tuple[str, str]:
+    if device == 'auto':
+        device = 'cuda' if _cuda_available() else 'cpu'
+    if not compute_type:
+        compute_type = 'float16' if device == 'cuda' else 'int8'
+    return device, compute_type
+
+
+def _get_or_load(key: tuple) -> WhisperModel:
+    if key in _loaded_models:
+        _loaded_models.move_to_end(key)
+        return _loaded_models[key]
+    model, device, compute_type, cpu_threads, num_workers = key
+    instance = WhisperModel(model, device=device, compute_type=compute_type,
+                            cpu_threads=cpu_threads, num_workers=num_workers)
+    _loaded_models[key] = instance
+    while len(_loaded_models) > MAX_LOADED_MODELS:
+        _loaded_models.popitem(last=False)
+    return instance
+
+
+def load_whisper_model(model: str, device: str = 'auto', compute_type: str = None,
+                       cpu_threads: int = 0, num_workers: int = 1) -> WhisperModel:
     """
-    Generate subtitles for the given audio file using faster-whisper.
-    :param audio_path: Path to the audio file.
-    :return: Subtitles as a string.
+    Returns whisper model from the process-wide registry, loading it on first use.
+    The same instance is shared between files and threads.
+    If the model can't be loaded on cuda, it falls back to cpu with int8 quantization.
+    :param model: model size or path
+    :param device: 'auto', 'cuda' or 'cpu'. 'auto' picks cuda if a cuda device is available
+    :param compute_type: ctranslate2 compute type. If None, float16 is used on cuda and int8 on cpu
+    :param cpu_threads: number of threads used on cpu (0 - ctranslate2 default)
+    :param num_workers: number of transcriptions which can run in parallel from different threads
     """
-    model = WhisperModel(model, device="cuda", compute_type="float16")
-    segments, info = model.transcribe(audio_path, language=language, word_timestamps=True)
+    device, compute_type = _resolve_device(device, compute_type)
+    key = (model, device, compute_type, cpu_threads, num_workers)
+    with _loaded_models_lock:
+        if key in _fallback_keys:
+            return _get_or_load(_fallback_keys[key])
+        try:
+            return _get_or_load(key)
+        except (RuntimeError, ValueError) as e:
+            if device == 'cpu':
+                raise
+            print(f"Не удалось загрузить модель {model} на {device} ({e}), используется cpu")
+            _fallback_keys[key] = (model, 'cpu', 'int8', cpu_threads, num_workers)
+            return _get_or_load(_fallback_keys[key])
+
+
+def get_whisper_model(subtitles_config: SubtitlesConfig) -> WhisperModel:
+    return load_whisper_model(subtitles_config.model, subtitles_config.device, subtitles_config.compute_type,
+                              subtitles_config.cpu_threads, subtitles_config.num_workers)
+
+
+def iter_word_timestamps(audio_path, model, language,
+                         speech_segments: list[tuple[float, float]] = None) -> Iterator[SubtitleEntry]:
+    """
+    Transcribes audio with faster-whisper. Words are yielded as soon as whisper decodes their segment,
+    so subtitles can be written while transcription is still running.
+    :param audio_path: Path to the audio file or 16kHz mono float32 samples array.
+    :param model: model size or already loaded WhisperModel
+    :param speech_segments: (start, end) of speech in seconds. If given, only these parts of audio are transcribed
+    :return: iterator of words with timestamps
+    """
+    if isinstance(model, str):
+        model = load_whisper_model(model)
+    if speech_segments is None:
+        segments, info = model.transcribe(audio_path, language=language, word_timestamps=True)
+    elif not speech_segments:
+        return
+    else:
+        clip_timestamps = [timestamp for segment in speech_segments for timestamp in segment]
+        segments, info = model.transcribe(audio_path, language=language, word_timestamps=True,
+                                          clip_timestamps=clip_timestamps, vad_filter=False)
 
-    word_timestamps = []
     for segment in segments:
         for word in segment.words:
-            word_timestamps.append(SubtitleEntry(word.start, word.end, word.word.strip()))
-    return word_timestamps
+            yield SubtitleEntry(word.start, word.end, word.word.strip())
 
 
-def generate_subtitles(word_timestamps: list[SubtitleEntry],
-                       max_line_width=25,
-                       max_line_count=2) -> list[SubtitleEntry]:
-    subtitles = []
-    curr_entry = word_timestamps[0]
+def iter_chunked_word_timestamps(chunks: Iterable[tuple[float, object]], model, language) -> Iterator[SubtitleEntry]:
+    """
+    Transcribes audio split into chunks one by one, see iter_word_timestamps.
+    :param chunks: chunk start in seconds and 16kHz mono float32 samples of the chunk
+    :return: iterator of words with timestamps relative to the start of the audio
+    """
+    if isinstance(model, str):
+        model = load_whisper_model(model)
+    for offset, samples in chunks:
+        for word in iter_word_timestamps(samples, model, language):
+            yield SubtitleEntry(word.start + offset, word.end + offset, word.word)
 
-    for i in range(1, len(word_timestamps)):
-        word_timestamp = word_timestamps[i]
 
-        last_line = curr_entry.word.split('\n')[-1]
-        if len(last_line + " " + word_timestamp.word) <= max_line_width:
-            curr_entry = SubtitleEntry(curr_entry.start, word_timestamp.end,
-                                       curr_entry.word + ' ' + word_timestamp.word)
-        else:
-            line_count = curr_entry.word.count('\n') + 1
-            if line_count < max_line_count:
-                curr_entry = SubtitleEntry(curr_entry.start, word_timestamp.end,
-                                           curr_entry.word + "\n" + word_timestamp.word)
+def generate_word_timestamps(audio_path, model, language,
+                             speech_segments: list[tuple[float, float]] = None) -> list[SubtitleEntry]:
+    """
+    Generate subtitles for the given audio file using faster-whisper, see iter_word_timestamps.
+    :return: list of words with timestamps
+    """
+    return list(iter_word_timestamps(audio_path, model, language, speech_segments))
+
+
+def transcribe_batch(audios: list[str] | dict[str, object],
+                     subtitles_config: SubtitlesConfig = default_subtitle_config,
+                     speech_segments: dict[str, list[tuple[float, float]]] = None) -> dict[str, list[SubtitleEntry]]:
+    """
+    Transcribes many audiofiles with one shared model. Up to subtitles_config.num_workers files
+    are transcribed in parallel by the model.
+    :param audios: paths to audiofiles or name -> path or 16kHz mono float32 samples array
+    :param subtitles_config: whisper model parameters
+    :param speech_segments: name -> precomputed speech segments of the audio (absent - transcribe the whole audio)
+    :return: name (path) -> word timestamps of the audio, in the order of audios
+    """
+    if not isinstance(audios, dict):
+        audios = {path: path for path in audios}
+    model = get_whisper_model(subtitles_config)
+    speech_segments = speech_segments or {}
+
+    def transcribe(name: str) -> list[SubtitleEntry]:
+        return generate_word_timestamps(audios[name], model, subtitles_config.language, speech_segments.get(name))
+
+    with ThreadPoolExecutor(max_workers=max(1, subtitles_config.num_workers)) as executor:
+        return dict(zip(audios, executor.map(transcribe, audios)))
+
+
+def iter_subtitles(word_timestamps: Iterable[SubtitleEntry],
+                   max_line_width=25,
+                   max_line_count=2,
+                   max_cue_duration: float = None,
+                   split_pause: float = None,
+                   split_on_punctuation: bool = False) -> Iterator[SubtitleEntry]:
+    """
+    Groups words into cues of at most max_line_count lines of at most max_line_width characters
+    (a single longer word takes a line of its own). Words are consumed one by one and every cue
+    is yielded as soon as it is complete, width of the current line is tracked incrementally.
+    :param word_timestamps: words with timestamps, may be a lazy iterator
+    :param max_cue_duration: a word which would make the cue longer starts a new cue
+    :param split_pause: a pause between two words at least this long starts a new cue
+    :param split_on_punctuation: a word ending with sentence punctuation ends the cue
+    :return: iterator of cues, lines of a cue are separated by newline
+    """
+    lines = []
+    start = end = None
+    line_width = 0
+    sentence_ended = False
+
+    for word in word_timestamps:
+        if lines:
+            if sentence_ended or \
+                    (split_pause is not None and word.start - end >= split_pause) or \
+                    (max_cue_duration and word.end - start > max_cue_duration):
+                yield SubtitleEntry(start, end, '\n'.join(' '.join(line) for line in lines))
+                lines = []
+            elif line_width + 1 + len(word.word) <= max_line_width:
+                lines[-1].append(word.word)
+                line_width += 1 + len(word.word)
+            elif len(lines) < max_line_count:
+                lines.append([word.word])
+                line_width = len(word.word)
             else:
-                subtitles.append(curr_entry)
-                curr_entry = word_timestamp
+                yield SubtitleEntry(start, end, '\n'.join(' '.join(line) for line in lines))
+                lines = []
+        if not lines:
+            lines = [[word.word]]
+            start = word.start
+            line_width = len(word.word)
+        end = word.end
+        sentence_ended = split_on_punctuation and word.word.endswith(SENTENCE_END)
 
-    subtitles.append(curr_entry)
+    if lines:
+        yield SubtitleEntry(start, end, '\n'.join(' '.join(line) for line in lines))
 
-    return subtitles
 
+def generate_subtitles(word_timestamps: Iterable[SubtitleEntry],
+                       max_line_width=25,
+                       max_line_count=2,
+                       max_cue_duration: float = None,
+                       split_pause: float = None,
+                       split_on_punctuation: bool = False) -> list[SubtitleEntry]:
+    return list(iter_subtitles(word_timestamps, max_line_width, max_line_count, max_cue_duration, split_pause,
+                               split_on_punctuation))
 
-def write_srt_file(output_path: str, word_timestamps: list[SubtitleEntry]):
-    def format_time(seconds: float) -> str:
-        millis = int((seconds - int(seconds)) * 1000)
-        total_seconds = int(seconds)
-        hours = total_seconds // 3600
-        minutes = (total_seconds % 3600) // 60
-        seconds = total_seconds % 60
 
+def _split_time(seconds: float) -> tuple[int, int, int, int]:
+    millis = int(round(seconds * 1000))
+    return millis // 3_600_000, millis // 60_000 % 60, millis // 1000 % 60, millis % 1000
+
+
+def _write_srt(f: TextIO, subtitles: Iterable[SubtitleEntry]):
+    def format_time(seconds: float) -> str:
+        hours, minutes, seconds, millis = _split_time(seconds)
         return f"{hours:02}:{minutes:02}:{seconds:02},{millis:03}"
 
+    for i, subtitle in enumerate(subtitles):
+        f.write(f'{i + 1}\n{format_time(subtitle.start)} --> {format_time(subtitle.end)}\n{subtitle.word}\n\n')
+
+
+def _write_vtt(f: TextIO, subtitles: Iterable[SubtitleEntry]):
+    def format_time(seconds: float) -> str:
+        hours, minutes, seconds, millis = _split_time(seconds)
+        return f"{hours:02}:{minutes:02}:{seconds:02}.{millis:03}"
+
+    f.write('WEBVTT\n\n')
+    for subtitle in subtitles:
+        f.write(f'{format_time(subtitle.start)} --> {format_time(subtitle.end)}\n{subtitle.word}\n\n')
+
+
+def _ass_font(font_path: str) -> tuple[str, bool]:
+    """
+    :return: font family name and whether the font is bold
+    """
+    family, style = ImageFont.truetype(font_path, 10).getname()
+    return family, 'bold' in style.lower()
+
+
+def _write_ass(f: TextIO, subtitles: Iterable[SubtitleEntry], font_path: str = None,
+               video_size: tuple[int, int] = (1920, 1080)):
+    def format_time(seconds: float) -> str:
+        hours, minutes, seconds, millis = _split_time(seconds)
+        return f"{hours}:{minutes:02}:{seconds:02}.{millis // 10:02}"
+
+    family, bold = _ass_font(font_path) if font_path else ('Arial', True)
+    width, height = video_size
+    font_size = round(min(width, height) * ASS_FONT_SCALE)
+    margin = round(height * ASS_MARGIN_SCALE)
+    f.write('[Script Info]\n'
+            'ScriptType: v4.00+\n'
+            f'PlayResX: {width}\n'
+            f'PlayResY: {height}\n'
+            'WrapStyle: 2\n'
+            'ScaledBorderAndShadow: yes\n\n'
+            '[V4+ Styles]\n'
+            'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, '
+            'Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, '
+            'MarginL, MarginR, MarginV, Encoding\n'
+            f'Style: Default,{family},{font_size},&H00FFFFFF,&H000000FF,&H00000000,&H80000000,{-1 if bold else 0},'
+            f'0,0,0,100,100,0,0,1,{max(1, font_size // 15)},0,2,{margin},{margin},{margin},1\n\n'
+            '[Events]\n'
+            'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n')
+    for subtitle in subtitles:
+        text = subtitle.word.replace('{', '\\{').replace('}', '\\}').replace('\n', '\\N')
+        f.write(f'Dialogue: 0,{format_time(subtitle.start)},{format_time(subtitle.end)},Default,,0,0,0,,{text}\n')
+
+
+def write_srt_file(output_path: str, word_timestamps: Iterable[SubtitleEntry]):
     with open(output_path, 'w', encoding='utf-8') as f:
-        for i, word_timestamp in enumerate(word_timestamps):
-            srt_entry = f'{i + 1}\n{format_time(word_timestamp.start)} --> {format_time(word_timestamp.end)}\n{word_timestamp.word}\n\n'
-            f.write(srt_entry)
+        _write_srt(f, word_timestamps)
+
+
+def write_subtitles(word_timestamps: Iterable[SubtitleEntry],
+                    output_path: str,
+                    subtitle_format: SubtitleFormat,
+                    subtitles_config: SubtitlesConfig = default_subtitle_config,
+                    font_path: str = None,
+                    video_size: tuple[int, int] = (1920, 1080)):
+    """
+    Groups word timestamps into subtitles and writes them to file. Words may be a lazy iterator,
+    every cue is written as soon as it is complete.
+    :param word_timestamps: words with timestamps returned by iter_word_timestamps / generate_word_timestamps
+    :param output_path: Path to the output subtitle file
+    :param subtitle_format: Enum, Output subtitle file format
+    :param subtitles_config
+    :param font_path: font of ASS subtitles
+    :param video_size: size of the video ASS subtitles are drawn on
+    """
+    subtitles = iter_subtitles(word_timestamps, subtitles_config.max_line_width, subtitles_config.max_line_count,
+                               subtitles_config.max_cue_duration, subtitles_config.split_pause,
+                               subtitles_config.split_on_punctuation)
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        if subtitle_format == SubtitleFormat.SRT:
+            _write_srt(f, subtitles)
+        elif subtitle_format == SubtitleFormat.VTT:
+            _write_vtt(f, subtitles)
+        elif subtitle_format == SubtitleFormat.ASS:
+            _write_ass(f, subtitles, font_path, video_size)
+        else:
+            raise ValueError(f'unknown subtitle format')
 
 
 def write_subtitle_file(audio_path: str,
@@ -85,15 +339,28 @@ def write_subtitle_file(audio_path: str,
     :param subtitles_config
     """
 
-    word_timestamps = generate_word_timestamps(audio_path, subtitles_config.model, subtitles_config.language)
+    word_timestamps = iter_word_timestamps(audio_path, get_whisper_model(subtitles_config), subtitles_config.language)
 
-    subtitles = generate_subtitles(word_timestamps, subtitles_config.max_line_width, subtitles_config.max_line_count)
+    write_subtitles(word_timestamps, output_path, subtitle_format, subtitles_config)
 
-    if subtitle_format == SubtitleFormat.SRT:
-        write_srt_file(output_path, subtitles)
-    else:
-        raise ValueError(f'unknown subtitle format')
 
+def write_subtitle_files(audio_paths: list[str],
+                         output_paths: list[str],
+                         subtitle_format: SubtitleFormat,
+                         subtitles_config: SubtitlesConfig = default_subtitle_config,
+                         speech_segments: list[list[tuple[float, float]]] = None):
+    """
+    Generates subtitles for many audiofiles with one shared model, see transcribe_batch.
+    :param audio_paths: Paths to the audio files.
+    :param output_paths: Paths to the output subtitle files, one for every audio file
+    :param subtitle_format: Enum, Output subtitle file format
+    :param subtitles_config
+    :param speech_segments: precomputed speech segments for every audio file
+    """
+    word_timestamps = transcribe_batch(audio_paths, subtitles_config,
+                                       dict(zip(audio_paths, speech_segments)) if speech_segments else None)
+    for audio_path, output_path in zip(audio_paths, output_paths):
+        write_subtitles(word_timestamps[audio_path], output_path, subtitle_format, subtitles_config)
 
 if __name__ == '__main__':
     write_subtitle_file('../examples/audio/123.mp3', '../examples/audio/123.srt', SubtitleFormat.SRT)
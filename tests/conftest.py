@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+from benchmarks.fixtures import tone_bursts, random_image
+from src.ffmpeg_utils import encode_audio
+
+
+@pytest.fixture
+def batch_folders(tmp_path):
+    """
+    Folders of a small batch: three short mp3 files with silence gaps and three background images.
+    :return: audio folder, images folder, output folder
+    """
+    audio_folder, images_folder = str(tmp_path / 'audio'), str(tmp_path / 'images')
+    os.makedirs(audio_folder)
+    for i, duration in enumerate((6, 5, 4)):
+        fixture = tone_bursts(duration, 16000, seed=i)
+        encode_audio(fixture.samples, fixture.rate, os.path.join(audio_folder, f'audio_{i}.mp3'))
+    for i in range(3):
+        random_image(os.path.join(images_folder, f'image_{i}.jpg'), (320, 240), seed=i)
+    return audio_folder, images_folder, str(tmp_path / 'out')
@@ -0,0 +1,82 @@
+import errno
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from src import audio_utils
+from src.audio_utils import AudioBuffer, spill_dir
+
+
+def blocks(count: int = 5, size: int = 1000, channels: int = 2) -> list[np.ndarray]:
+    rng = np.random.default_rng(0)
+    return [rng.integers(-20000, 20000, (size, channels), dtype=np.int16) for _ in range(count)]
+
+
+def test_spill_dir_falls_back_when_shm_is_short():
+    assert spill_dir(2 ** 62) == tempfile.gettempdir()
+
+
+def test_from_chunks_is_memory_mapped():
+    chunks = blocks()
+    audio = AudioBuffer.from_chunks(iter(chunks), 16000, 2, max_size=sum(chunk.nbytes for chunk in chunks))
+    try:
+        assert isinstance(audio.samples, np.memmap)
+        assert np.array_equal(audio.samples, np.concatenate(chunks))
+    finally:
+        spill_path = audio.spill_path
+        audio.close()
+    assert not os.path.exists(spill_path)
+
+
+def test_from_chunks_moves_to_temp_dir_when_shm_is_full(tmp_path, monkeypatch):
+    shm_dir = str(tmp_path / 'shm')
+    os.makedirs(shm_dir)
+    monkeypatch.setattr(audio_utils, 'SHM_DIR', shm_dir)
+    monkeypatch.setattr(audio_utils, 'spill_dir', lambda size: shm_dir)
+    write_all = audio_utils._write_all
+    written = []
+
+    def write_with_limit(f, data):
+        # /dev/shm is full after two blocks, the third one is written partially
+        if len(written) == 2:
+            written.append(0)
+            f.write(data[:100])
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        write_all(f, data)
+        written.append(len(data))
+
+    monkeypatch.setattr(audio_utils, '_write_all', write_with_limit)
+    chunks = blocks()
+    audio = AudioBuffer.from_chunks(iter(chunks), 16000, 2)
+    try:
+        assert os.path.dirname(audio.spill_path) == tempfile.gettempdir()
+        assert np.array_equal(audio.samples, np.concatenate(chunks))
+        assert os.listdir(shm_dir) == []
+    finally:
+        audio.close()
+
+
+def test_empty_chunks():
+    audio = AudioBuffer.from_chunks(iter([]), 16000, 2)
+    assert audio.samples.shape == (0, 2)
+    assert audio.spill_path is None
+
+
+def test_whisper_chunks_end_in_pauses():
+    rate = 8000
+    rng = np.random.default_rng(0)
+    # 3s of noise, 0.3s of silence, 3s of noise: the nominal chunk end at 3.5s falls into the noise
+    noise = rng.integers(-20000, 20000, (3 * rate, 1), dtype=np.int16)
+    samples = np.concatenate((noise, np.zeros((int(0.3 * rate), 1), dtype=np.int16), noise))
+    audio = AudioBuffer.from_samples(samples, rate)
+    chunks = list(audio.whisper_chunks(chunk_duration=3.5, search_duration=1.0))
+    starts = [start for start, _ in chunks]
+    assert starts[0] == 0
+    assert 3.0 <= starts[1] <= 3.3
+    assert sum(len(chunk) for _, chunk in chunks) == pytest.approx(len(audio.whisper_samples()), abs=len(chunks))
+    for start, chunk in chunks:
+        assert chunk.dtype == np.float32
+        assert len(chunk) == pytest.approx(16000 * (next((s for s in starts if s > start), audio.duration) - start),
+                                           abs=1)
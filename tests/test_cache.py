@@ -0,0 +1,96 @@
+import os
+import pickle
+import shutil
+
+import pytest
+
+from src import montajer_utils
+from src.cache_utils import ArtifactCache
+from src.montajer_utils import create_videos_with_image, RenderBackend
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                  reason='ffmpeg is not installed')
+
+
+def artifact(tmp_path, name: str, size: int) -> str:
+    path = str(tmp_path / name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+
+def test_key_depends_on_content_and_params(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    first, second = artifact(tmp_path, 'a.bin', 10), artifact(tmp_path, 'b.bin', 10)
+    # paths are ignored, content is hashed
+    assert cache.key([first], x=1) == cache.key([second], x=1)
+    assert cache.key([first], x=1) != cache.key([first], x=2)
+    with open(second, 'ab') as f:
+        f.write(b'y')
+    assert cache.key([first], x=1) != cache.key([second], x=1)
+
+
+def test_get_returns_put_artifacts(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    key = cache.key(x=1)
+    assert cache.get('audio', key, '.wav') is None
+    path = cache.put('audio', key, '.wav', artifact(tmp_path, 'a.wav', 100))
+    assert cache.get('audio', key, '.wav') == path
+    cache.put_json('words', key, [{'word': 'a'}])
+    assert cache.get_json('words', key) == [{'word': 'a'}]
+    assert cache.stats()['audio'] == {'count': 1, 'size': 100}
+
+
+def test_put_scans_the_cache_only_over_the_limit(tmp_path, monkeypatch):
+    cache = ArtifactCache(str(tmp_path / 'cache'), max_size=250)
+    scans = []
+    artifacts = cache._artifacts
+    monkeypatch.setattr(cache, '_artifacts', lambda: scans.append(1) or artifacts())
+    keys = [cache.key(i=i) for i in range(4)]
+    for i, key in enumerate(keys[:2]):
+        os.utime(cache.put('video', key, '.mp4', artifact(tmp_path, f'{i}.mp4', 100)), (i, i))
+    # the first put counts the existing artifacts, the next ones only add their size
+    assert len(scans) == 1
+    cache.put('video', keys[2], '.mp4', artifact(tmp_path, '2.mp4', 100))
+    # over the limit: the least recently used artifact is evicted
+    assert len(scans) == 2
+    assert cache.get('video', keys[0], '.mp4') is None
+    assert cache.get('video', keys[1], '.mp4') is not None
+    assert cache.stats()['video']['size'] == 200
+
+
+def test_cache_is_passed_to_process_workers(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'), max_size=1000)
+    key = cache.key([artifact(tmp_path, 'a.bin', 10)])
+    restored = pickle.loads(pickle.dumps(cache))
+    assert (restored.cache_dir, restored.max_size) == (cache.cache_dir, cache.max_size)
+    assert restored.key([str(tmp_path / 'a.bin')]) == key
+
+
+@needs_ffmpeg
+def test_rerun_of_unchanged_batch_is_taken_from_cache(tmp_path, batch_folders, monkeypatch):
+    audio_folder, images_folder, output_folder = batch_folders
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    cleanups, renders = [], []
+    clean_audio, export_still_video = montajer_utils._clean_audio, montajer_utils.export_still_video
+    monkeypatch.setattr(montajer_utils, '_clean_audio', lambda *args: cleanups.append(args[0]) or clean_audio(*args))
+    monkeypatch.setattr(montajer_utils, 'export_still_video',
+                        lambda *args: renders.append(args[1]) or export_still_video(*args))
+
+    def run():
+        failures = create_videos_with_image(audio_folder, images_folder, output_folder, 'caption', threads=2,
+                                            render_backend=RenderBackend.FFMPEG, cache=cache)
+        assert failures == {}
+
+    run()
+    assert len(cleanups) == len(renders) == 3
+    first_outputs = {name: os.path.getsize(os.path.join(output_folder, name)) for name in os.listdir(output_folder)
+                     if name.endswith('.mp4')}
+    shutil.rmtree(output_folder)
+    # a new cache object, as in the next nightly run
+    cache = ArtifactCache(cache.cache_dir)
+    run()
+    # every video of the second run is copied from the cache, nothing is cleaned or rendered again
+    assert len(cleanups) == len(renders) == 3
+    assert {name: os.path.getsize(os.path.join(output_folder, name)) for name in os.listdir(output_folder)
+            if name.endswith('.mp4')} == first_outputs
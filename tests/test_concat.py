@@ -0,0 +1,87 @@
+import shutil
+import subprocess
+
+import pytest
+
+from src import montajer_utils
+from src.encoder_utils import ENCODER_PROFILES, EncoderProfileName, parse_h264_params, stream_args, video_args
+from src.ffmpeg_utils import parameter_sets, probe_media, split_nal_units, nal_type
+from src.montajer_utils import concat_videos
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                reason='ffmpeg is not installed')
+
+# sources encoded with settings other than the ones of the built-in profiles
+SOURCE_SETTINGS = {
+    'ultrafast': ['-preset', 'ultrafast'],
+    'medium': ['-preset', 'medium'],
+    'main-crf30': ['-preset', 'slow', '-tune', 'film', '-profile:v', 'main', '-crf', '30'],
+}
+
+
+def encode(path: str, args: list[str], size: str = '320x240', rate: int = 24, duration: float = 6,
+           tone: int = 440):
+    command = ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=s={size}:r={rate}:d={duration}',
+               '-f', 'lavfi', '-i', f'sine=f={tone}:d={duration}', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+               '-g', str(2 * rate), *args, '-c:a', 'aac', '-shortest', path]
+    subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return path
+
+
+def stream_parameter_sets(path: str) -> set[bytes]:
+    """
+    All distinct SPS and PPS of the file: the ones of the mp4 header and the ones repeated before keyframes.
+    """
+    command = ['ffmpeg', '-v', 'error', '-i', path, '-map', '0:v:0', '-c', 'copy', '-bsf:v', 'h264_mp4toannexb',
+               '-f', 'h264', '-']
+    stream = subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout
+    return {nal for nal in split_nal_units(stream) if nal_type(nal, 'h264') in (7, 8)}
+
+
+@pytest.mark.parametrize('source', list(SOURCE_SETTINGS))
+@pytest.mark.parametrize('profile_name', list(EncoderProfileName))
+def test_stream_args_reproduce_parameter_sets(tmp_path, source, profile_name):
+    source_path = encode(str(tmp_path / 'source.mp4'), SOURCE_SETTINGS[source], duration=2)
+    sets = parameter_sets(source_path, 'h264')
+    assert parse_h264_params(sets) is not None
+    profile = ENCODER_PROFILES[profile_name]
+    part_path = encode(str(tmp_path / 'part.mp4'),
+                       video_args(profile, keep_frame_rate=True) + stream_args(profile, sets), duration=1)
+    assert parameter_sets(part_path, 'h264') == sets
+
+
+def test_parse_h264_params(tmp_path):
+    baseline = parse_h264_params(parameter_sets(encode(str(tmp_path / 'a.mp4'), ['-preset', 'ultrafast'], duration=1),
+                                                'h264'))
+    assert (baseline.profile_idc, baseline.cabac, baseline.transform_8x8) == (66, 0, 0)
+    high = parse_h264_params(parameter_sets(encode(str(tmp_path / 'b.mp4'), ['-preset', 'medium', '-crf', '27'],
+                                                   duration=1), 'h264'))
+    assert (high.profile_idc, high.ref, high.cabac, high.init_qp, high.transform_8x8) == (100, 3, 1, 27, 1)
+    assert parse_h264_params([]) is None
+
+
+@pytest.fixture
+def videos(tmp_path):
+    # main videos with CAVLC and an intro of another size: the default profile would write CABAC parts
+    intro = encode(str(tmp_path / 'intro.mp4'), ['-preset', 'medium'], size='640x360', rate=30, duration=4, tone=220)
+    first = encode(str(tmp_path / 'first.mp4'), ['-preset', 'ultrafast'], duration=8)
+    second = encode(str(tmp_path / 'second.mp4'), ['-preset', 'ultrafast'], duration=7, tone=660)
+    return [intro, first, second]
+
+
+@pytest.mark.parametrize('crossfade', [0.0, 1.0])
+def test_concat_keeps_parameter_sets_of_the_videos(tmp_path, videos, crossfade):
+    output_path = str(tmp_path / 'out.mp4')
+    concat_videos(videos, output_path, crossfade)
+    assert stream_parameter_sets(output_path) == set(parameter_sets(videos[1], 'h264'))
+    assert probe_media(output_path).duration == pytest.approx(4 + 8 + 7 - 2 * crossfade, abs=0.2)
+
+
+def test_concat_encodes_everything_when_parts_can_not_match(tmp_path, videos, monkeypatch, capsys):
+    # without matching options the transitions are encoded with the CABAC settings of the default profile
+    monkeypatch.setattr(montajer_utils, 'stream_args', lambda profile, sets: [])
+    output_path = str(tmp_path / 'out.mp4')
+    concat_videos(videos, output_path, 1.0)
+    assert 'перекодировано целиком' in capsys.readouterr().out
+    assert len(stream_parameter_sets(output_path)) == 2
+    assert probe_media(output_path).duration == pytest.approx(4 + 8 + 7 - 2, abs=0.2)
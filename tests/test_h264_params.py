@@ -0,0 +1,63 @@
+import pytest
+
+from src.encoder_utils import ENCODER_PROFILES, EncoderProfileName, H264Params, encoder_profile, parse_h264_params, \
+    stream_args, _rbsp
+
+# SPS and PPS written by x264 for 320x240 yuv420p: -preset ultrafast / -preset medium -crf 27 /
+# -preset slow -tune film -profile:v main -crf 30 / -preset veryfast -tune stillimage -crf 23
+SAMPLES = {
+    'ultrafast': ('6742c00dda0507ec0440000003004000000c03c50aa8', '68ce0fc8',
+                  H264Params(66, 13, 1, 0, 23, 0, 0, 0, 0)),
+    'medium': ('6764000dacd94141fb011000000300100000030300f1429960', '68ebe52c8b',
+               H264Params(100, 13, 3, 1, 27, 1, 2, 1, -2)),
+    'main-film': ('674d400decc0a0fd80880000030008000003018078a14cd0', '68e97844f2',
+                  H264Params(77, 13, 5, 1, 30, 1, 2, 0, -3)),
+    'stillimage': ('6764000dacd94141fb011000000300100000030300f1429960', '68ef8fcb',
+                   H264Params(100, 13, 1, 1, 23, 1, 2, 1, 0)),
+}
+
+
+def sample_sets(name: str) -> list[bytes]:
+    sps, pps, _ = SAMPLES[name]
+    return [bytes.fromhex(sps), bytes.fromhex(pps)]
+
+
+@pytest.mark.parametrize('name', list(SAMPLES))
+def test_parse_h264_params(name):
+    assert parse_h264_params(sample_sets(name)) == SAMPLES[name][2]
+    # the order of the parameter sets doesn't matter
+    assert parse_h264_params(sample_sets(name)[::-1]) == SAMPLES[name][2]
+
+
+def test_parse_h264_params_of_unsupported_streams():
+    sps = bytes.fromhex(SAMPLES['ultrafast'][0])
+    assert parse_h264_params([]) is None
+    assert parse_h264_params([sps]) is None
+    # PPS with two slice groups
+    assert parse_h264_params([sps, bytes.fromhex('68c5')]) is None
+    # PPS cut before the base qp
+    assert parse_h264_params([sps, bytes.fromhex('68ce')]) is None
+
+
+def test_rbsp_removes_header_and_emulation_prevention():
+    # the SPS samples contain 00 00 03 in the VUI
+    assert _rbsp(bytes.fromhex(SAMPLES['ultrafast'][0])) == bytes.fromhex('42c00dda0507ec04400000004000000c03c50aa8')
+    assert _rbsp(bytes.fromhex('6800000300000301')) == bytes.fromhex('0000000001')
+
+
+def test_stream_args():
+    profile = ENCODER_PROFILES[EncoderProfileName.STILL]
+    assert stream_args(profile, sample_sets('ultrafast')) == [
+        '-profile:v', 'baseline', '-level:v', '1.3',
+        '-x264-params', 'crf=23:ref=1:weightp=0:weightb=0:chroma-qp-offset=0:psy=0']
+    assert stream_args(profile, sample_sets('medium')) == [
+        '-profile:v', 'high', '-level:v', '1.3',
+        '-x264-params', 'crf=27:ref=3:weightp=2:weightb=1:chroma-qp-offset=-2:psy=0:cabac=1:8x8dct=1:bframes=3']
+    assert stream_args(profile, sample_sets('main-film')) == [
+        '-profile:v', 'main', '-level:v', '1.3',
+        '-x264-params', 'crf=30:ref=5:weightp=2:weightb=1:chroma-qp-offset=-3:psy=0:cabac=1:8x8dct=0:bframes=3']
+
+
+def test_stream_args_of_other_encoders():
+    assert stream_args(encoder_profile(codec='h264_nvenc'), sample_sets('medium')) == []
+    assert stream_args(ENCODER_PROFILES[EncoderProfileName.STILL], []) == []
@@ -0,0 +1,76 @@
+import os
+import shutil
+
+import pytest
+
+from src import montajer_utils
+from src.file_utils import PARTIAL_MARK
+from src.manifest_utils import BatchManifest, ItemState, MANIFEST_NAME
+from src.montajer_utils import create_videos_with_image, RenderBackend
+
+
+def test_should_run(tmp_path):
+    manifest = BatchManifest(str(tmp_path / MANIFEST_NAME))
+    output_path = str(tmp_path / 'done.mp4')
+    for name in ['done', 'deleted', 'failed', 'interrupted']:
+        manifest.register(name, name, str(tmp_path / f'{name}.mp4'))
+        manifest.start(name)
+        manifest.stage_started(name, 'render')
+    with open(output_path, 'w'):
+        pass
+    manifest.stage_done('done', 'render', last=True)
+    manifest.stage_done('deleted', 'render', last=True)
+    manifest.stage_failed('failed', 'render', 'error')
+
+    assert manifest.should_run('new')
+    assert not manifest.should_run('done')
+    # the output was removed after the batch, the video is made again
+    assert manifest.should_run('deleted')
+    assert manifest.should_run('failed', max_attempts=2)
+    assert not manifest.should_run('failed', max_attempts=1)
+    assert manifest.should_run('interrupted')
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                    reason='ffmpeg is not installed')
+def test_resumed_batch_retries_only_failed_videos(batch_folders, monkeypatch):
+    audio_folder, images_folder, output_folder = batch_folders
+    export_still_video = montajer_utils.export_still_video
+    renders = []
+
+    def render(frame_path, audio, output_path, *args):
+        renders.append(os.path.basename(output_path))
+        if 'audio_1' in output_path:
+            raise RuntimeError('encoder crashed')
+        return export_still_video(frame_path, audio, output_path, *args)
+
+    monkeypatch.setattr(montajer_utils, 'export_still_video', render)
+
+    def run(**kwargs) -> dict:
+        return create_videos_with_image(audio_folder, images_folder, output_folder, 'caption', threads=2,
+                                        render_backend=RenderBackend.FFMPEG, **kwargs)
+
+    failures = run()
+    assert [os.path.basename(path) for path in failures] == ['audio_1.mp3']
+    assert sorted(name for name in os.listdir(output_folder) if name.endswith('.mp4')) == ['audio_0.mp4', 'audio_2.mp4']
+    assert not [name for name in os.listdir(output_folder) if PARTIAL_MARK in name]
+    manifest = BatchManifest(os.path.join(output_folder, MANIFEST_NAME))
+    items = {os.path.basename(item['name']): item for item in manifest.items()}
+    assert (items['audio_1.mp3']['state'], items['audio_1.mp3']['stage']) == (ItemState.FAILED, 'render')
+    assert 'encoder crashed' in items['audio_1.mp3']['error']
+
+    # with one attempt the failed video is not retried
+    renders.clear()
+    assert run(resume=True, max_attempts=1) == {}
+    assert renders == []
+
+    # the encoder is fixed: only the failed video is rendered again
+    monkeypatch.setattr(montajer_utils, 'export_still_video', lambda *args: renders.append(args[2]) or
+                        export_still_video(*args))
+    assert run(resume=True) == {}
+    assert len(renders) == 1 and 'audio_1' in renders[0]
+    items = {os.path.basename(item['name']): item for item in manifest.items()}
+    assert all(item['state'] == ItemState.DONE for item in items.values())
+    assert [items[f'audio_{i}.mp3']['attempts'] for i in range(3)] == [1, 2, 1]
+    assert sorted(name for name in os.listdir(output_folder) if name.endswith('.mp4')) == \
+        ['audio_0.mp4', 'audio_1.mp4', 'audio_2.mp4']
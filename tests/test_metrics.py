@@ -0,0 +1,41 @@
+import contextvars
+import os
+import threading
+
+from src.metrics_utils import MetricsConfig, configure_metrics, read_metrics, span, summarize_metrics
+
+
+def busy(seconds: float):
+    event = threading.Event()
+    event.wait(seconds)
+    return sum(i * i for i in range(20000))
+
+
+def test_concurrent_profiled_spans(tmp_path):
+    config = MetricsConfig(str(tmp_path / 'metrics.jsonl'), str(tmp_path / 'profiles'))
+    configure_metrics(config, reset=True)
+    try:
+        def job(i: int):
+            with span('transcribe', f'audio_{i}.mp3', profile=True):
+                busy(0.2)
+
+        # metrics settings are per context, threads of a batch are started in a copy of it
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(job, i)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # nested profiled span in the same thread
+        with span('render', 'audio_0.mp3', profile=True):
+            with span('frame_layer', 'audio_0.mp3', profile=True):
+                busy(0.01)
+    finally:
+        configure_metrics(None)
+
+    records = read_metrics(config.report_path)
+    assert len(records) == 6
+    assert all(record['error'] is None for record in records)
+    profiled = [record for record in records if record['profiled']]
+    assert 1 <= len(profiled) <= 5
+    assert len(os.listdir(config.profile_dir)) == len({(r['file'], r['stage']) for r in profiled})
+    assert 'transcribe' in summarize_metrics(config.report_path)
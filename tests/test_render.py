@@ -0,0 +1,34 @@
+import shutil
+
+import pytest
+from PIL import Image
+
+from benchmarks.fixtures import tone_bursts, write_wav
+from src.ffmpeg_utils import render_still_video, probe_audio
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                                reason='ffmpeg is not installed')
+
+
+@pytest.fixture
+def frame_path(tmp_path):
+    path = str(tmp_path / 'frame.png')
+    Image.new('RGB', (320, 180), (40, 80, 120)).save(path)
+    return path
+
+
+@pytest.mark.parametrize('fps', [1, 24])
+def test_still_video_is_as_long_as_audio(tmp_path, frame_path, fps):
+    fixture = tone_bursts(20, 16000)
+    output_path = str(tmp_path / 'out.mp4')
+    render_still_video(frame_path, None, output_path, fps=fps, audio_samples=fixture.samples,
+                       sample_rate=fixture.rate)
+    # at 1 fps the encoder lookahead used to add several seconds of frames after the audio
+    assert probe_audio(output_path).duration == pytest.approx(20, abs=1.0 / fps + 0.1)
+
+
+def test_still_video_from_file_respects_max_duration(tmp_path, frame_path):
+    audio_path = write_wav(str(tmp_path / 'tone.wav'), tone_bursts(20, 16000, 2))
+    output_path = str(tmp_path / 'out.mp4')
+    render_still_video(frame_path, audio_path, output_path, duration=8, fps=1)
+    assert probe_audio(output_path).duration == pytest.approx(8, abs=1.1)
@@ -0,0 +1,77 @@
+import contextvars
+import threading
+import time
+
+import pytest
+
+from src.metrics_utils import MetricsConfig, configure_metrics, read_metrics, span
+from src.scheduler_utils import ExecutorType, StageLimits, Stage, init_worker, run_jobs, run_pipeline, stage_slot
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.current -= 1
+
+
+def encode(name: str, counter: Counter, barrier: threading.Barrier = None):
+    with stage_slot('encoders'), span('render', name), counter:
+        if barrier is not None:
+            # all jobs of an unlimited batch must be able to encode at the same time
+            barrier.wait(timeout=10)
+        else:
+            time.sleep(0.05)
+
+
+def run_batch(tmp_path, batch: str, limits: StageLimits, counter: Counter, barrier: threading.Barrier,
+              pipeline: bool):
+    config = MetricsConfig(str(tmp_path / f'{batch}.jsonl'), None)
+    configure_metrics(config, reset=True)
+    names = [f'{batch}_{i}.mp3' for i in range(4)]
+    if pipeline:
+        init_worker({'encoders': threading.BoundedSemaphore(limits.encoders)} if limits.encoders else {},
+                    metrics_config=config)
+        failures = run_pipeline({name: name for name in names},
+                                [Stage('render', lambda name: encode(name, counter, barrier), 4)])
+    else:
+        failures = run_jobs(encode, {name: dict(name=name, counter=counter, barrier=barrier) for name in names},
+                            ExecutorType.THREAD, 4, limits, metrics_config=config)
+    assert failures == {}
+    return config
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_concurrent_batches_keep_their_limits_and_metrics(tmp_path, pipeline):
+    # like two jobs of the render service with --max-jobs 2: every batch runs in its own context
+    limited, unlimited = Counter(), Counter()
+    barrier = threading.Barrier(4)
+    results = {}
+
+    def batch(name: str, limits: StageLimits, counter: Counter, batch_barrier):
+        results[name] = run_batch(tmp_path, name, limits, counter, batch_barrier, pipeline)
+
+    threads = [threading.Thread(target=contextvars.copy_context().run,
+                                args=(batch, 'limited', StageLimits(1, 1), limited, None)),
+               threading.Thread(target=contextvars.copy_context().run,
+                                args=(batch, 'unlimited', StageLimits(None, 1), unlimited, barrier))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert set(results) == {'limited', 'unlimited'}
+    assert limited.peak == 1
+    assert unlimited.peak == 4
+    for name, config in results.items():
+        records = read_metrics(config.report_path)
+        assert sorted(record['file'] for record in records) == [f'{name}_{i}.mp3' for i in range(4)]
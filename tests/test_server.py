@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from src.server_utils import JobState, RenderService
+
+
+def test_only_the_last_finished_jobs_are_kept():
+    async def scenario():
+        service = RenderService(lambda spec: spec['n'], max_jobs=2, max_finished=3)
+        await service.start()
+        try:
+            jobs = [service.submit({'task-type': 'montage', 'n': i}) for i in range(10)]
+            await service._queue.join()
+            # a queued job cancelled before it runs is finished too
+            queued = service.submit({'task-type': 'montage', 'n': 10})
+            service.cancel(queued.id)
+            await service._queue.join()
+        finally:
+            await service.stop()
+        return service, jobs, queued
+
+    service, jobs, queued = asyncio.run(scenario())
+    assert len(service.jobs) == 3
+    assert service.jobs[queued.id].state == JobState.CANCELLED
+    assert all(job.state == JobState.DONE for job in jobs)
+    assert set(service.jobs) - {queued.id} <= {job.id for job in jobs[-3:]}
+
+
+async def request(path: str, head: str, body: bytes = b'') -> tuple[int, dict]:
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(head.encode('latin-1') + b'\r\n' + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, payload = response.partition(b'\r\n\r\n')
+    return int(status_line.split()[1]), json.loads(payload)
+
+
+def test_large_request_bodies_are_rejected(tmp_path):
+    socket_path = str(tmp_path / 'service.sock')
+
+    async def scenario():
+        service = RenderService(lambda spec: None, max_body=64)
+        server = asyncio.create_task(service.serve(socket_path=socket_path))
+        for _ in range(100):
+            if (tmp_path / 'service.sock').exists():
+                break
+            await asyncio.sleep(0.01)
+        try:
+            spec = json.dumps({'task-type': 'montage'}).encode()
+            accepted = await request(socket_path, f'POST /jobs HTTP/1.1\r\nContent-Length: {len(spec)}\r\n', spec)
+            # the client claims a huge body and doesn't send it: the service answers without waiting for it
+            too_large = await asyncio.wait_for(
+                request(socket_path, 'POST /jobs HTTP/1.1\r\nContent-Length: 1000000000\r\n'), 5)
+            invalid = await request(socket_path, 'POST /jobs HTTP/1.1\r\nContent-Length: many\r\n')
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+        return accepted, too_large, invalid
+
+    accepted, too_large, invalid = asyncio.run(scenario())
+    assert accepted[0] == 201
+    assert too_large[0] == 413
+    assert invalid[0] == 400
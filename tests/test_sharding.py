@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from src.file_utils import atomic_output, PARTIAL_MARK
+from src.manifest_utils import BatchManifest, ItemState
+from src.scheduler_utils import check_cancelled
+from src.sharding_utils import ShardConfig, prepare_sharded_batch, run_sharded, shared_manifest, batch_progress
+
+MAX_ATTEMPTS = 2
+PROCESSES = 4
+THREADS = 2
+ITEMS = 24
+
+
+def render(name: str, output_path: str, log_path: str, manifest: BatchManifest, cancel_event: threading.Event,
+           worker: str):
+    """
+    Stands in for create_video_with_image: records the stage in the manifest like run_stage does
+    and writes the output through atomic_output. Inputs named bad_* always fail.
+    """
+    manifest.stage_started(name, 'render', worker)
+    log(log_path, 'start', name, worker)
+    time.sleep(0.02)
+    try:
+        if name.startswith('bad'):
+            raise RuntimeError(f'cannot render {name}')
+        with atomic_output(output_path, worker) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write(worker)
+    except Exception as e:
+        manifest.stage_failed(name, 'render', repr(e), worker)
+        raise
+    finally:
+        log(log_path, 'end', name, worker)
+    manifest.stage_done(name, 'render', 0.02, last=True, worker=worker)
+
+
+def log(log_path: str, event: str, name: str, worker: str):
+    # one short line per event, O_APPEND keeps lines of different processes whole and ordered
+    fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, f'{event} {name} {worker}\n'.encode())
+    finally:
+        os.close(fd)
+
+
+def shard_worker(output_folder: str, names: list[str], log_path: str, index: int):
+    manifest = shared_manifest(output_folder)
+    jobs = {name: dict(name=name, output_path=os.path.join(output_folder, f'{name}.mp4'), log_path=log_path,
+                       manifest=manifest)
+            for name in names}
+    shard_config = ShardConfig(f'host{index}', 0.2, 30.0, 0.05)
+    failures = run_sharded(render, jobs, manifest, THREADS, shard_config, MAX_ATTEMPTS)
+    # a process may fail the same input more than once, only the failed inputs themselves are checked
+    if set(failures) - {'bad_0', 'bad_1'}:
+        os._exit(1)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='fork is not available')
+def test_several_processes_render_every_input_once(tmp_path):
+    output_folder = str(tmp_path / 'out')
+    log_path = str(tmp_path / 'renders.log')
+    names = [f'audio_{i:02d}' for i in range(ITEMS)] + ['bad_0', 'bad_1']
+    manifest = prepare_sharded_batch(output_folder)
+    for i, name in enumerate(names):
+        manifest.register(name, name, os.path.join(output_folder, f'{name}.mp4'), priority=i)
+    manifest.close()
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=shard_worker, args=(output_folder, names, log_path, i))
+                 for i in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    with open(log_path) as f:
+        events = [line.split() for line in f.read().splitlines()]
+    renders = [(name, worker) for event, name, worker in events if event == 'start']
+    rendered = [name for name, _ in renders]
+    # an input is never processed by two workers at the same time: every start follows the end of the previous one
+    owners = {}
+    for event, name, worker in events:
+        if event == 'start':
+            assert name not in owners, f'{name} is processed by {owners[name]} and {worker}'
+            owners[name] = worker
+        else:
+            assert owners.pop(name) == worker
+    assert not owners
+    good = [name for name in names if not name.startswith('bad')]
+    for name in good:
+        assert rendered.count(name) == 1, name
+    # failed inputs are retried until they used all attempts, never more
+    assert rendered.count('bad_0') == MAX_ATTEMPTS
+    assert rendered.count('bad_1') == MAX_ATTEMPTS
+    # work was spread over processes
+    assert len({worker.split('/')[0] for _, worker in renders}) > 1
+
+    manifest = shared_manifest(output_folder)
+    items = {item['name']: item for item in manifest.items()}
+    for name in good:
+        assert items[name]['state'] == ItemState.DONE
+        assert items[name]['attempts'] == 1
+        with open(os.path.join(output_folder, f'{name}.mp4')) as f:
+            assert f.read() == items[name]['worker']
+    for name in ['bad_0', 'bad_1']:
+        assert items[name]['state'] == ItemState.FAILED
+        assert items[name]['attempts'] == MAX_ATTEMPTS
+        assert 'cannot render' in items[name]['error']
+        assert not os.path.exists(os.path.join(output_folder, f'{name}.mp4'))
+    assert not [name for name in os.listdir(output_folder) if PARTIAL_MARK in name]
+    progress = batch_progress(manifest, MAX_ATTEMPTS)
+    assert (progress.done, progress.failed, progress.retryable, progress.running) == (len(good), 2, 0, 0)
+    assert sum(progress.workers.values()) == len(good)
+
+
+def test_cancelled_batch_returns_inputs_to_the_queue(tmp_path):
+    output_folder = str(tmp_path / 'out')
+    manifest = prepare_sharded_batch(output_folder)
+    names = [f'audio_{i}' for i in range(6)]
+    for name in names:
+        manifest.register(name, name, os.path.join(output_folder, f'{name}.mp4'))
+    batch_event, started = threading.Event(), threading.Event()
+
+    def wait_for_cancel(name: str, cancel_event: threading.Event, worker: str):
+        started.set()
+        while True:
+            check_cancelled(cancel_event)
+            time.sleep(0.01)
+
+    jobs = {name: dict(name=name) for name in names}
+    thread = threading.Thread(target=run_sharded, args=(wait_for_cancel, jobs, manifest, 2,
+                                                        ShardConfig('host', 0.05, 30.0, 0.05)),
+                              kwargs=dict(cancel_event=batch_event))
+    thread.start()
+    assert started.wait(10)
+    batch_event.set()
+    thread.join(10)
+    assert not thread.is_alive()
+    # interrupted inputs don't lose an attempt, nothing else was claimed after the cancellation
+    for item in manifest.items():
+        assert (item['state'], item['attempts'], item['worker']) == (ItemState.PENDING, 0, None)
+
+
+def test_release_keeps_inputs_of_other_workers(tmp_path):
+    manifest = prepare_sharded_batch(str(tmp_path / 'out'))
+    manifest.register('a', 'a', 'a.mp4')
+    assert manifest.claim('first')['name'] == 'a'
+    assert not manifest.release('a', 'second')
+    assert manifest.item('a')['state'] == ItemState.RUNNING
+    assert manifest.release('a', 'first')
+    assert manifest.claim('second')['attempts'] == 1
@@ -0,0 +1,81 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from benchmarks.fixtures import tone_bursts, write_wav
+from src.ffmpeg_utils import SilenceConfig, StreamingSilenceCutter, cut_audio, detect_silence, \
+    detect_silence_in_samples, non_silent_intervals
+
+MIN_DURATION = 0.5
+THRESHOLD_DB = -35.0
+# boundaries of detected silences are rounded to analysis frames (10 ms)
+TOLERANCE = 0.02
+
+
+def expected_silences(fixture, min_duration: float = MIN_DURATION) -> list[tuple[float, float]]:
+    return [(start, end) for start, end in fixture.silences if end - start >= min_duration]
+
+
+def assert_silences_match(actual, expected, tolerance: float = TOLERANCE):
+    assert len(actual) == len(expected), (actual, expected)
+    for (start, end), (expected_start, expected_end) in zip(actual, expected):
+        assert start == pytest.approx(expected_start, abs=tolerance)
+        assert end == pytest.approx(expected_end, abs=tolerance)
+
+
+@pytest.mark.parametrize('rate', [8000, 16000, 22050, 44100, 48000])
+@pytest.mark.parametrize('channels', [1, 2])
+def test_detects_known_gaps(rate, channels):
+    fixture = tone_bursts(30, rate, channels)
+    silences = detect_silence_in_samples(fixture.samples, rate, THRESHOLD_DB, MIN_DURATION)
+    assert_silences_match(silences, expected_silences(fixture))
+
+
+def test_silence_in_one_channel_is_not_silence():
+    fixture = tone_bursts(20, 16000, 2)
+    samples = fixture.samples.copy()
+    start, end = expected_silences(fixture)[0]
+    # the right channel keeps playing during the first gap
+    samples[int(start * 16000):int(end * 16000), 1] = 8000
+    silences = detect_silence_in_samples(samples, 16000, THRESHOLD_DB, MIN_DURATION)
+    assert_silences_match(silences, expected_silences(fixture)[1:])
+
+
+def test_no_silence():
+    t = np.arange(16000 * 3) / 16000
+    samples = (np.sin(2 * np.pi * 440 * t) * 8000).astype(np.int16)
+    assert detect_silence_in_samples(samples, 16000, THRESHOLD_DB, MIN_DURATION) == []
+    assert detect_silence_in_samples(samples[:0], 16000) == []
+
+
+@pytest.mark.parametrize('rate', [16000, 44100])
+@pytest.mark.parametrize('channels', [1, 2])
+@pytest.mark.parametrize('block_size', [1000, 4410, 100000])
+def test_streaming_cutter_matches_cut_audio(rate, channels, block_size):
+    config = SilenceConfig(THRESHOLD_DB, MIN_DURATION, 0.2)
+    fixture = tone_bursts(30, rate, channels)
+    samples = fixture.samples.reshape(len(fixture.samples), channels)
+    silences = detect_silence_in_samples(samples, rate, config.threshold_db, config.min_duration)
+    expected = cut_audio(samples, rate, non_silent_intervals(silences, config.keep_silence, len(samples) / rate))
+
+    cutter = StreamingSilenceCutter(rate, channels, config)
+    chunks = []
+    for start in range(0, len(samples), block_size):
+        chunks.extend(cutter.feed(samples[start:start + block_size]))
+    chunks.extend(cutter.finish())
+    actual = np.concatenate(chunks)
+
+    assert actual.shape == expected.shape
+    assert np.array_equal(actual, expected)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+@pytest.mark.parametrize('rate', [16000, 44100])
+@pytest.mark.parametrize('channels', [1, 2])
+def test_matches_ffmpeg_silencedetect(tmp_path, rate, channels):
+    fixture = tone_bursts(30, rate, channels)
+    path = write_wav(str(tmp_path / 'tone.wav'), fixture)
+    reference = detect_silence(path, MIN_DURATION, THRESHOLD_DB)
+    silences = detect_silence_in_samples(fixture.samples, rate, THRESHOLD_DB, MIN_DURATION)
+    assert_silences_match(silences, reference)
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from benchmarks.bench import StubWhisperModel
+from src import subtitles_utils
+from src.subtitles_utils import SubtitleEntry, SubtitleFormat, default_subtitle_config, iter_chunked_word_timestamps, \
+    iter_subtitles, transcribe_batch, write_subtitle_files
+
+
+@pytest.fixture
+def stub_model(monkeypatch):
+    monkeypatch.setattr(subtitles_utils, 'get_whisper_model', lambda subtitles_config: StubWhisperModel())
+
+
+def test_transcribe_batch_returns_words_of_every_audio(stub_model):
+    audios = {'long': np.zeros(16000 * 4, dtype=np.float32), 'short': np.zeros(16000, dtype=np.float32)}
+    words = transcribe_batch(audios, default_subtitle_config._replace(num_workers=2),
+                             speech_segments={'long': [(1.0, 2.0)]})
+    assert list(words) == ['long', 'short']
+    # only the speech segment of the long audio is transcribed, the short one is transcribed whole
+    assert [word.start for word in words['long']] == pytest.approx([1.0, 1.4, 1.8])
+    assert [word.start for word in words['short']] == pytest.approx([0.0, 0.4, 0.8])
+    assert all(isinstance(word, SubtitleEntry) for word in words['long'] + words['short'])
+
+
+def test_transcribe_batch_skips_audio_without_speech(stub_model):
+    assert transcribe_batch({'silent': np.zeros(16000, dtype=np.float32)}, speech_segments={'silent': []}) == \
+        {'silent': []}
+
+
+def test_write_subtitle_files_writes_every_file(stub_model, tmp_path, monkeypatch):
+    monkeypatch.setattr(subtitles_utils, 'generate_word_timestamps',
+                        lambda audio, model, language, segments: [SubtitleEntry(0.0, 0.5, audio)])
+    output_paths = [str(tmp_path / 'a.srt'), str(tmp_path / 'b.srt')]
+    write_subtitle_files(['a.mp3', 'b.mp3'], output_paths, SubtitleFormat.SRT)
+    for name, path in zip(['a.mp3', 'b.mp3'], output_paths):
+        with open(path, encoding='utf-8') as f:
+            assert f.read() == f'1\n00:00:00,000 --> 00:00:00,500\n{name}\n\n'
+
+
+def test_chunked_transcription_keeps_timestamps_of_the_audio():
+    chunks = [(0.0, np.zeros(16000, dtype=np.float32)), (1.0, np.zeros(8000, dtype=np.float32))]
+    words = list(iter_chunked_word_timestamps(chunks, StubWhisperModel(), None))
+    assert [word.start for word in words] == pytest.approx([0.0, 0.4, 0.8, 1.0, 1.4])
+    assert words[-1].end == pytest.approx(1.5)
+
+
+def words(text: str, starts: list[float] = None, length: float = 0.4) -> list[SubtitleEntry]:
+    """
+    Words of the text, by default one every 0.5s.
+    """
+    tokens = text.split()
+    starts = starts or [i * 0.5 for i in range(len(tokens))]
+    return [SubtitleEntry(start, start + length, token) for start, token in zip(starts, tokens)]
+
+
+def test_iter_subtitles_fills_lines_and_cues():
+    cues = list(iter_subtitles(words('aaaa bbbb cccc dddd eeee ffff'), max_line_width=9, max_line_count=2))
+    assert cues == [SubtitleEntry(0.0, 1.9, 'aaaa bbbb\ncccc dddd'), SubtitleEntry(2.0, 2.9, 'eeee ffff')]
+    # a word longer than the line takes a line of its own
+    assert [cue.word for cue in iter_subtitles(words('a verylongword b'), max_line_width=5)] == \
+        ['a\nverylongword', 'b']
+
+
+def test_iter_subtitles_splits_cues():
+    # pauses
+    cues = iter_subtitles(words('one two three', [0.0, 0.5, 3.0]), max_line_width=40, split_pause=1.0)
+    assert [cue.word for cue in cues] == ['one two', 'three']
+    # duration of a cue
+    cues = iter_subtitles(words('a b c d e'), max_line_width=40, max_cue_duration=1.0)
+    assert [(cue.start, cue.word) for cue in cues] == [(0.0, 'a b'), (1.0, 'c d'), (2.0, 'e')]
+    # sentences
+    text = 'Hello there. How are you? Fine'
+    assert [cue.word for cue in iter_subtitles(words(text), max_line_width=40, split_on_punctuation=True)] == \
+        ['Hello there.', 'How are you?', 'Fine']
+    assert [cue.word for cue in iter_subtitles(words(text), max_line_width=40)] == ['Hello there. How are you? Fine']
+
+
+def test_iter_subtitles_yields_cues_before_all_words_are_decoded():
+    consumed = []
+
+    def decoded():
+        for word in words('aaaa bbbb cccc dddd eeee'):
+            consumed.append(word.word)
+            yield word
+
+    cues = iter_subtitles(decoded(), max_line_width=4, max_line_count=1)
+    assert next(cues).word == 'aaaa'
+    assert consumed == ['aaaa', 'bbbb']
+    assert [cue.word for cue in cues] == ['bbbb', 'cccc', 'dddd', 'eeee']
+    assert list(iter_subtitles([])) == []